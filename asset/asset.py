@@ -2,6 +2,7 @@
 
 from odoo import models, fields, api
 import odoo.addons.decimal_precision as dp
+from odoo.addons.core.core import insert_rows
 from odoo.exceptions import UserError, ValidationError
 from datetime import datetime
 
@@ -441,68 +442,95 @@ class CreateDepreciationWizard(models.TransientModel):
         compute='_compute_period_id', ondelete='restrict', store=True)
 
     @api.multi
-    def _get_voucher_line(self, asset, cost_depreciation, vouch_obj):
-        '''借方行'''
-        res = {}
-        if asset.account_depreciation.id not in res:
-            res[asset.account_depreciation.id] = {'debit': 0}
-        val = res[asset.account_depreciation.id]
-        val.update({'debit': val.get('debit') + cost_depreciation,
-                    'voucher_id': vouch_obj.id,
-                    'account_id': asset.account_depreciation.id,
-                    'name': u'固定资产折旧',
-                    })
+    def _compute_depreciation(self):
+        '''
+        计算本期所有需要折旧的固定资产的折旧额：资产和已提折旧各用一条SQL取出，在内存中计算，
+        本期已经折旧过的资产跳过，折旧之后达到最终残值的资产本期只提剩余部分并标记为不折旧
+        :return: 折旧明细行的值列表
+        '''
+        self.env.cr.execute('''
+            SELECT id, code, name, surplus_value, depreciation_value, cost_depreciation,
+                   account_depreciation, account_accumulated_depreciation
+            FROM asset
+            WHERE no_depreciation IS NOT TRUE
+              AND (period_id IS NULL OR period_id != %s)
+            ORDER BY code
+        ''', (self.period_id.id,))
+        assets = self.env.cr.dictfetchall()
+        if not assets:
+            return []
+
+        self.env.cr.execute('''
+            SELECT order_id, sum(cost_depreciation), bool_or(period_id = %s)
+            FROM asset_line
+            WHERE order_id IN %s
+            GROUP BY order_id
+        ''', (self.period_id.id, tuple(asset['id'] for asset in assets)))
+        depreciated = dict((row[0], row[1:]) for row in self.env.cr.fetchall())
+
+        lines = []
+        for asset in assets:
+            accumulated, current_period = depreciated.get(asset['id'], (0, False))
+            if current_period:
+                continue
+            cost_depreciation = asset['cost_depreciation'] or 0
+            total = (accumulated or 0) + (asset['depreciation_value'] or 0)
+            surplus_value = asset['surplus_value'] or 0
+            done = surplus_value <= total + cost_depreciation
+            if done:
+                cost_depreciation = surplus_value - total
+            lines.append(dict(asset,
+                              cost_depreciation=cost_depreciation,
+                              no_depreciation=surplus_value - total - cost_depreciation,
+                              done=done))
+
+        return lines
 
-        '''贷方行'''
-        if asset.account_accumulated_depreciation.id not in res:
-            res[asset.account_accumulated_depreciation.id] = {'credit': 0}
+    @api.multi
+    def _generate_asset_lines(self, lines):
+        '''用多行INSERT批量生成折旧明细行'''
+        asset_line_ids = insert_rows(
+            self.env, 'asset_line',
+            ['order_id', 'code', 'name', 'date', 'period_id', 'cost_depreciation', 'no_depreciation'],
+            [(line['id'], line['code'], line['name'], self.date, self.period_id.id,
+              line['cost_depreciation'], line['no_depreciation']) for line in lines])
+        self.env['asset'].invalidate_cache(['line_ids'], [line['id'] for line in lines])
 
-        val = res[asset.account_accumulated_depreciation.id]
-        val.update({'credit': val.get('credit') + cost_depreciation,
-                    'voucher_id': vouch_obj.id,
-                    'account_id': asset.account_accumulated_depreciation.id,
-                    'name': u'固定资产折旧',
-                    })
-        return res
+        return asset_line_ids
 
     @api.multi
-    def _generate_asset_line(self, asset, cost_depreciation, total):
-        '''生成折旧明细行'''
-        asset_line = self.env['asset.line'].create({
-             'date': asset.date,
-             'order_id': asset.id,
-             'period_id': self.period_id.id,
-             'cost_depreciation': cost_depreciation,
-             'name': asset.name,
-             'code': asset.code,
-             'no_depreciation': asset.surplus_value - total - cost_depreciation,
-            })
-        return asset_line
+    def _get_voucher_lines(self, lines):
+        '''按科目汇总折旧额：借方为折旧费用科目，贷方为累计折旧科目'''
+        debits, credits = {}, {}
+        for line in lines:
+            debit_account = line['account_depreciation']
+            credit_account = line['account_accumulated_depreciation']
+            debits[debit_account] = debits.get(debit_account, 0) + line['cost_depreciation']
+            credits[credit_account] = credits.get(credit_account, 0) + line['cost_depreciation']
+
+        voucher_lines = []
+        for account_id, debit in sorted(debits.iteritems()):
+            if debit:
+                voucher_lines.append((0, 0, {'account_id': account_id, 'debit': debit, 'name': u'固定资产折旧'}))
+        for account_id, credit in sorted(credits.iteritems()):
+            if credit:
+                voucher_lines.append((0, 0, {'account_id': account_id, 'credit': credit, 'name': u'固定资产折旧'}))
+
+        return voucher_lines
 
     @api.multi
     def create_depreciation(self):
         ''' 资产折旧，生成凭证和折旧明细'''
-        vouch_obj = self.env['voucher'].create({'date': self.date})
-        res = {}
-        asset_line_id_list = []
-        for asset in self.env['asset'].search([('no_depreciation', '=', False), ('period_id','!=', self.period_id.id)]):
-            if self.period_id not in asset.line_ids.period_id:
-                cost_depreciation = asset.cost_depreciation
-                total = sum(line.cost_depreciation for line in asset.line_ids) + asset.depreciation_value
-                if asset.surplus_value <= (total + cost_depreciation):
-                    cost_depreciation = asset.surplus_value - total
-                    asset.no_depreciation = 1
-                # 获得凭证明细行
-                res = self._get_voucher_line(asset, cost_depreciation, vouch_obj)
-                # 生成折旧明细行
-                asset_line_row = self._generate_asset_line(asset, cost_depreciation, total)
-                asset_line_id_list.append(asset_line_row.id)
-        for account_id,val in res.iteritems():
-            self.env['voucher.line'].create(dict(val,account_id = account_id))
-
-        if not vouch_obj.line_ids:
-            vouch_obj.unlink()
+        lines = self._compute_depreciation()
+        voucher_lines = self._get_voucher_lines(lines)
+        if not voucher_lines:
             raise UserError(u'本期所有固定资产都已折旧！')
+
+        vouch_obj = self.env['voucher'].create({'date': self.date, 'line_ids': voucher_lines})
+        asset_line_id_list = self._generate_asset_lines(lines)
+        done_asset_ids = [line['id'] for line in lines if line['done']]
+        if done_asset_ids:
+            self.env['asset'].browse(done_asset_ids).write({'no_depreciation': True})
         vouch_obj.voucher_done()
         view = self.env.ref('asset.asset_line_tree')
         return {
@@ -27,3 +27,16 @@ class test_asset(TransactionCase):
         self.asset.onchange_partner_id()
         self.asset.bank_account = self.env.ref('core.alipay')
         self.asset.onchange_bank_account()
+
+    def test_create_depreciation(self):
+        '''批量计提折旧，同一期间不重复折旧'''
+        self.asset.asset_done()
+        wizard = self.env['create.depreciation.wizard'].create({'date': '2016-05-31'})
+        line_ids = wizard.create_depreciation()['domain'][0][2]
+        line = self.env['asset.line'].search([('id', 'in', line_ids), ('order_id', '=', self.asset.id)])
+        self.assertEqual(line.period_id, wizard.period_id)
+        self.assertAlmostEqual(line.cost_depreciation, self.asset.cost_depreciation)
+        self.assertAlmostEqual(line.no_depreciation, self.asset.surplus_value - self.asset.depreciation_value
+                               - self.asset.cost_depreciation)
+        with self.assertRaises(UserError):
+            wizard.create_depreciation()
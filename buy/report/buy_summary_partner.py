@@ -9,6 +9,8 @@ class buy_summary_partner(models.Model):
     _name = 'buy.summary.partner'
     _inherit = 'report.base'
     _description = u'采购汇总表（按供应商）'
+    _order = 'partner ASC'
+    _sql_pushdown = True
 
     id_lists = fields.Text(u'移动明细行id列表')
     date = fields.Date(u'日期')
@@ -119,10 +121,6 @@ class buy_summary_partner(models.Model):
                 context.get('warehouse_dest_id')[0] or '',
         }
 
-    def _compute_order(self, result, order):
-        order = order or 'partner ASC'
-        return super(buy_summary_partner, self)._compute_order(result, order)
-
     def collect_data_by_sql(self, sql_type='out'):
         collection = self.execute_sql(sql_type='out')
 
@@ -8,25 +8,11 @@ from odoo.exceptions import UserError
 
 class supplier_statements_report(models.Model):
     _name = "supplier.statements.report"
+    _inherit = 'statements.balance.mixin'
     _description = u"供应商对账单"
     _auto = False
     _order = 'id, date'
 
-    @api.one
-    @api.depends('amount', 'pay_amount', 'partner_id')
-    def _compute_balance_amount(self):
-        pre_record = self.search([
-            ('id', '=', self.id - 1),
-            ('partner_id', '=', self.partner_id.id)
-        ])
-        # 相邻的两条记录，partner不同，应收款余额重新计算
-        if pre_record:
-            before_balance = pre_record.this_balance_amount
-        else:
-            before_balance = 0
-        self.balance_amount += before_balance + self.amount - self.pay_amount - self.discount_money
-        self.this_balance_amount = self.balance_amount
-
     partner_id = fields.Many2one('partner', string=u'业务伙伴', readonly=True)
     name = fields.Char(string=u'单据编号', readonly=True)
     date = fields.Date(string=u'单据日期', readonly=True)
@@ -41,38 +27,16 @@ class supplier_statements_report(models.Model):
                               digits=dp.get_precision('Amount'))
     discount_money = fields.Float(string=u'付款折扣', readonly=True,
                                   digits=dp.get_precision('Amount'))
-    balance_amount = fields.Float(
-        string=u'应付款余额',
-        compute='_compute_balance_amount',
-        readonly=True,
-        digits=dp.get_precision('Amount'))
-    this_balance_amount = fields.Float(string=u'应付款余额',
+    balance_amount = fields.Float(string=u'应付款余额', readonly=True,
+                                  digits=dp.get_precision('Amount'))
+    this_balance_amount = fields.Float(string=u'应付款余额', readonly=True,
                                        digits=dp.get_precision('Amount'))
     note = fields.Char(string=u'备注', readonly=True)
     move_id = fields.Many2one('wh.move', string=u'出入库单', readonly=True)
 
-    def init(self):
-        # union money_order(type = 'pay'), money_invoice(type = 'expense')
-        cr = self._cr
-        tools.drop_view_if_exists(cr, 'supplier_statements_report')
-        cr.execute("""
-            CREATE or REPLACE VIEW supplier_statements_report AS (
-            SELECT  ROW_NUMBER() OVER(ORDER BY partner_id,done_date) AS id,
-                    partner_id,
-                    name,
-                    date,
-                    done_date,
-                    purchase_amount,
-                    benefit_amount,
-                    amount,
-                    pay_amount,
-                    discount_money,
-                    balance_amount,
-                    0 AS this_balance_amount,
-                    note,
-                    move_id
-            FROM
-                (
+    def _statement_lines_sql(self):
+        # 对账单明细行：付款单和采购结算单
+        return """
                 SELECT m.partner_id,
                         m.name,
                         m.date,
@@ -104,8 +68,47 @@ class supplier_statements_report(models.Model):
                 LEFT JOIN core_category AS c ON mi.category_id = c.id
                 LEFT JOIN buy_receipt AS br ON br.buy_move_id = mi.move_id
                 WHERE c.type = 'expense' AND mi.state = 'done'
-                ) AS ps)
-        """)
+        """
+
+    def init(self):
+        # union money_order(type = 'pay'), money_invoice(type = 'expense')
+        # 余额用窗口函数按业务伙伴累计，不再逐条查找上一条记录
+        cr = self._cr
+        tools.drop_view_if_exists(cr, 'supplier_statements_report')
+        cr.execute("""
+            CREATE or REPLACE VIEW supplier_statements_report AS (
+            SELECT  id,
+                    partner_id,
+                    name,
+                    date,
+                    done_date,
+                    purchase_amount,
+                    benefit_amount,
+                    amount,
+                    pay_amount,
+                    discount_money,
+                    %(balance)s AS balance_amount,
+                    %(balance)s AS this_balance_amount,
+                    note,
+                    move_id
+            FROM
+            (
+            SELECT  ROW_NUMBER() OVER(ORDER BY partner_id,done_date) AS id,
+                    partner_id,
+                    name,
+                    date,
+                    done_date,
+                    purchase_amount,
+                    benefit_amount,
+                    amount,
+                    pay_amount,
+                    discount_money,
+                    note,
+                    move_id
+            FROM
+                (%(lines)s) AS ps) AS lines)
+        """ % {'balance': self._balance_window_sql(),
+               'lines': self._statement_lines_sql()})
 
     @api.multi
     def find_source_order(self):
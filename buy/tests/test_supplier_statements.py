@@ -68,7 +68,14 @@ class test_supplier_statements(TransactionCase):
     def test_supplier_statements_find_source(self):
         '''查看供应商对账单明细'''
         # 查看不带商品明细源单
-        self.statement.partner_statements_without_goods()
+        action = self.statement.partner_statements_without_goods()
+        lines = self.env[action['res_model']].search(action['domain'], order='id')
+        # 第一行是期初余额，之后的余额在期初余额的基础上累计
+        self.assertEqual(lines[0].name, u'期初')
+        with self.assertRaises(UserError):
+            lines[0].find_source_order()
+        self.assertAlmostEqual(lines[-1].balance_amount, lines[0].balance_amount + sum(
+            line.amount - line.pay_amount - line.discount_money for line in lines[1:]))
         supplier_statement = self.env['supplier.statements.report'].search([])
         supplier_statement_init = self.env['supplier.statements.report'].search([('move_id', '=', False),
                                                                                  ('amount', '!=', 0)])
@@ -80,11 +87,12 @@ class test_supplier_statements(TransactionCase):
             report.find_source_order()
 
         # 查看带商品明细源单
-        self.statement.partner_statements_with_goods()
+        action = self.statement.partner_statements_with_goods()
         objGoods = self.env['supplier.statements.report.with.goods']
-        supplier_statement_goods = objGoods.search([('name', '!=', False)])
-        supplier_statement_goods_init = objGoods.search([('move_id', '=', False),
-                                                         ('amount', '!=', 0)])
+        supplier_statement_goods = objGoods.search(
+            action['domain'] + [('name', '!=', False), ('name', '!=', u'期初')])
+        supplier_statement_goods_init = objGoods.search(
+            action['domain'] + [('move_id', '=', False), ('amount', '!=', 0)])
 
         # 如果对账单中是期初余额行，点击查看按钮应报错
         with self.assertRaises(UserError):
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from itertools import islice
 import odoo.addons.decimal_precision as dp
 from odoo import models, fields, api
 from odoo.exceptions import UserError
@@ -20,6 +21,32 @@ def create(self, vals):
 
 models.BaseModel.create = create
 
+# 批量写入：每batch_size行用一条多行INSERT直接写入数据库，不再逐行create，返回新记录的id
+# rows中每一行是与columns一一对应的值，create_uid、write_uid等审计字段自动填写当前用户和时间
+
+
+def insert_rows(env, table, columns, rows, batch_size=1000):
+    record_ids = []
+    row_sql = '(%s)' % ', '.join(['%s'] * len(columns) + [
+        "%s, (now() at time zone 'UTC'), %s, (now() at time zone 'UTC')"])
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        params = []
+        for row in batch:
+            params.extend(row)
+            params.extend([env.uid, env.uid])
+        env.cr.execute('''
+            INSERT INTO %s (%s, create_uid, create_date, write_uid, write_date)
+            VALUES %s
+            RETURNING id
+        ''' % (table, ', '.join(columns), ', '.join([row_sql] * len(batch))), params)
+        record_ids.extend(row[0] for row in env.cr.fetchall())
+
+    return record_ids
+
 # 分类的类别
 
 CORE_CATEGORY_TYPE = [('customer', u'客户'),
@@ -30,7 +57,7 @@ CORE_CATEGORY_TYPE = [('customer', u'客户'),
                       ('other_pay', u'其他支出'),
                       ('other_get', u'其他收入'),
                       ('attribute', u'属性')]
-# 成本计算方法，已实现 先入先出
+# 成本计算方法，已实现 移动平均 和 先入先出
 
 CORE_COST_METHOD = [('average', u'移动平均法'),
                     ('fifo', u'先进先出法'),
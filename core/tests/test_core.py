@@ -2,6 +2,7 @@
 from odoo.tests.common import TransactionCase
 from psycopg2 import IntegrityError
 from odoo.exceptions import UserError
+from odoo.addons.core.core import insert_rows
 
 
 class test_core(TransactionCase):
@@ -17,6 +18,15 @@ class test_core(TransactionCase):
         self.env['res.currency'].rmb_upper(10000100.3)
         # 测试输入value为负时的货币大写问题
         self.assertTrue(self.env['res.currency'].rmb_upper(-10000100.3) == u'负壹仟万零壹佰元叁角整')
+
+    def test_insert_rows(self):
+        '''测试多行INSERT批量写入，超过batch_size时分成多条INSERT'''
+        uom_ids = insert_rows(self.env, 'uom', ['name'],
+                              [(u'批量%s' % i,) for i in range(3)], batch_size=2)
+        uoms = self.env['uom'].browse(uom_ids)
+        self.assertEqual(uoms.mapped('name'), [u'批量0', u'批量1', u'批量2'])
+        self.assertEqual(uoms.mapped('create_uid'), self.env.user)
+        self.assertEqual(insert_rows(self.env, 'uom', ['name'], []), [])
         
 class test_res_users(TransactionCase):
     
@@ -56,44 +56,84 @@ class create_balance_sheet_wizard(models.TransientModel):
     period_id = fields.Many2one('finance.period', string=u'会计期间', domain=_default_period_domain,
                                 default=_default_period_id, help=u'用来设定报表的期间')
 
+    @api.model
+    def _get_trial_balances(self, periods):
+        """
+        一条SQL取出各期间所有科目的余额，返回{期间id: {科目id: 余额行}}，
+        余额行中同时带有科目的类型和余额方向，报表的每一行直接在内存中计算
+        """
+        period_ids = tuple(period.id for period in periods if period)
+        trial_balances = dict((period_id, {}) for period_id in period_ids)
+        if not period_ids:
+            return trial_balances
+
+        self.env.cr.execute("""
+            SELECT tb.period_id, tb.subject_name_id,
+                   account.costs_types, account.balance_directions,
+                   COALESCE(tb.initial_balance_debit, 0) AS initial_balance_debit,
+                   COALESCE(tb.initial_balance_credit, 0) AS initial_balance_credit,
+                   COALESCE(tb.current_occurrence_debit, 0) AS current_occurrence_debit,
+                   COALESCE(tb.current_occurrence_credit, 0) AS current_occurrence_credit,
+                   COALESCE(tb.ending_balance_debit, 0) AS ending_balance_debit,
+                   COALESCE(tb.ending_balance_credit, 0) AS ending_balance_credit,
+                   COALESCE(tb.cumulative_occurrence_debit, 0) AS cumulative_occurrence_debit,
+                   COALESCE(tb.cumulative_occurrence_credit, 0) AS cumulative_occurrence_credit
+            FROM trial_balance tb
+            JOIN finance_account account ON tb.subject_name_id = account.id
+            WHERE tb.period_id IN %s
+        """, (period_ids,))
+        for row in self.env.cr.dictfetchall():
+            trial_balances[row['period_id']][row['subject_name_id']] = row
+
+        return trial_balances
+
     @api.multi
-    def compute_balance(self, parameter_str, period_id, compute_field_list):
-        """根据所填写的 科目的code 和计算的字段 进行计算对应的资产值"""
+    def compute_balance(self, parameter_str, period_id, compute_field_list, trial_balances=None):
+        """根据所填写的 科目的code 和计算的字段 进行计算对应的资产值
+        trial_balances为_get_trial_balances取出的该期间的余额，不传时单独查询"""
         if parameter_str:
-            parameter_str_list = parameter_str.split('~')
+            if trial_balances is None:
+                trial_balances = self._get_trial_balances(period_id).get(period_id.id, {})
             subject_vals = []
-            if len(parameter_str_list) == 1:
-                subject_ids = self.env['finance.account'].search([('code', '=', parameter_str_list[0])])
-            else:
-                subject_ids = self.env['finance.account'].search([('code', '>=', parameter_str_list[0]), ('code', '<=', parameter_str_list[1])])
-            trial_balances = self.env['trial.balance'].search([('subject_name_id', 'in', [subject.id for subject in subject_ids]), ('period_id', '=', period_id.id)])
-            for trial_balance in trial_balances:
+            for account_id in self.env['finance.account'].get_formula_account_ids(parameter_str):
+                trial_balance = trial_balances.get(account_id)
+                if not trial_balance:
+                    continue
                 # 根据参数code 对应的科目的 方向 进行不同的操作
-                #  trial_balance.subject_name_id.costs_types == 'assets'解决：累计折旧 余额记贷方
-                if trial_balance.subject_name_id.costs_types == 'assets':
+                #  costs_types == 'assets'解决：累计折旧 余额记贷方
+                if trial_balance['costs_types'] == 'assets':
                     subject_vals.append(trial_balance[compute_field_list[0]] - trial_balance[compute_field_list[1]])
-                elif trial_balance.subject_name_id.costs_types == 'debt' or trial_balance.subject_name_id.costs_types == 'equity':
+                elif trial_balance['costs_types'] in ('debt', 'equity'):
                     subject_vals.append(trial_balance[compute_field_list[1]] - trial_balance[compute_field_list[0]])
             return sum(subject_vals)
 
         else:
             return 0
 
+    @api.multi
+    def _prepare_trial_balance(self):
+        """ 未结账的期间重新生成科目余额表，已结账期间的科目余额表不会再变化，直接使用 """
+        if not self.period_id.is_closed:
+            balance_wizard = self.env['create.trial.balance.wizard'].create({'period_id': self.period_id.id})
+            balance_wizard.create_trial_balance()
+
     @api.multi
     def create_balance_sheet(self):
         """ 资产负债表的创建 """
-        balance_wizard = self.env['create.trial.balance.wizard'].create({'period_id': self.period_id.id})
-        balance_wizard.create_trial_balance()
+        self._prepare_trial_balance()
         view_id = self.env.ref('finance.balance_sheet_tree_wizard').id
         balance_sheet_objs = self.env['balance.sheet'].search([])
         period = self.env['finance.period'].search([('year', '=', self.period_id.year), ('month', '=', '1')])
         year_begain_field = ['initial_balance_debit', 'initial_balance_credit']
         current_period_field = ['ending_balance_debit', 'ending_balance_credit']
+        trial_balances = self._get_trial_balances([period, self.period_id])
+        year_begain_balances = trial_balances.get(period.id, {})
+        current_period_balances = trial_balances.get(self.period_id.id, {})
         for balance_sheet_obj in balance_sheet_objs:
-            balance_sheet_obj.write({'beginning_balance': fabs(self.compute_balance(balance_sheet_obj.balance_formula, period, year_begain_field)),
-                                     'ending_balance': fabs(self.compute_balance(balance_sheet_obj.balance_formula, self.period_id, current_period_field)),
-                                     'beginning_balance_two': self.compute_balance(balance_sheet_obj.balance_two_formula, period, year_begain_field),
-                                     'ending_balance_two': self.compute_balance(balance_sheet_obj.balance_two_formula, self.period_id, current_period_field)})
+            balance_sheet_obj.write({'beginning_balance': fabs(self.compute_balance(balance_sheet_obj.balance_formula, period, year_begain_field, year_begain_balances)),
+                                     'ending_balance': fabs(self.compute_balance(balance_sheet_obj.balance_formula, self.period_id, current_period_field, current_period_balances)),
+                                     'beginning_balance_two': self.compute_balance(balance_sheet_obj.balance_two_formula, period, year_begain_field, year_begain_balances),
+                                     'ending_balance_two': self.compute_balance(balance_sheet_obj.balance_two_formula, self.period_id, current_period_field, current_period_balances)})
         force_company = self._context.get('force_company')
         if not force_company:
             force_company = self.env.user.company_id.id
@@ -118,15 +158,15 @@ class create_balance_sheet_wizard(models.TransientModel):
     @api.multi
     def create_profit_statement(self):
         """生成利润表"""
-        balance_wizard = self.env['create.trial.balance.wizard'].create({'period_id': self.period_id.id})
-        balance_wizard.create_trial_balance()
+        self._prepare_trial_balance()
         view_id = self.env.ref('finance.profit_statement_tree').id
         balance_sheet_objs = self.env['profit.statement'].search([])
         year_begain_field = ['cumulative_occurrence_debit', 'cumulative_occurrence_credit']
         current_period_field = ['current_occurrence_debit', 'current_occurrence_credit']
+        trial_balances = self._get_trial_balances(self.period_id).get(self.period_id.id, {})
         for balance_sheet_obj in balance_sheet_objs:
-            balance_sheet_obj.write({'cumulative_occurrence_balance': self.compute_profit(balance_sheet_obj.occurrence_balance_formula, self.period_id, year_begain_field),
-                                     'current_occurrence_balance': self.compute_profit(balance_sheet_obj.occurrence_balance_formula, self.period_id, current_period_field)})
+            balance_sheet_obj.write({'cumulative_occurrence_balance': self.compute_profit(balance_sheet_obj.occurrence_balance_formula, self.period_id, year_begain_field, trial_balances),
+                                     'current_occurrence_balance': self.compute_profit(balance_sheet_obj.occurrence_balance_formula, self.period_id, current_period_field, trial_balances)})
         force_company = self._context.get('force_company')
         if not force_company:
             force_company = self.env.user.company_id.id
@@ -149,30 +189,28 @@ class create_balance_sheet_wizard(models.TransientModel):
         }
 
     @api.multi
-    def compute_profit(self, parameter_str, period_id, compute_field_list):
-        """ 根据传进来的 的科目的code 进行利润表的计算 """
+    def compute_profit(self, parameter_str, period_id, compute_field_list, trial_balances=None):
+        """ 根据传进来的 的科目的code 进行利润表的计算
+        trial_balances为_get_trial_balances取出的该期间的余额，不传时单独查询"""
         if parameter_str:
-            parameter_str_list = parameter_str.split('~')
+            if trial_balances is None:
+                trial_balances = self._get_trial_balances(period_id).get(period_id.id, {})
             subject_vals_in = []
             subject_vals_out = []
             total_sum = 0
-            sign_in = False
-            sign_out = False
-            if len(parameter_str_list) == 1:
-                subject_ids = self.env['finance.account'].search([('code', '=', parameter_str_list[0])])
-            else:
-                subject_ids = self.env['finance.account'].search([('code', '>=', parameter_str_list[0]), ('code', '<=', parameter_str_list[1])])
-            if subject_ids:   # 本行计算科目借贷方向
-                for line in subject_ids:
-                    if line.balance_directions == 'in':
-                        sign_in = True
-                    if line.balance_directions == 'out':
-                        sign_out = True
-            trial_balances = self.env['trial.balance'].search([('subject_name_id', 'in', [subject.id for subject in subject_ids]), ('period_id', '=', period_id.id)])
-            for trial_balance in trial_balances:
-                if trial_balance.subject_name_id.balance_directions == 'in':
+            account_obj = self.env['finance.account']
+            subject_ids = account_obj.get_formula_account_ids(parameter_str)
+            # 本行计算科目借贷方向，直接从科目索引中取得
+            directions = set(account_obj.get_account_direction(subject_id) for subject_id in subject_ids)
+            sign_in = 'in' in directions
+            sign_out = 'out' in directions
+            for subject_id in subject_ids:
+                trial_balance = trial_balances.get(subject_id)
+                if not trial_balance:
+                    continue
+                if trial_balance['balance_directions'] == 'in':
                     subject_vals_in.append(trial_balance[compute_field_list[0]])
-                elif trial_balance.subject_name_id.balance_directions == 'out':
+                elif trial_balance['balance_directions'] == 'out':
                     subject_vals_out.append(trial_balance[compute_field_list[1]])
                 if sign_out and sign_in:    # 方向有借且有贷
                     total_sum = sum(subject_vals_out)-sum(subject_vals_in)
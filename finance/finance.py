@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import calendar
+from bisect import bisect_left, bisect_right
 from datetime import datetime
 
 import odoo.addons.decimal_precision as dp
-from odoo import api, fields, models
+from odoo import api, fields, models, tools
 from odoo.exceptions import UserError, ValidationError
 
 FIANNCE_CATEGORY_TYPE = [
@@ -30,6 +31,17 @@ MONTH_SELECTION = [
     ('12', u'12')]
 
 
+def clear_caches_on_transaction_end(model):
+    '''
+    清除模型的ormcache：立即清除一次，使当前事务看到自己的修改；事务提交或者回滚之后再清除一次，
+    丢弃其他请求在提交之前缓存的旧数据，以及回滚掉的记录
+    '''
+    model.clear_caches()
+    cr = model.env.cr
+    cr.after('commit', model.clear_caches)
+    cr.after('rollback', model.clear_caches)
+
+
 class voucher(models.Model):
     '''新建凭证'''
     _name = 'voucher'
@@ -72,32 +84,49 @@ class voucher(models.Model):
     is_checkout = fields.Boolean(u'结账凭证',help=u'是否是结账凭证!')
     is_init = fields.Boolean(u'是否初始化凭证',help=u'是否是初始化凭证!')
 
-    @api.one
+    @api.multi
     def voucher_done(self):
         """
-        审核 凭证按钮 所调用的方法
+        审核 凭证按钮 所调用的方法，可以一次审核多张凭证：
+        所有凭证的借贷合计和凭证行检查用一条汇总SQL完成，再一次批量改变凭证的状态
         :return: 主要是把 凭证的 state改变
         """
-        if self.state == 'done':
-            raise UserError(u'请不要重复审核！')
-        if self.period_id.is_closed is True:
-            raise UserError(u'该会计期间已结账！不能审核')
-        if not self.line_ids:
-            raise ValidationError(u'请输入凭证行')
-        for line in self.line_ids:
-            if line.debit + line.credit == 0:
+        if not self:
+            return True
+        precision = self.env['decimal.precision'].precision_get('Account')
+        self.env.cr.execute('''
+            SELECT vo.id, vo.state, COALESCE(period.is_closed, FALSE),
+                   count(vol.id),
+                   count(vol.id) FILTER (WHERE COALESCE(vol.debit, 0) + COALESCE(vol.credit, 0) = 0),
+                   count(vol.id) FILTER (WHERE COALESCE(vol.debit, 0) * COALESCE(vol.credit, 0) != 0),
+                   round(COALESCE(sum(vol.debit), 0)::numeric, %s),
+                   round(COALESCE(sum(vol.credit), 0)::numeric, %s)
+            FROM voucher vo
+            LEFT JOIN finance_period period ON vo.period_id = period.id
+            LEFT JOIN voucher_line vol ON vol.voucher_id = vo.id
+            WHERE vo.id IN %s
+            GROUP BY vo.id, vo.state, period.is_closed
+            ORDER BY vo.id
+        ''', (precision, precision, tuple(self.ids)))
+        for voucher_id, state, is_closed, line_count, zero_count, both_count, debit_sum, credit_sum \
+                in self.env.cr.fetchall():
+            if state == 'done':
+                raise UserError(u'请不要重复审核！')
+            if is_closed:
+                raise UserError(u'该会计期间已结账！不能审核')
+            if not line_count:
+                raise ValidationError(u'请输入凭证行')
+            if zero_count:
                 raise ValidationError(u'单行凭证行借和贷不能同时为0')
-            if line.debit * line.credit != 0:
+            if both_count:
                 raise ValidationError(u'单行凭证行不能同时输入借和贷')
-        debit_sum = sum([line.debit for line in self.line_ids])
-        credit_sum = sum([line.credit for line in self.line_ids])
-        precision = self.env['decimal.precision'].precision_get('Account')
-        debit_sum = round(debit_sum, precision)
-        credit_sum = round(credit_sum, precision)
-        if debit_sum != credit_sum:
-            raise ValidationError(u'借贷方不平')
+            if debit_sum != credit_sum:
+                raise ValidationError(u'借贷方不平')
+
+        # 一次批量写入状态：跳过只支持单张凭证的write重载，保留状态变化的跟踪记录和凭证行状态的重新计算
+        super(voucher, self).write({'state': 'done'})
 
-        self.state = 'done'
+        return True
 
     @api.one
     def voucher_draft(self):
@@ -256,17 +285,53 @@ class finance_period(models.Model):
         if not period_id:
             return self.create({'year': current_date[0:4],
                                 'month': str(int(current_date[5:7])), })
+
+    @api.model
+    def create(self, vals):
+        clear_caches_on_transaction_end(self)
+        return super(finance_period, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if 'year' in vals or 'month' in vals:
+            clear_caches_on_transaction_end(self)
+        return super(finance_period, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        clear_caches_on_transaction_end(self)
+        return super(finance_period, self).unlink()
+
+    @api.model
+    @tools.ormcache('year', 'month')
+    def _get_period_id(self, year, month):
+        """
+        按(年度, 月份)查找会计期间的id，只缓存不会变化的年月和id，
+        是否结账等状态每次从记录上读取
+        :return: 期间id，不存在时返回None
+        """
+        self.env.cr.execute('''
+            SELECT id FROM finance_period WHERE year = %s AND month = %s
+        ''', (str(year), str(int(month))))
+        row = self.env.cr.fetchone()
+        return row and row[0] or None
+
+    @api.model
+    def find_period(self, year, month):
+        """
+        取得年度、月份对应的会计期间
+        :return: 会计期间的对象 如果不存在则返回空的对象
+        """
+        return self.browse(self._get_period_id(str(year), str(int(month))) or [])
+
     @api.multi
     def get_date_now_period_id(self):
         """
         默认是当前会计期间
         :return: 当前会计期间的对象 如果不存在则返回 False
         """
-        datetime_str = datetime.now().strftime("%Y-%m-%d")
-        datetime_str_list = datetime_str.split('-')
-        period_row = self.env['finance.period'].search(
-            [('year', '=', datetime_str_list[0]), ('month', '=', str(int(datetime_str_list[1])))])
-        return period_row and period_row[0]
+        now = datetime.now()
+        return self.find_period(now.year, now.month)
 
     @api.multi
     def get_period_month_date_range(self, period_id):
@@ -292,17 +357,25 @@ class finance_period(models.Model):
     @api.multi
     def get_period(self, date):
         if date:
-            period_id = self.search([
-                ('year', '=', date[0:4]),
-                ('month', '=', int(date[5:7]))
-            ])
-            if period_id:
-                if period_id.is_closed and self._context.get('module_name', False) != 'checkout_wizard':
-                    raise UserError(u'此会计期间已关闭')
-                else:
-                    return period_id
-            else:
+            return self.get_periods([date])[date]
+
+    @api.model
+    def get_periods(self, dates):
+        """
+        批量取得日期对应的会计期间，同一个月的日期只查找一次
+        :return: {日期: 会计期间的对象}
+        """
+        month_periods = {}
+        for month in set(date[0:7] for date in dates if date):
+            period_id = self._get_period_id(month[0:4], str(int(month[5:7])))
+            if not period_id:
                 raise UserError(u'此日期对应的会计期间不存在')
+            period = self.browse(period_id)
+            if period.is_closed and self._context.get('module_name', False) != 'checkout_wizard':
+                raise UserError(u'此会计期间已关闭')
+            month_periods[month] = period
+
+        return dict((date, month_periods[date[0:7]]) for date in dates if date)
 
     _sql_constraints = [
         ('period_uniq', 'unique (year,month)', u'会计区间不能重复'),
@@ -348,12 +421,20 @@ class finance_account(models.Model):
         ('code', 'unique(code)', u'科目代码必须唯一!'),
     ]
 
+    # 科目索引中保存的字段，这些字段变化时索引失效
+    INDEX_FIELDS = ('code', 'name', 'balance_directions', 'costs_types')
+
     @api.multi
     @api.depends('name', 'code')
     def name_get(self):
+        index = self._get_account_index()
         result = []
         for line in self:
-            account_name = line.code + ' ' + line.name
+            account = index['accounts'].get(line.id)
+            if account:
+                account_name = account[0] + ' ' + account[1]
+            else:
+                account_name = line.code + ' ' + line.name
             result.append((line.id, account_name))
         return result
 
@@ -361,22 +442,127 @@ class finance_account(models.Model):
     def name_search(self, name, args=None, operator='ilike', limit=100):
         '''会计科目按名字和编号搜索'''
         args = args or []
+        if not args and operator == 'ilike':
+            # 没有其他条件时先在科目索引中按编码前缀和名称找出候选科目，再用search套用记录规则
+            index = self._get_account_index()
+            name = tools.ustr(name or '').lower()
+            account_ids = [account_id for code, account_id in zip(index['codes'], index['ids'])
+                           if code.lower().startswith(name)
+                           or name in index['accounts'][account_id][1].lower()]
+            return self.search([('id', 'in', account_ids)], limit=limit).name_get()
+
         domain = []
         if name:
             domain = ['|', ('code', '=ilike', name + '%'), ('name', operator, name)]
         accounts = self.search(domain + args, limit=limit)
         return accounts.name_get()
 
+    @api.model
+    def create(self, vals):
+        clear_caches_on_transaction_end(self)
+        return super(finance_account, self).create(vals)
+
     @api.multi
-    def get_smallest_code_account(self):
-        finance_account_row = self.search([],order='code')
-        return finance_account_row and finance_account_row[0]
+    def write(self, vals):
+        if any(field in vals for field in self.INDEX_FIELDS):
+            clear_caches_on_transaction_end(self)
+        return super(finance_account, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        clear_caches_on_transaction_end(self)
+        return super(finance_account, self).unlink()
+
+    @api.model
+    @tools.ormcache()
+    def _get_account_index(self):
+        '''
+        科目索引：每个数据库只在第一次使用时读取一次全部科目，科目新增、删除或者修改编码、名称、方向时失效，
+        事务提交或者回滚之后再失效一次，回滚掉的科目不会留在索引中
+        codes/ids: 按编码排序的编码和科目id
+        accounts: {科目id: (编码, 名称, 余额方向, 类型, 上级科目id)}
+        children: {科目id: 下级科目id}，上级科目是编码为本科目编码前缀的最长的科目
+        '''
+        self.env.cr.execute('''
+            SELECT id, code, name, balance_directions, costs_types FROM finance_account
+        ''')
+        rows = sorted(self.env.cr.fetchall(), key=lambda row: row[1])
+        code_ids = dict((row[1], row[0]) for row in rows)
+
+        accounts, children = {}, {}
+        for account_id, code, name, balance_directions, costs_types in rows:
+            parent_id = False
+            for length in range(len(code) - 1, 0, -1):
+                if code[:length] in code_ids:
+                    parent_id = code_ids[code[:length]]
+                    children.setdefault(parent_id, []).append(account_id)
+                    break
+            accounts[account_id] = (code, name, balance_directions, costs_types, parent_id)
+
+        return {
+            'codes': tuple(row[1] for row in rows),
+            'ids': tuple(row[0] for row in rows),
+            'accounts': accounts,
+            'children': dict((key, tuple(value)) for key, value in children.iteritems()),
+        }
+
+    @api.model
+    def get_code_range_account_ids(self, code_from, code_to):
+        ''' 编码在code_from和code_to之间(包括两端)的科目id，按编码排序 '''
+        index = self._get_account_index()
+        return index['ids'][bisect_left(index['codes'], code_from):bisect_right(index['codes'], code_to)]
+
+    @api.model
+    def get_code_prefix_account_ids(self, prefix):
+        ''' 编码以prefix开头的科目id(即本科目和所有下级科目)，按编码排序 '''
+        index = self._get_account_index()
+        begin = bisect_left(index['codes'], prefix)
+        end = begin
+        while end < len(index['codes']) and index['codes'][end].startswith(prefix):
+            end += 1
+        return index['ids'][begin:end]
+
+    @api.model
+    def get_child_account_ids(self, account_id):
+        ''' 科目的直接下级科目id '''
+        return self._get_account_index()['children'].get(account_id, ())
 
+    @api.model
+    def get_parent_account_id(self, account_id):
+        ''' 科目的上级科目id，没有上级科目时返回False '''
+        account = self._get_account_index()['accounts'].get(account_id)
+        return account and account[4] or False
+
+    @api.model
+    def get_account_direction(self, account_id):
+        ''' 科目的余额方向 '''
+        account = self._get_account_index()['accounts'].get(account_id)
+        return account and account[2] or False
+
+    @api.model
+    def get_formula_account_ids(self, formula):
+        '''
+        把报表模板上的科目范围(例如 1001 或者 1001~1012999999)解析为科目id，直接在科目索引中查找
+        '''
+        codes = formula.split('~')
+        if len(codes) == 1:
+            index = self._get_account_index()
+            position = bisect_left(index['codes'], codes[0])
+            if position < len(index['codes']) and index['codes'][position] == codes[0]:
+                return index['ids'][position:position + 1]
+            return ()
+
+        return self.get_code_range_account_ids(codes[0], codes[1])
+
+    @api.multi
+    def get_smallest_code_account(self):
+        index = self._get_account_index()
+        return self.browse(index['ids'][:1])
 
     @api.multi
     def get_max_code_account(self):
-        finance_account_row = self.search([],order='code desc')
-        return finance_account_row and finance_account_row[0]
+        index = self._get_account_index()
+        return self.browse(index['ids'][-1:])
 
 
 class auxiliary_financing(models.Model):
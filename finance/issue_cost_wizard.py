@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from odoo import models, fields, api
+from odoo.exceptions import UserError
 
 class MonthProductCost(models.Model):
     _name = 'month.product.cost'
@@ -16,149 +17,120 @@ class MonthProductCost(models.Model):
     current_period_remaining_qty = fields.Float(string='本期剩余数量')
     current_period_remaining_cost = fields.Float(string='剩余数量成本')
 
-    # 使用SQL来取得指定产品情况下的库存数量
     @api.multi
-    def get_stock_qty(self, period_id):
-        date_range = self.env['finance.period'].get_period_month_date_range(period_id)
-        self.env.cr.execute('''
-            SELECT line.goods_id as goods_id,
-                   line.type as type,
-                   sum(line.goods_qty) as qty,
-                   sum(line.cost) as cost
-            FROM wh_move_line line
-            LEFT JOIN warehouse wh_dest ON line.warehouse_dest_id = wh_dest.id
-            LEFT JOIN warehouse wh ON line.warehouse_id = wh.id
-            WHERE  line.state = 'done'
-              AND line.date >= '%s'
-              AND line.date <= '%s'
-              AND ((wh_dest.type='stock'AND wh.type!='stock') OR
-                (wh_dest.type!='stock' AND wh.type='stock'))
-            GROUP BY line.goods_id,line.type
-        ''' % (date_range[0], date_range[1]))
-        return self.env.cr.dictfetchall()
-
-    @api.multi
-    def get_goods_last_period_remaining_qty(self, period_id, goods_id):
-        """
-        :param period_id: 传入当前所需的期间，根据这个期间找到对应的上一个期间
-        :param goods_id: 出入 goods 精确找到 上一期间 对应的 month.product.cost 记录
-        :return: 让上一期间的 剩余数量，和剩余数量成本 以字典 形式返回
-        """
-        last_period = self.env['create.trial.balance.wizard'].compute_last_period_id(period_id)
-        month_product_cost_row = self.search([('period_id', '=', last_period.id), ('goods_id', '=', goods_id)])
-
-        return {
-            'current_period_remaining_qty': month_product_cost_row.current_period_remaining_qty or 0,
-            'current_period_remaining_cost': month_product_cost_row.current_period_remaining_cost or 0
-        }
-
-    @api.multi
-    def current_period_type_current_period(self, dcit_goods):
-        """
-        获得传入的dict的type 属性，根据属性，进行 返回不同的dict key值。
-        :param dcit_goods: 含有type qty 和 cost 三个字段
-        :return: 根据type 类型返回 {'current_period_in_qty':00 ,'current_period_in_cost':00 } 或者
-        {'current_period_out_qty'：00,'current_period_out_cost' :00}
-        """
-        if dcit_goods.get('type') == 'in':
-            res = {'current_period_in_qty': dcit_goods.get('qty', 0),
-                   'current_period_in_cost': dcit_goods.get('cost', 0)}
-        else:
-            res = {'current_period_out_qty': dcit_goods.get('qty'),
-                   'current_period_out_cost': dcit_goods.get('cost', 0)}
-        return res
-
-    @api.multi
-    def month_remaining_qty_cost(self, goods_qty_cost):
-        """
-        根据前边数据据的 构造，在后边对字典里面的值进行处理。
-        算出 本月的剩余的数量以放便，取下月的期初的数量，及余额
-        :param month_remaining_qty_cost:
-        :return: {'current_period_remaining_qty’： ×××,'current_period_remaining_cost':××× }
-        """
-        sum_goods_qty = goods_qty_cost.get('period_begin_qty', 0) - \
-                        goods_qty_cost.get('current_period_out_qty', 0) + \
-                        goods_qty_cost.get('current_period_in_qty', 0)
-        sum_goods_cost =goods_qty_cost.get('period_begin_cost', 0) - \
-                       goods_qty_cost.get('current_period_out_cost',0) + \
-                        goods_qty_cost.get('current_period_in_cost',0)
-        return {'current_period_remaining_qty': sum_goods_qty,
-                'current_period_remaining_cost': sum_goods_cost}
-
-    @api.multi
-    def compute_balance_price(self, data_dcit):
+    def compute_issue_cost(self, period_id):
         """
+        一条SQL生成本期间所有产品的出库成本记录：
+        本期有出入库的产品汇总本期入库、出库的数量和成本，关联上一期间的剩余数量和成本作为期初，
         本月该产品的结存单价 = （上月该产品的成本余额 + 本月入库成本 ）/ (上月数量余额 + 本月入库数量)
-        则本月发出成本 = 结存单价 * 发出数量
-        :param data_dcit:
-        :return:月发出成本
+        则本月发出成本 = 结存单价 * 发出数量，没有结存数量的产品发出成本为0
+        :return: 新生成的记录条数
         """
-        balance_price = (data_dcit.get("period_begin_cost", 0) + data_dcit.get("current_period_in_cost", 0)) / \
-                        (data_dcit.get("period_begin_qty", 0) + data_dcit.get("current_period_in_qty", 0))
-        return balance_price * data_dcit.get("current_period_out_qty", 0)
-
-    @api.multi
-    def create_month_product_cost_voucher(self, period_id, month_product_cost_dict):
-        voucher_line_data_list = []
-        account_row = self.env.ref('finance.account_cost')
-        all_balance_price = 0
-        for create_vals in month_product_cost_dict.values():
-            goods_row = self.env['goods'].browse(create_vals.get('goods_id'))
-            current_period_out_cost = self.compute_balance_price(create_vals)
-            if self.compute_balance_price(create_vals)!=0:
-                voucher_line_data = {'name': u'发出成本', 'credit':current_period_out_cost,
-                                     'account_id': goods_row.category_id.account_id.id,
-                                     'goods_id': create_vals.get('goods_id')}
-                voucher_line_data_list.append([0, 0, voucher_line_data.copy()])
-            create_vals.update({'current_period_out_cost':current_period_out_cost})
-            all_balance_price += self.compute_balance_price(create_vals)
-            self.create(create_vals)
-        if all_balance_price != 0:
-            voucher_line_data_list.append(
-                [0, 0, {'name': u'发出成本', 'account_id': account_row.id, 'debit': all_balance_price}])
-        if voucher_line_data_list:
-            voucher_id = self.env['voucher'].create({'period_id': period_id.id, 'line_ids': voucher_line_data_list,
-                                                     'is_checkout':True})
-            voucher_id.voucher_done()
+        date_range = self.env['finance.period'].get_period_month_date_range(period_id)
+        last_period = self.env['create.trial.balance.wizard'].compute_last_period_id(period_id)
+        self.env.cr.execute('''
+            WITH moves AS (
+                SELECT line.goods_id,
+                       sum(CASE WHEN line.type = 'in' THEN line.goods_qty ELSE 0 END) AS in_qty,
+                       sum(CASE WHEN line.type = 'in' THEN line.cost ELSE 0 END) AS in_cost,
+                       sum(CASE WHEN line.type != 'in' THEN line.goods_qty ELSE 0 END) AS out_qty,
+                       sum(CASE WHEN line.type != 'in' THEN line.cost ELSE 0 END) AS out_cost
+                FROM wh_move_line line
+                LEFT JOIN warehouse wh_dest ON line.warehouse_dest_id = wh_dest.id
+                LEFT JOIN warehouse wh ON line.warehouse_id = wh.id
+                WHERE line.state = 'done'
+                  AND line.date >= %(date_start)s
+                  AND line.date <= %(date_end)s
+                  AND ((wh_dest.type = 'stock' AND wh.type != 'stock') OR
+                    (wh_dest.type != 'stock' AND wh.type = 'stock'))
+                GROUP BY line.goods_id
+            ), costs AS (
+                SELECT moves.goods_id,
+                       COALESCE(last.current_period_remaining_qty, 0) AS begin_qty,
+                       COALESCE(last.current_period_remaining_cost, 0) AS begin_cost,
+                       COALESCE(moves.in_qty, 0) AS in_qty,
+                       COALESCE(moves.in_cost, 0) AS in_cost,
+                       COALESCE(moves.out_qty, 0) AS out_qty,
+                       COALESCE(moves.out_cost, 0) AS out_cost
+                FROM moves
+                LEFT JOIN month_product_cost last
+                       ON last.goods_id = moves.goods_id AND last.period_id = %(last_period_id)s
+            )
+            INSERT INTO month_product_cost (period_id, goods_id, period_begin_qty, period_begin_cost,
+                current_period_in_qty, current_period_in_cost, current_period_out_qty,
+                current_period_out_cost, current_period_remaining_qty, current_period_remaining_cost,
+                create_uid, create_date, write_uid, write_date)
+            SELECT %(period_id)s, goods_id, begin_qty, begin_cost, in_qty, in_cost, out_qty,
+                   COALESCE((begin_cost + in_cost) / NULLIF(begin_qty + in_qty, 0), 0) * out_qty,
+                   begin_qty - out_qty + in_qty,
+                   begin_cost - out_cost + in_cost,
+                   %(uid)s, (now() at time zone 'UTC'), %(uid)s, (now() at time zone 'UTC')
+            FROM costs
+        ''', {'date_start': date_range[0],
+              'date_end': date_range[1],
+              'last_period_id': last_period.id or None,
+              'period_id': period_id.id,
+              'uid': self.env.uid})
+        self.invalidate_cache()
+
+        return self.env.cr.rowcount
 
     @api.multi
-    def data_structure(self, list_dict_data, period_id):
+    def create_month_product_cost_voucher(self, period_id):
         """
-
-        :param list_dict_data:
-        :param period_id:
-        :return:
+        根据本期间的出库成本记录生成结账凭证：每个产品一条贷方凭证行(产品类别上的科目)，
+        再加一条借方的发出成本合计，凭证行用一条INSERT批量写入
         """
-        month_product_cost_dict = {}
-        for dict_goods in list_dict_data:
-            period_begin_qty_cost = self.get_goods_last_period_remaining_qty(period_id, dict_goods.get('goods_id'))
-            vals = {}
-            if dict_goods.get('goods_id') not in month_product_cost_dict:
-                vals = {'goods_id': dict_goods.get('goods_id'), 'period_id': period_id.id,
-                        'period_begin_qty': period_begin_qty_cost.get('current_period_remaining_qty', 0),
-                        'period_begin_cost': period_begin_qty_cost.get('current_period_remaining_cost', 0)}
-                vals.update(self.current_period_type_current_period(dict_goods))
-                month_product_cost_dict.update({dict_goods.get('goods_id'): vals.copy()})
-                month_product_cost_dict.get(dict_goods.get('goods_id')).update(self.month_remaining_qty_cost(
-                    month_product_cost_dict.get(dict_goods.get('goods_id'))))
-            else:
-                vals.update(self.current_period_type_current_period(dict_goods))
-                month_product_cost_dict.get(dict_goods.get('goods_id')).update(vals.copy())
-                month_product_cost_dict.get(dict_goods.get('goods_id')).update(self.month_remaining_qty_cost(
-                    month_product_cost_dict.get(dict_goods.get('goods_id'))))
-        return month_product_cost_dict
+        self.env.cr.execute('''
+            SELECT cost.goods_id, category.account_id, cost.current_period_out_cost
+            FROM month_product_cost cost
+            JOIN goods goods ON cost.goods_id = goods.id
+            LEFT JOIN core_category category ON goods.category_id = category.id
+            WHERE cost.period_id = %s AND cost.current_period_out_cost != 0
+            ORDER BY cost.goods_id
+        ''', (period_id.id,))
+        costs = self.env.cr.fetchall()
+        if not costs:
+            return False
+
+        no_account_goods = [goods_id for goods_id, account_id, _ in costs if not account_id]
+        if no_account_goods:
+            raise UserError(u'产品 %s 的类别没有设置科目，无法生成发出成本凭证' % u', '.join(
+                self.env['goods'].browse(no_account_goods).mapped('name')))
+
+        voucher_id = self.env['voucher'].create({'period_id': period_id.id, 'is_checkout': True})
+        line_values = [(u'发出成本', account_id, 0, out_cost, goods_id)
+                       for goods_id, account_id, out_cost in costs]
+        line_values.append((u'发出成本', self.env.ref('finance.account_cost').id,
+                            sum(cost[2] for cost in costs), 0, None))
+        self.env.cr.execute('''
+            INSERT INTO voucher_line (voucher_id, name, account_id, debit, credit, goods_id,
+                date, state, create_uid, create_date, write_uid, write_date)
+            SELECT voucher.id, line.name, line.account_id, line.debit, line.credit, line.goods_id,
+                   voucher.date, voucher.state,
+                   %%s, (now() at time zone 'UTC'), %%s, (now() at time zone 'UTC')
+            FROM (VALUES %s) AS line (name, account_id, debit, credit, goods_id)
+            JOIN voucher ON voucher.id = %%s
+        ''' % ', '.join(['(%s, %s::integer, %s::numeric, %s::numeric, %s::integer)'] * len(line_values)),
+            [self.env.uid, self.env.uid] + [value for line in line_values for value in line] + [voucher_id.id])
+        voucher_id.invalidate_cache()
+        self.env.add_todo(voucher_id._fields['amount_text'], voucher_id)
+        voucher_id.recompute()
+        voucher_id.voucher_done()
+
+        return voucher_id
 
     @api.multi
     def generate_issue_cost(self, period_id):
         """
-
+        重新生成本期间的出库成本记录和对应的结账凭证
         :param period_id:
         :return:
         """
-        list_dict_data = self.get_stock_qty(period_id)
         issue_cost_exists = self.search([('period_id', '=', period_id.id)])
         issue_cost_exists.unlink()
-        self.create_month_product_cost_voucher(period_id, self.data_structure(list_dict_data, period_id))
+        self.compute_issue_cost(period_id)
+        self.create_month_product_cost_voucher(period_id)
 
 
 class CheckOutWizard(models.TransientModel):
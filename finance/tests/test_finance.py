@@ -37,6 +37,22 @@ class test_voucher(TransactionCase):
         with self.assertRaises(UserError):
             voucher.voucher_draft()
 
+    def test_approve_batch(self):
+        '''一次审核多张凭证'''
+        vouchers = self.env.ref('finance.voucher_1') + self.env.ref('finance.voucher_2')
+        message_count = len(vouchers[0].message_ids)
+        vouchers.voucher_done()
+        self.assertEqual(vouchers.mapped('state'), ['done', 'done'])
+        self.assertEqual(set(vouchers.mapped('line_ids.state')), set(['done']))
+        # 审核的状态变化仍然记录到凭证的跟踪消息中
+        self.assertGreater(len(vouchers[0].message_ids), message_count)
+        # 其中一张凭证借贷不平时整批都不审核
+        vouchers.voucher_draft()
+        vouchers[1].line_ids[0].debit += 1
+        with self.assertRaises(ValidationError):
+            vouchers.voucher_done()
+        self.assertEqual(vouchers.mapped('state'), ['draft', 'draft'])
+
     def test_line_unlink(self):
         '''测试可正常删除未审核的凭证行'''
         voucher = self.env.ref('finance.voucher_1')
@@ -95,6 +111,28 @@ class test_period(TransactionCase):
             with self.assertRaises(UserError):
                 period_obj.get_period('2100-06-20')
             
+    def test_get_periods(self):
+        '''批量取得日期对应的会计期间，期间变化之后缓存失效'''
+        period_obj = self.env['finance.period']
+        period = self.env.ref('finance.period_201601')
+        periods = period_obj.get_periods(['2016-01-01', '2016-01-31', False])
+        self.assertEqual(periods, {'2016-01-01': period, '2016-01-31': period})
+        self.assertEqual(period_obj.find_period(2016, 1), period)
+        self.assertEqual(self.env['create.trial.balance.wizard'].compute_last_period_id(period),
+                         self.env.ref('finance.period_201512'))
+        # 结账之后不能再取得该期间
+        period.is_closed = True
+        with self.assertRaises(UserError):
+            period_obj.get_periods(['2016-01-15'])
+        self.assertEqual(period_obj.with_context(module_name='checkout_wizard').get_period('2016-01-15'), period)
+        # 反结账之后立即可以取得，结账状态不在缓存中
+        period.is_closed = False
+        self.assertEqual(period_obj.get_period('2016-01-15'), period)
+        # 新建期间之后可以取到
+        if not period_obj.find_period(2100, 6):
+            new_period = period_obj.create({'year': '2100', 'month': '6'})
+            self.assertEqual(period_obj.get_period('2100-06-20'), new_period)
+
     def test_onchange_account_id(self):
         '''凭证行的科目变更影响到其他字段的可选值'''
         voucher = self.env.ref('finance.voucher_1')
@@ -148,3 +186,27 @@ class test_finance_account(TransactionCase):
                         self.cash.code + ' ' + self.cash.name)]
 
         self.assertEqual(result, real_result)
+
+    def test_account_index(self):
+        '''科目索引按编码范围、前缀和上下级查找科目'''
+        account_obj = self.env['finance.account']
+        bank = self.env.ref('finance.account_bank')
+        range_ids = account_obj.get_code_range_account_ids('1001', '1012999999')
+        self.assertEqual(list(range_ids), account_obj.search([('code', '>=', '1001'),
+                                                              ('code', '<=', '1012999999')]).ids)
+        self.assertEqual(account_obj.get_formula_account_ids('1001'), (self.cash.id,))
+        self.assertEqual(account_obj.get_formula_account_ids('1001~1012999999'), range_ids)
+        self.assertTrue(bank.id in account_obj.get_code_prefix_account_ids('1002'))
+        self.assertEqual(account_obj.get_account_direction(bank.id), 'in')
+        self.assertEqual(account_obj.get_smallest_code_account(), account_obj.search([], order='code', limit=1))
+        # 新增下级科目之后索引失效
+        child = account_obj.create({'code': '1001001', 'name': u'库存现金-测试',
+                                    'costs_types': 'assets', 'balance_directions': 'in'})
+        self.assertEqual(account_obj.get_parent_account_id(child.id), self.cash.id)
+        self.assertEqual(account_obj.get_child_account_ids(self.cash.id), (child.id,))
+        child.name = u'库存现金-修改'
+        self.assertEqual(child.name_get()[0][1], u'1001001 库存现金-修改')
+        # 按名称和编码前缀查找，结果经过search
+        self.assertEqual(account_obj.name_search(u'库存现金-修改'), [(child.id, u'1001001 库存现金-修改')])
+        self.assertEqual([account_id for account_id, _ in account_obj.name_search('1001')],
+                         account_obj.search([('code', '=like', '1001%')]).ids)
@@ -106,6 +106,40 @@ class test_report(TransactionCase):
         wizard.get_current_occurrence_amount(self.period_201512, self.env.ref('finance.account_bank'))
 
 
+    def test_ledger_engine(self):
+        '''明细账引擎批量计算的逐笔余额和合计与逐个科目计算的结果一致'''
+        month_end = self.env['checkout.wizard'].create({'date': '2015-12-31'})
+        month_end.onchange_period_id()
+        month_end.button_checkout()
+        bank = self.env.ref('finance.account_bank')
+        wizard = self.env['create.vouchers.summary.wizard'].create(
+            {'period_begin_id': self.period_201512.id,
+             'period_end_id': self.period_id,
+             'subject_name_id': bank.id,
+             'subject_name_end_id': bank.id,
+             })
+        rows = list(wizard._iter_ledger_rows())
+        line_rows = [row for row in rows if row.get('voucher_id') and row['period_id'] == self.period_201512.id]
+        expected = wizard.get_current_occurrence_amount(self.period_201512, bank)
+        self.assertEqual([(row['voucher_id'], row['direction']) for row in line_rows],
+                         [(row['voucher_id'], row['direction']) for row in expected])
+        for row, expected_row in zip(line_rows, expected):
+            self.assertAlmostEqual(row['balance'], expected_row['balance'])
+
+        # 已结账期间的本期合计和本年累计取自科目余额表
+        period_total, year_total = wizard.get_year_balance(self.period_201512, bank)
+        self.assertEqual([row for row in rows if row['summary'] == period_total['summary']
+                          and row['period_id'] == self.period_201512.id][0]['debit'], period_total['debit'])
+        self.assertEqual([row for row in rows if row['summary'] == year_total['summary']
+                          and row['period_id'] == self.period_201512.id][0]['credit'], year_total['credit'])
+
+        # 总账每个期间一条期初余额，没有凭证行
+        general_rows = list(wizard._iter_ledger_rows(detail=False))
+        self.assertEqual(len(general_rows), 3 * len(wizard._get_ledger_periods()))
+        self.assertFalse([row for row in general_rows if row.get('voucher_id')])
+        summary_ids = wizard.create_vouchers_summary()['domain'][0][2]
+        self.assertEqual(len(summary_ids), len(rows))
+
     def test_view_detail_voucher(self):
         '''在明细账上查看凭证明细按钮'''
         report = self.env['create.vouchers.summary.wizard'].create(
@@ -170,6 +204,38 @@ class test_report(TransactionCase):
             balance_sheet_obj.cumulative_occurrence_balance_formula = ''
         report.create_profit_statement()
 
+    def test_balance_sheet_formula(self):
+        ''' 测试报表模板科目范围的解析缓存和按期间一次取出的余额 '''
+        account_obj = self.env['finance.account']
+        cash = self.env.ref('finance.account_cash')
+        bank = self.env.ref('finance.account_bank')
+        self.assertEqual(account_obj.get_formula_account_ids('1001'), (cash.id,))
+        self.assertTrue(bank.id in account_obj.get_formula_account_ids('1001~1012999999'))
+        # 修改科目编码之后缓存失效
+        cash.code = '1001999'
+        self.assertEqual(account_obj.get_formula_account_ids('1001'), ())
+        self.assertTrue(cash.id in account_obj.get_formula_account_ids('1001~1012999999'))
+        cash.code = '1001'
+
+        month_end = self.env['checkout.wizard'].create({'date': '2015-12-31'})
+        month_end.onchange_period_id()
+        month_end.button_checkout()
+        report = self.env['create.balance.sheet.wizard'].create({'period_id': self.period_201512.id})
+        report.create_balance_sheet()
+        field_list = ['ending_balance_debit', 'ending_balance_credit']
+        trial_balances = self.env['trial.balance'].search([
+            ('period_id', '=', self.period_201512.id),
+            ('subject_name_id.code', '>=', '1001'),
+            ('subject_name_id.code', '<=', '1012999999')])
+        self.assertAlmostEqual(
+            report.compute_balance('1001~1012999999', self.period_201512, field_list),
+            sum(trial_balances.mapped('ending_balance_debit')) - sum(trial_balances.mapped('ending_balance_credit')))
+        # 已结账的期间不再重新生成科目余额表
+        trial_balance_ids = self.env['trial.balance'].search([('period_id', '=', self.period_201512.id)]).ids
+        report.create_balance_sheet()
+        self.assertEqual(self.env['trial.balance'].search([('period_id', '=', self.period_201512.id)]).ids,
+                         trial_balance_ids)
+
 
 class test_checkout_wizard(TransactionCase):
     
@@ -242,6 +308,38 @@ class test_checkout_wizard(TransactionCase):
         with self.assertRaises(UserError):
             wizard.button_checkout()
 
+    def test_checkout_totals(self):
+        '''结账时按科目汇总的发生额和未审核凭证数量'''
+        checkout_obj = self.env['checkout.wizard']
+        vouchers = self.env['voucher'].search([('period_id', '=', self.period_15_12.id)])
+        self.assertEqual(checkout_obj.count_undone_voucher(self.period_15_12),
+                         len(vouchers.filtered(lambda voucher: voucher.state != 'done')))
+
+        totals = checkout_obj.get_profit_account_totals(self.period_15_12)
+        self.assertEqual([row[1] for row in totals], sorted(row[1] for row in totals))
+        for account_id, costs_types, debit, credit in totals:
+            lines = self.env['voucher.line'].search([('account_id', '=', account_id),
+                                                     ('voucher_id.period_id', '=', self.period_15_12.id)])
+            self.assertTrue(costs_types in ('in', 'out'))
+            self.assertAlmostEqual(debit, sum(lines.mapped('debit')))
+            self.assertAlmostEqual(credit, sum(lines.mapped('credit')))
+
+    def test_renumber_vouchers(self):
+        '''批量重排凭证号'''
+        checkout_obj = self.env['checkout.wizard']
+        vouchers = self.env['voucher'].search([('period_id', '=', self.period_15_12.id)], order='create_date, id')
+        next_number = checkout_obj.renumber_vouchers(self.period_15_12, 1, 'T', '', 4)
+        self.assertEqual(next_number, len(vouchers) + 1)
+        self.assertEqual(vouchers.mapped('name'), ['T%04d' % (i + 1) for i in range(len(vouchers))])
+        changes = self.env['chang.voucher.name'].search([('period_id', '=', self.period_15_12.id)])
+        self.assertEqual(sorted(changes.mapped('after_voucher_name')), vouchers.mapped('name'))
+
+        # 凭证号没有变化时不再记录
+        checkout_obj.renumber_vouchers(self.period_15_12, 1, 'T', '', 4)
+        self.assertEqual(self.env['chang.voucher.name'].search_count([('period_id', '=', self.period_15_12.id)]),
+                         len(changes))
+        self.assertEqual(checkout_obj.get_last_voucher_number(self.env.ref('finance.period_201601')), 0)
+
     def test_recreate_voucher_name(self):
         '''按用户设置重排结账会计期间凭证号（会计要求凭证号必须连续）'''
         # FIXME: 没有成功
@@ -254,4 +352,39 @@ class test_checkout_wizard(TransactionCase):
         self.checkout_voucher.voucher_done()
         wizard.button_checkout()
 
-    
\ No newline at end of file
+    
+
+
+class test_month_product_cost(TransactionCase):
+
+    def setUp(self):
+        super(test_month_product_cost, self).setUp()
+        # 审核2016年2月的入库单和盘点单，生成本期的出入库
+        self.env.ref('core.goods_category_1').account_id = self.env.ref('finance.account_goods').id
+        for xml_id in ('warehouse.wh_in_whin0', 'warehouse.wh_in_whin1', 'warehouse.wh_in_whin3',
+                       'warehouse.wh_in_wh_in_attribute'):
+            self.env.ref(xml_id).date = '2016-02-06'
+        self.env['wh.in'].search([('name', '!=', 'WH/IN/16040004')]).approve_order()
+        self.env.ref('warehouse.wh_in_whin0').approve_order()
+
+    def test_month_product_cost(self):
+        ''' 按期间批量生成出库成本记录 '''
+        cost_obj = self.env['month.product.cost']
+        period = self.env['finance.period'].get_period('2016-02-06')
+        date_start, date_end = self.env['finance.period'].get_period_month_date_range(period)
+        self.assertEqual(cost_obj.compute_issue_cost(period), len(cost_obj.search([('period_id', '=', period.id)])))
+
+        lines = self.env['wh.move.line'].search([('state', '=', 'done'),
+                                                 ('date', '>=', date_start), ('date', '<=', date_end)])
+        lines = lines.filtered(lambda line: (line.warehouse_id.type == 'stock') != (line.warehouse_dest_id.type == 'stock'))
+        for cost in cost_obj.search([('period_id', '=', period.id)]):
+            goods_lines = lines.filtered(lambda line: line.goods_id == cost.goods_id)
+            in_lines = goods_lines.filtered(lambda line: line.type == 'in')
+            self.assertAlmostEqual(cost.current_period_in_qty, sum(in_lines.mapped('goods_qty')))
+            self.assertAlmostEqual(cost.current_period_out_qty, sum((goods_lines - in_lines).mapped('goods_qty')))
+            self.assertAlmostEqual(cost.current_period_remaining_qty,
+                                   cost.period_begin_qty + cost.current_period_in_qty - cost.current_period_out_qty)
+            if cost.period_begin_qty + cost.current_period_in_qty:
+                self.assertAlmostEqual(cost.current_period_out_cost,
+                                       (cost.period_begin_cost + cost.current_period_in_cost) /
+                                       (cost.period_begin_qty + cost.current_period_in_qty) * cost.current_period_out_qty)
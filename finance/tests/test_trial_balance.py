@@ -70,6 +70,35 @@ class test_trial_balance(TransactionCase):
         with self.assertRaises(UserError):
             self.trial_balance_wizard_period_last_year.create_trial_balance()
 
+    def test_trial_balance_amount(self):
+        '''科目余额表的期初、本期发生额和期末余额'''
+        self.trial_balance_wizard_last.create_trial_balance()
+        self.period_last.is_closed = True
+        action = self.trial_balance_wizard_now.create_trial_balance()
+
+        balances = self.env['trial.balance'].search(action.get('domain'))
+        self.assertEqual(balances, self.env['trial.balance'].search([('period_id', '=', self.period_now.id)]))
+        last_balances = {balance.subject_name_id: balance for balance in
+                         self.env['trial.balance'].search([('period_id', '=', self.period_last.id)])}
+        for balance in balances:
+            lines = self.env['voucher.line'].search([('voucher_id.period_id', '=', self.period_now.id),
+                                                     ('account_id', '=', balance.subject_name_id.id)])
+            self.assertAlmostEqual(balance.current_occurrence_debit, sum(lines.mapped('debit')))
+            self.assertAlmostEqual(balance.current_occurrence_credit, sum(lines.mapped('credit')))
+
+            last = last_balances.get(balance.subject_name_id)
+            if not last:
+                continue
+            # 期初等于上期期末，期末余额借贷相抵
+            self.assertEqual(balance.subject_code, last.subject_code)
+            self.assertAlmostEqual(balance.initial_balance_debit, last.ending_balance_debit)
+            self.assertAlmostEqual(balance.initial_balance_credit, last.ending_balance_credit)
+            self.assertAlmostEqual(balance.ending_balance_debit - balance.ending_balance_credit,
+                                   balance.initial_balance_debit - balance.initial_balance_credit +
+                                   balance.current_occurrence_debit - balance.current_occurrence_credit)
+            self.assertAlmostEqual(balance.cumulative_occurrence_debit,
+                                   last.cumulative_occurrence_debit + balance.current_occurrence_debit)
+
     def test_create_vouchers_summary(self):
         """测试创建明细帐"""
         self.period_2016__01_03.create_vouchers_summary()
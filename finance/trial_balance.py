@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from odoo import models, fields, api
+from odoo.addons.core.core import insert_rows
 from odoo.exceptions import UserError
 from math import fabs
 
@@ -46,7 +47,7 @@ class CreateTrialBalanceWizard(models.TransientModel):
         else:
             year = period_id.year
             month = int(period_id.month) - 1
-        return self.env['finance.period'].search([('year', '=', str(year)), ('month', '=', str(month))])
+        return self.env['finance.period'].find_period(year, month)
 
     @api.multi
     def compute_next_period_id(self, period_id):
@@ -57,7 +58,7 @@ class CreateTrialBalanceWizard(models.TransientModel):
         else:
             year = period_id.year
             month = int(period_id.month) + 1
-        return self.env['finance.period'].search([('year', '=', str(year)), ('month', '=', str(month))])
+        return self.env['finance.period'].find_period(year, month)
 
     @api.multi
     def get_period_balance(self, period_id):
@@ -90,78 +91,83 @@ class CreateTrialBalanceWizard(models.TransientModel):
                     raise UserError(u'前一期间未结账，无法取到期初余额')
             else:
                 last_period_id = False
-            period_id = self.period_id.id
-            current_occurrence_dic_list = self.get_period_balance(period_id)
-            trial_balance_dict = {}
-            """把本期发生额的数量填写到  准备好的dict 中 """
-            for current_occurrence in current_occurrence_dic_list:
-                account = self.env['finance.account'].browse(current_occurrence.get('account_id'))
-                ending_balance_debit = ending_balance_credit = 0
-                this_debit = current_occurrence.get('debit', 0) or 0
-                this_credit = current_occurrence.get('credit', 0) or 0
-                if account.balance_directions == 'in':
-                    ending_balance_debit = this_debit - this_credit
-                else:
-                    ending_balance_credit = this_credit - this_debit
-
-                account_dict = {'period_id': period_id, 
-                                'current_occurrence_debit': this_debit,
-                                'current_occurrence_credit': this_credit, 
-                                'subject_code': account.code,
-                                'initial_balance_credit': 0,
-                                'initial_balance_debit': 0,
-                                'ending_balance_debit': ending_balance_debit,
-                                'ending_balance_credit': ending_balance_credit,
-                                'cumulative_occurrence_debit': this_debit,
-                                'cumulative_occurrence_credit': this_credit, 
-                                'subject_name_id': account.id}
-                trial_balance_dict[account.id] = account_dict
-
-            """ 结合上一期间的 数据 填写  trial_balance_dict(余额表 记录生成dict)   """
-            for trial_balance in self.env['trial.balance'].search([('period_id', '=', last_period_id)]):
-                initial_balance_credit = trial_balance.ending_balance_credit or 0
-                initial_balance_debit = trial_balance.ending_balance_debit or 0
-                ending_balance_debit = ending_balance_credit = 0
-                this_debit = this_credit = 0
-                cumulative_occurrence_credit = cumulative_occurrence_debit = 0
-                subject_name_id = trial_balance.subject_name_id.id
-
-                if subject_name_id in trial_balance_dict:               # 本月有发生额
-                    this_debit = trial_balance_dict[subject_name_id].get('current_occurrence_debit', 0) or 0
-                    this_credit = trial_balance_dict[subject_name_id].get('current_occurrence_credit', 0) or 0
-                    # if trial_balance.subject_name_id.balance_directions == 'in':
-                    #     ending_balance_debit = initial_balance_debit + this_debit - this_credit
-                    # else:
-                    #     ending_balance_credit = initial_balance_credit + this_credit - this_debit
-                    ending_balance_debit = initial_balance_debit + this_debit - initial_balance_credit - this_credit
-                    if ending_balance_debit < 0:
-                        ending_balance_credit -= ending_balance_debit
-                        ending_balance_debit = 0
-                else:
-                    ending_balance_credit = initial_balance_credit
-                    ending_balance_debit = initial_balance_debit
-
-                if self.period_id.year == last_period.year:
-                    cumulative_occurrence_credit = this_credit + trial_balance.cumulative_occurrence_credit
-                    cumulative_occurrence_debit = this_debit + trial_balance.cumulative_occurrence_debit
-                else:
-                    cumulative_occurrence_credit = this_credit
-                    cumulative_occurrence_debit = this_debit
-                subject_code = trial_balance.subject_code
-                trial_balance_dict[subject_name_id] = {
-                    'initial_balance_credit': initial_balance_credit,
-                    'initial_balance_debit': initial_balance_debit,
-                    'ending_balance_credit': ending_balance_credit,
-                    'ending_balance_debit': ending_balance_debit,
-                    'current_occurrence_debit': this_debit,
-                    'current_occurrence_credit': this_credit, 
-                    'cumulative_occurrence_credit': cumulative_occurrence_credit,
-                    'cumulative_occurrence_debit': cumulative_occurrence_debit,
-                    'subject_code': subject_code,
-                    'period_id': period_id,
-                    'subject_name_id': subject_name_id
-                }
-            trial_balance_ids = [self.env['trial.balance'].create(vals).id for (key, vals) in trial_balance_dict.items()]
+            # 本期发生额和上一期间的科目余额表在一条SQL中合并计算，并直接批量插入
+            self.env.cr.execute('''
+                WITH current_occurrence AS (
+                    SELECT vol.account_id, sum(vol.debit) AS debit, sum(vol.credit) AS credit,
+                           TRUE AS found
+                    FROM voucher AS vo
+                    LEFT JOIN voucher_line AS vol ON vo.id = vol.voucher_id
+                    WHERE vo.period_id = %(period_id)s
+                    GROUP BY vol.account_id
+                ), last_balance AS (
+                    SELECT subject_name_id AS account_id, subject_code,
+                           COALESCE(ending_balance_debit, 0) AS debit,
+                           COALESCE(ending_balance_credit, 0) AS credit,
+                           COALESCE(cumulative_occurrence_debit, 0) AS cumulative_debit,
+                           COALESCE(cumulative_occurrence_credit, 0) AS cumulative_credit,
+                           TRUE AS found
+                    FROM trial_balance
+                    WHERE period_id = %(last_period_id)s
+                ), balance AS (
+                    SELECT COALESCE(last.account_id, cur.account_id) AS account_id,
+                           last.found IS NOT NULL AS has_last,
+                           cur.found IS NOT NULL AS has_current,
+                           last.subject_code,
+                           COALESCE(last.debit, 0) AS initial_debit,
+                           COALESCE(last.credit, 0) AS initial_credit,
+                           COALESCE(cur.debit, 0) AS debit,
+                           COALESCE(cur.credit, 0) AS credit,
+                           COALESCE(last.cumulative_debit, 0) AS cumulative_debit,
+                           COALESCE(last.cumulative_credit, 0) AS cumulative_credit
+                    FROM current_occurrence AS cur
+                    FULL JOIN last_balance AS last ON cur.account_id = last.account_id
+                )
+                INSERT INTO trial_balance (period_id, subject_code, subject_name_id,
+                    initial_balance_debit, initial_balance_credit,
+                    current_occurrence_debit, current_occurrence_credit,
+                    ending_balance_debit, ending_balance_credit,
+                    cumulative_occurrence_debit, cumulative_occurrence_credit,
+                    create_uid, create_date, write_uid, write_date)
+                SELECT %(period_id)s,
+                       CASE WHEN balance.has_last THEN balance.subject_code ELSE account.code END,
+                       balance.account_id,
+                       balance.initial_debit,
+                       balance.initial_credit,
+                       balance.debit,
+                       balance.credit,
+                       -- 上期没有余额的按科目方向计算期末余额，否则借贷相抵之后放在余额所在的方向
+                       CASE WHEN NOT balance.has_last THEN
+                                CASE WHEN account.balance_directions = 'in'
+                                     THEN balance.debit - balance.credit ELSE 0 END
+                            WHEN NOT balance.has_current THEN balance.initial_debit
+                            ELSE GREATEST(balance.initial_debit + balance.debit
+                                          - balance.initial_credit - balance.credit, 0)
+                       END,
+                       CASE WHEN NOT balance.has_last THEN
+                                CASE WHEN account.balance_directions = 'in'
+                                     THEN 0 ELSE balance.credit - balance.debit END
+                            WHEN NOT balance.has_current THEN balance.initial_credit
+                            ELSE GREATEST(balance.initial_credit + balance.credit
+                                          - balance.initial_debit - balance.debit, 0)
+                       END,
+                       -- 跨年度时本年累计发生额重新开始计算
+                       balance.debit + CASE WHEN balance.has_last AND %(same_year)s
+                                            THEN balance.cumulative_debit ELSE 0 END,
+                       balance.credit + CASE WHEN balance.has_last AND %(same_year)s
+                                             THEN balance.cumulative_credit ELSE 0 END,
+                       %(uid)s, (now() at time zone 'UTC'), %(uid)s, (now() at time zone 'UTC')
+                FROM balance
+                LEFT JOIN finance_account AS account ON balance.account_id = account.id
+                RETURNING id
+            ''', {
+                'period_id': self.period_id.id,
+                'last_period_id': last_period_id or None,
+                'same_year': bool(last_period) and self.period_id.year == last_period.year,
+                'uid': self.env.uid,
+            })
+            trial_balance_ids = [row[0] for row in self.env.cr.fetchall()]
+            self.env['trial.balance'].invalidate_cache()
         view_id = self.env.ref('finance.trial_balance_tree').id
         return {
             'type': 'ir.actions.act_window',
@@ -385,6 +391,134 @@ class CreateVouchersSummaryWizard(models.TransientModel):
         })
         return [current_occurrence, initial_balance_new]
 
+    @api.multi
+    def _get_ledger_periods(self):
+        """ 按年、月的顺序返回开始期间到结束期间之间的所有期间 """
+        def period_key(period):
+            return (int(period.year), int(period.month))
+
+        begin_key, end_key = period_key(self.period_begin_id), period_key(self.period_end_id)
+        periods = self.env['finance.period'].search([('year', '>=', self.period_begin_id.year),
+                                                     ('year', '<=', self.period_end_id.year)])
+        return sorted([period for period in periods if begin_key <= period_key(period) <= end_key],
+                      key=period_key)
+
+    @api.multi
+    def _iter_ledger_rows(self, detail=True):
+        """
+        明细账和总账的引擎：科目范围内所有科目的科目余额表、各期间的发生额和凭证行各用一条SQL取出，
+        凭证行的逐笔余额用窗口函数在数据库中累计，然后按科目、期间的顺序逐行返回账簿记录
+        detail为True时返回明细账(只有第一个期间有期初余额，包括凭证行)，否则返回总账(每个期间都有期初余额)
+        """
+        last_period = self.env['create.trial.balance.wizard'].compute_last_period_id(self.period_begin_id)
+        periods = self._get_ledger_periods()
+        account_obj = self.env['finance.account']
+        accounts = account_obj.browse(account_obj.get_code_range_account_ids(
+            self.subject_name_id.code, self.subject_name_end_id.code))
+        if not periods or not accounts:
+            return
+
+        cr = self.env.cr
+        account_ids = tuple(accounts.ids)
+        period_ids = tuple(period.id for period in periods)
+
+        # 科目余额表：上一期间的期末余额作为期初余额，已结账期间的本期合计和本年累计直接取用
+        cr.execute("""
+            SELECT period_id, subject_name_id,
+                   COALESCE(current_occurrence_debit, 0), COALESCE(current_occurrence_credit, 0),
+                   COALESCE(ending_balance_debit, 0), COALESCE(ending_balance_credit, 0),
+                   COALESCE(cumulative_occurrence_debit, 0), COALESCE(cumulative_occurrence_credit, 0)
+            FROM trial_balance
+            WHERE period_id IN %s AND subject_name_id IN %s
+        """, (period_ids + (last_period.id or 0,), account_ids))
+        trial_balances = dict(((row[0], row[1]), row[2:]) for row in cr.fetchall())
+
+        # 各期间的发生额，包括开始期间之前的本年期间，用来计算未结账期间的本年累计
+        year_periods = self.env['finance.period'].search([('year', 'in', list(set(period.year for period in periods)))])
+        cr.execute("""
+            SELECT vo.period_id, vol.account_id,
+                   sum(COALESCE(vol.debit, 0)), sum(COALESCE(vol.credit, 0))
+            FROM voucher AS vo
+            JOIN voucher_line AS vol ON vo.id = vol.voucher_id
+            WHERE vo.period_id IN %s AND vol.account_id IN %s
+            GROUP BY vo.period_id, vol.account_id
+        """, (tuple(year_periods.ids), account_ids))
+        occurrences = dict(((row[0], row[1]), row[2:]) for row in cr.fetchall())
+
+        lines = {}
+        if detail:
+            cr.execute("""
+                SELECT vol.account_id, vo.period_id, vo.date, vo.id AS voucher_id,
+                       vol.name AS summary,
+                       COALESCE(vol.debit, 0) AS debit, COALESCE(vol.credit, 0) AS credit,
+                       sum(COALESCE(vol.debit, 0) - COALESCE(vol.credit, 0)) OVER (
+                           PARTITION BY vol.account_id, vo.period_id
+                           ORDER BY vo.name, vol.id) AS balance
+                FROM voucher AS vo
+                JOIN voucher_line AS vol ON vo.id = vol.voucher_id
+                WHERE vo.period_id IN %s AND vol.account_id IN %s
+                ORDER BY vol.account_id, vo.period_id, vo.name, vol.id
+            """, (period_ids, account_ids))
+            for line in cr.dictfetchall():
+                lines.setdefault((line.pop('account_id'), line['period_id']), []).append(line)
+
+        for account in accounts:
+            account_name = account.code + ' ' + account.name + u":"
+            previous_period = last_period
+            year_debit = year_credit = 0
+            for index, period in enumerate(periods):
+                # 本期期初余额，借方为正，贷方为负
+                previous_balance = trial_balances.get((previous_period.id, account.id))
+                initial_balance = previous_balance and previous_balance[2] - previous_balance[3] or 0
+                if not detail or index == 0:
+                    direction, balance = self.judgment_lending(initial_balance, 0, 0)
+                    yield {'date': False,
+                           'period_id': period.id,
+                           'direction': direction,
+                           'balance': fabs(balance),
+                           'summary': account_name + u'期初余额'}
+
+                for line in lines.get((account.id, period.id), []):
+                    direction, balance = self.judgment_lending(initial_balance + line['balance'], 0, 0)
+                    yield dict(line, direction=direction, balance=fabs(balance))
+
+                if period.is_closed:
+                    current_debit, current_credit, ending_debit, ending_credit, year_debit, year_credit = \
+                        trial_balances.get((period.id, account.id), (0, 0, 0, 0, 0, 0))
+                    direction, balance = self.judgment_lending(0, ending_credit, ending_debit)
+                else:
+                    current_debit, current_credit = occurrences.get((period.id, account.id), (0, 0))
+                    year_debit = year_credit = 0
+                    for year_period in year_periods:
+                        if year_period.year == period.year and int(year_period.month) <= int(period.month):
+                            debit, credit = occurrences.get((year_period.id, account.id), (0, 0))
+                            year_debit += debit
+                            year_credit += credit
+                    direction, balance = self.judgment_lending(initial_balance, current_credit, current_debit)
+
+                yield {'date': False,
+                       'period_id': period.id,
+                       'direction': direction,
+                       'balance': fabs(balance),
+                       'debit': current_debit,
+                       'credit': current_credit,
+                       'summary': account_name + u'本期合计'}
+                yield {'date': False,
+                       'period_id': period.id,
+                       'direction': direction,
+                       'balance': fabs(balance),
+                       'debit': year_debit,
+                       'credit': year_credit,
+                       'summary': account_name + u'本年累计'}
+                previous_period = period
+
+    @api.model
+    def _insert_ledger_rows(self, model_name, rows, columns):
+        """ 把账簿记录批量INSERT写入账簿的临时表，不再逐行create，返回新记录的id """
+        return insert_rows(self.env, self.env[model_name]._table, columns,
+                           ([None if row.get(column) is False else row.get(column) for column in columns]
+                            for row in rows))
+
     @api.multi
     def create_vouchers_summary(self):
         """创建出根据所选期间范围内的 明细帐记录"""
@@ -392,35 +526,9 @@ class CreateVouchersSummaryWizard(models.TransientModel):
         if last_period:
             if not last_period.is_closed:
                 raise UserError(u'前一期间未结账，无法取到期初余额')
-        # period_end = self.env['create.trial.balance.wizard'].compute_next_period_id(self.period_end_id)
-        vouchers_summary_ids = []
-        subject_ids = self.env['finance.account'].search([('code', '>=', self.subject_name_id.code), ('code', '<=', self.subject_name_end_id.code)])
-        for account_line in subject_ids:
-            local_last_period = last_period
-            local_currcy_period = self.period_begin_id
-            break_flag = True
-            init = 1
-            while break_flag:
-                create_vals = []
-                initial_balance = self.get_initial_balance(local_last_period, local_currcy_period, account_line.id) # 取上期间期初余额
-                if init:
-                    create_vals.append(initial_balance)
-                    init = 0
-                occurrence_amount = self.get_current_occurrence_amount(local_currcy_period, account_line)
-                create_vals += occurrence_amount
-                if local_currcy_period.is_closed:
-                    cumulative_year_occurrence = self.get_year_balance(local_currcy_period, account_line)
-                else:
-                    cumulative_year_occurrence = self.get_unclose_year_balance(initial_balance.copy(), local_currcy_period, account_line)
-                create_vals += cumulative_year_occurrence
-                if local_currcy_period.id == self.period_end_id.id:
-                    break_flag = False
-                local_last_period = local_currcy_period
-                local_currcy_period = self.env['create.trial.balance.wizard'].compute_next_period_id(local_currcy_period)
-                if not local_currcy_period:  # 无下一期间，退出循环。
-                    break_flag = False
-                for vals in create_vals:
-                    vouchers_summary_ids.append((self.env['vouchers.summary'].create(vals)).id)
+        vouchers_summary_ids = self._insert_ledger_rows(
+            'vouchers.summary', self._iter_ledger_rows(),
+            ['date', 'period_id', 'voucher_id', 'summary', 'direction', 'debit', 'credit', 'balance'])
         view_id = self.env.ref('finance.vouchers_summary_tree').id
         return {
             'type': 'ir.actions.act_window',
@@ -441,34 +549,9 @@ class CreateVouchersSummaryWizard(models.TransientModel):
         last_period = self.env['create.trial.balance.wizard'].compute_last_period_id(self.period_begin_id)
         if last_period and not last_period.is_closed:
             raise UserError(u'前一期间未结账，无法取到期初余额')
-        # period_end = self.env['create.trial.balance.wizard'].compute_next_period_id(self.period_end_id)
-        vouchers_summary_ids = []
-        subject_ids = self.env['finance.account'].search([('code', '>=', self.subject_name_id.code), ('code', '<=', self.subject_name_end_id.code)])
-        for account_line in subject_ids:
-            local_last_period = last_period
-            local_currcy_period = self.period_begin_id
-            break_flag = True
-            while break_flag:
-                create_vals = []
-                initial_balance = self.get_initial_balance(local_last_period, local_currcy_period, account_line.id)
-                create_vals.append(initial_balance)
-                if local_currcy_period.is_closed:
-                    cumulative_year_occurrence = self.get_year_balance(local_currcy_period, account_line)
-                else:
-                    cumulative_year_occurrence = self.get_unclose_year_balance(initial_balance.copy(), local_currcy_period, account_line)
-                create_vals += cumulative_year_occurrence
-                if local_currcy_period.id == self.period_end_id.id:
-                    break_flag = False
-                local_last_period = local_currcy_period
-                local_currcy_period = self.env['create.trial.balance.wizard'].compute_next_period_id(local_currcy_period)
-                if not local_currcy_period:  # 无下一期间，退出循环。
-                    break_flag = False
-                for vals in create_vals:
-                    del vals['date']
-                    if vals.get('voucher_id'):
-                        del vals['date']
-                    vouchers_summary_ids.append((self.env['general.ledger.account'].create(vals)).id)
-
+        vouchers_summary_ids = self._insert_ledger_rows(
+            'general.ledger.account', self._iter_ledger_rows(detail=False),
+            ['period_id', 'summary', 'direction', 'debit', 'credit', 'balance'])
         view_id = self.env.ref('finance.general_ledger_account_tree').id
         return {
             'type': 'ir.actions.act_window',
@@ -28,54 +28,36 @@ class checkout_wizard(models.TransientModel):
                 raise UserError(u'本期间已结账')
             else:
                 voucher_obj = self.env['voucher']
-                voucher_ids = voucher_obj.search([('period_id', '=', self.period_id.id)])
-                i = 0
-                for voucher_id in voucher_ids:
-                    if voucher_id.state != 'done':
-                        i += 1
+                i = self.count_undone_voucher(self.period_id)
                 if i != 0:
                     raise UserError(u'该期间有%s张凭证未审核' % i)
                 else:
                     voucher_line = []  # 生成的结账凭证行
-                    account_obj = self.env['finance.account']
+                    checkout_vouchers = voucher_obj.browse()  # 生成的结转凭证
                     company_obj = self.env['res.company']
-                    voucher_line_obj = self.env['voucher.line']
-                    revenue_account_ids = account_obj.search([('costs_types', '=', 'in')])  # 收入类科目
-                    expense_account_ids = account_obj.search([('costs_types', '=', 'out')])  # 费用类科目
                     revenue_total = 0  # 收入类科目合计
                     expense_total = 0  # 费用类科目合计
-                    for revenue_account_id in revenue_account_ids:
-                        voucher_line_ids = voucher_line_obj.search([
-                            ('account_id', '=', revenue_account_id.id),
-                            ('voucher_id.period_id', '=', self.period_id.id)])
-                        credit_total = 0
-                        for voucher_line_id in voucher_line_ids:
-                            credit_total += voucher_line_id.credit
-                        revenue_total += credit_total
-                        if credit_total != 0:
-                            res = {
-                                'name': u'月末结账',
-                                'account_id': revenue_account_id.id,
-                                'debit': credit_total,
-                                'credit': 0,
-                            }
-                            voucher_line.append(res)
-                    for expense_account_id in expense_account_ids:
-                        voucher_line_ids = voucher_line_obj.search([
-                            ('account_id', '=', expense_account_id.id),
-                            ('voucher_id.period_id', '=', self.period_id.id)])
-                        debit_total = 0
-                        for voucher_line_id in voucher_line_ids:
-                            debit_total += voucher_line_id.debit
-                        expense_total += debit_total
-                        if debit_total != 0:
-                            res = {
-                                'name': u'月末结账',
-                                'account_id': expense_account_id.id,
-                                'debit': 0,
-                                'credit': debit_total,
-                            }
-                            voucher_line.append(res)
+                    # 收入类科目结转贷方发生额，费用类科目结转借方发生额，所有科目的发生额在一次查询中汇总
+                    for account_id, costs_types, debit_total, credit_total in \
+                            self.get_profit_account_totals(self.period_id):
+                        if costs_types == 'in':
+                            revenue_total += credit_total
+                            if credit_total != 0:
+                                voucher_line.append({
+                                    'name': u'月末结账',
+                                    'account_id': account_id,
+                                    'debit': credit_total,
+                                    'credit': 0,
+                                })
+                        else:
+                            expense_total += debit_total
+                            if debit_total != 0:
+                                voucher_line.append({
+                                    'name': u'月末结账',
+                                    'account_id': account_id,
+                                    'debit': 0,
+                                    'credit': debit_total,
+                                })
                     # 利润结余
                     year_profit_account = company_obj.search([])[0].profit_account
                     remain_account = company_obj.search([])[0].remain_account
@@ -107,16 +89,16 @@ class checkout_wizard(models.TransientModel):
                             'line_ids': [
                                 (0, 0, line) for line in voucher_line],
                         }
-                        voucher = voucher_obj.create(valus)
-                        voucher.voucher_done()
+                        checkout_vouchers += voucher_obj.create(valus)
                 year_account = None
                 if self.period_id.month == '12':
-                    year_profit_ids = voucher_line_obj.search([
-                        ('account_id', '=', year_profit_account.id),
-                        ('voucher_id.period_id', '=', self.period_id.id)])
-                    year_total = 0
-                    for year_profit_id in year_profit_ids:
-                        year_total += (year_profit_id.credit - year_profit_id.debit)
+                    self.env.cr.execute('''
+                        SELECT COALESCE(sum(vol.credit - vol.debit), 0)
+                        FROM voucher_line vol
+                        JOIN voucher vo ON vol.voucher_id = vo.id
+                        WHERE vol.account_id = %s AND vo.period_id = %s
+                    ''', (year_profit_account.id, self.period_id.id))
+                    year_total = self.env.cr.fetchone()[0]
                     precision = self.env['decimal.precision'].precision_get('Account')
                     year_total = round(year_total, precision)
                     if year_total != 0:
@@ -137,7 +119,9 @@ class checkout_wizard(models.TransientModel):
                                      (0, 0, line) for line in year_line_ids],
                                  }
                         year_account = voucher_obj.create(value)  # 创建结转凭证
-                        year_account.voucher_done()  # 凭证审核
+                        checkout_vouchers += year_account
+                # 结转凭证一次审核
+                checkout_vouchers.voucher_done()
                 # 生成科目余额表
                 trial_wizard = self.env['create.trial.balance.wizard'].create({
                     'period_id': self.period_id.id,
@@ -174,6 +158,34 @@ class checkout_wizard(models.TransientModel):
                         'limit': 65535,
                     }
 
+    @api.model
+    def count_undone_voucher(self, period):
+        ''' 返回会计期间内未审核的凭证数量 '''
+        self.env.cr.execute('''
+            SELECT count(*) FROM voucher
+            WHERE period_id = %s AND state IS DISTINCT FROM 'done'
+        ''', (period.id,))
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def get_profit_account_totals(self, period):
+        '''
+        按科目汇总会计期间内收入类和费用类科目的借贷方发生额，
+        返回[(科目id, 科目类型, 借方合计, 贷方合计)]，收入类科目在前，同类科目按科目编码排序
+        '''
+        self.env.cr.execute('''
+            SELECT account.id, account.costs_types,
+                   COALESCE(sum(vol.debit), 0), COALESCE(sum(vol.credit), 0)
+            FROM voucher_line vol
+            JOIN voucher vo ON vol.voucher_id = vo.id
+            JOIN finance_account account ON vol.account_id = account.id
+            WHERE vo.period_id = %s
+              AND account.costs_types IN ('in', 'out')
+            GROUP BY account.id, account.costs_types, account.code
+            ORDER BY account.costs_types, account.code
+        ''', (period.id,))
+        return self.env.cr.fetchall()
+
     # 反结账
     @api.multi
     def button_counter_checkout(self):
@@ -199,8 +211,6 @@ class checkout_wizard(models.TransientModel):
     def recreate_voucher_name(self, period_id):
         # 取重排凭证设置
         # 是否重置凭证号
-        context = dict(self.env.context or {})
-        context['call_module'] = "checkout_wizard"
         auto_reset = self.env['ir.values'].get_default('finance.config.settings', 'default_auto_reset')
         # 重置凭证间隔:年  月
         reset_period = self.env['ir.values'].get_default('finance.config.settings', 'default_reset_period')
@@ -215,69 +225,20 @@ class checkout_wizard(models.TransientModel):
             seq_ids = self.env['ir.sequence'].search(['&', ('code', '=', 'voucher'), ('company_id', 'in', company_ids)])
             preferred_sequences = [s for s in seq_ids if s.company_id and s.company_id.id == force_company]
             seq_id = preferred_sequences[0] if preferred_sequences else seq_ids[0]
-            voucher_obj = self.env['voucher']
-            # 按年重置
-            last_period = self.env['create.trial.balance.wizard'].compute_last_period_id(self.period_id)
-            last_voucher_number = 0
+            # 按年重置时接着本年度上一个有凭证的期间的最后凭证号，按月重置时从起始数字开始
             if reset_period == 'year':
-                if last_period:
-                    while last_period and last_voucher_number < 1:
-                        if not last_period.is_closed:
-                            raise UserError(u'上一个期间%s未结账' % last_period.name)
-                        if period_id.year != last_period.year:
-                            # 按年，而且是第一个会计期间
-                            last_voucher_number = reset_init_number
-                        else:
-                            # 查找上一期间最后凭证号
-                            last_period_voucher_name = voucher_obj.search([('period_id', '=', last_period.id)],
-                                                                          order="create_date desc", limit=1).name
-                            # 凭证号转换为数字
-                            if last_period_voucher_name:  # 上一期间是否有凭证？
-                                last_voucher_number = int(filter(str.isdigit, last_period_voucher_name.encode("utf-8"))) + 1
-                            #else:
-                            #    raise UserError(u'请核实上一个期间：%s是否有凭证！' % last_period.name)
-                            last_period = self.env['create.trial.balance.wizard'].compute_last_period_id(last_period)
-                else:
-                    last_voucher_number = reset_init_number
-                # 产生凭证号前后缀
-                d = self.env['ir.sequence']._interpolation_dict_context(context=self._context)
-                try:
-                    interpolated_prefix = self.env['ir.sequence']._interpolate(seq_id.prefix, d)
-                    interpolated_suffix = self.env['ir.sequence']._interpolate(seq_id.suffix, d)
-                except ValueError:
-                    raise UserError(_(u'警告'),
-                                     _(u'无效的前缀或后缀 \'%s\'') % (seq_id.name))
-                voucher_ids = voucher_obj.search([('period_id', '=', period_id.id)], order='create_date')
-                for voucher_id in voucher_ids:
-                    # 产生凭证号
-                    next_voucher_name = interpolated_prefix + '%%0%sd' % seq_id.padding % last_voucher_number + interpolated_suffix
-                    last_voucher_number += 1
-                    # 更新凭证号
-                    voucher_id.with_context(context).write({'name': next_voucher_name})
-            # 按月重置
+                last_voucher_number = self.get_last_voucher_number(period_id) or reset_init_number
             else:
                 last_voucher_number = reset_init_number
-                # 产生凭证号前后缀
-                d = self.env['ir.sequence']._interpolation_dict_context(context=self._context)
-                try:
-                    interpolated_prefix = self.env['ir.sequence']._interpolate(seq_id.prefix, d)
-                    interpolated_suffix = self.env['ir.sequence']._interpolate(seq_id.suffix, d)
-                except ValueError:
-                    raise UserError(_(u'警告'),
-                                     _(u'无效的前缀或后缀 \'%s\'') % (seq_id.name))
-                voucher_ids = voucher_obj.search([('period_id', '=', period_id.id)], order='create_date')
-                for voucher_id in voucher_ids:
-                    # 产生凭证号
-                    next_voucher_name = interpolated_prefix + '%%0%sd' % seq_id.padding % last_voucher_number + interpolated_suffix
-                    # 更新凭证号,将老号写到变化表中去！
-                    if voucher_id.name != next_voucher_name:
-                        self.env['chang.voucher.name'].create({
-                            'period_id': self.period_id.id,
-                            'before_voucher_name': voucher_id.name,
-                            'after_voucher_name': next_voucher_name,
-                        })
-                    voucher_id.with_context(context).write({'name': next_voucher_name})
-                    last_voucher_number += 1
+            # 产生凭证号前后缀
+            d = self.env['ir.sequence']._interpolation_dict_context(context=self._context)
+            try:
+                interpolated_prefix = self.env['ir.sequence']._interpolate(seq_id.prefix, d)
+                interpolated_suffix = self.env['ir.sequence']._interpolate(seq_id.suffix, d)
+            except ValueError:
+                raise UserError(u'无效的前缀或后缀 \'%s\'' % seq_id.name)
+            last_voucher_number = self.renumber_vouchers(
+                period_id, last_voucher_number, interpolated_prefix, interpolated_suffix, seq_id.padding)
             # update ir.sequence  number_next
             if last_voucher_number:
                 self.env.cr.execute("UPDATE ir_sequence SET suffix=%s WHERE id=%s ",
@@ -286,4 +247,71 @@ class checkout_wizard(models.TransientModel):
                                                         seq_id.number_next)
                 self.env.cr.commit()
 
+    @api.model
+    def get_last_voucher_number(self, period):
+        '''
+        一次查询取得本年度之前各期间的结账状态和最后一张凭证的凭证号，从最近的期间往前找，
+        返回最后凭证号的下一个号码，本年度之前的期间都没有凭证时返回0
+        '''
+        self.env.cr.execute('''
+            SELECT p.name, p.is_closed,
+                   (SELECT vo.name FROM voucher vo
+                    WHERE vo.period_id = p.id
+                    ORDER BY vo.create_date DESC, vo.id DESC
+                    LIMIT 1)
+            FROM finance_period p
+            WHERE p.year = %s AND p.month::integer < %s
+            ORDER BY p.month::integer DESC
+        ''', (period.year, int(period.month)))
+        for name, is_closed, voucher_name in self.env.cr.fetchall():
+            if not is_closed:
+                raise UserError(u'上一个期间%s未结账' % name)
+            if voucher_name:
+                # 凭证号转换为数字
+                return int(filter(str.isdigit, voucher_name.encode("utf-8"))) + 1
+
+        return 0
+
+    @api.model
+    def renumber_vouchers(self, period, first_number, prefix, suffix, padding):
+        '''
+        按创建时间顺序把会计期间内的凭证重新编号为 prefix + first_number起的连续号码 + suffix，
+        编号用一条窗口函数查询算出，再用一条UPDATE写回，凭证号有变化的记录批量写入凭证号变化表，
+        返回下一个可用的号码
+        '''
+        self.env.cr.execute('''
+            SELECT id, name, %s + row_number() OVER (ORDER BY create_date, id) - 1
+            FROM voucher
+            WHERE period_id = %s
+        ''', (first_number, period.id))
+        rows = self.env.cr.fetchall()
+
+        changes = []
+        for voucher_id, name, number in rows:
+            next_voucher_name = prefix + '%%0%sd' % padding % number + suffix
+            if name != next_voucher_name:
+                changes.append((voucher_id, name, next_voucher_name))
+
+        if changes:
+            # 结账时直接更新凭证号，不再逐张经过凭证的write检查
+            self.env.cr.execute('''
+                UPDATE voucher
+                SET name = changed.name,
+                    write_uid = %%s,
+                    write_date = (now() at time zone 'UTC')
+                FROM (VALUES %s) AS changed (id, name)
+                WHERE voucher.id = changed.id
+            ''' % ', '.join(['(%s, %s)'] * len(changes)),
+                [self.env.uid] + [value for change in changes for value in (change[0], change[2])])
+
+            # 更新凭证号,将老号写到变化表中去！
+            self.env.cr.execute('''
+                INSERT INTO chang_voucher_name (period_id, before_voucher_name,
+                    after_voucher_name, create_uid, create_date, write_uid, write_date)
+                VALUES %s
+            ''' % ', '.join(["(%s, %s, %s, %s, (now() at time zone 'UTC'), %s, (now() at time zone 'UTC'))"] * len(changes)),
+                [value for change in changes
+                 for value in (period.id, change[1], change[2], self.env.uid, self.env.uid)])
+            self.env['voucher'].invalidate_cache(['name'], [change[0] for change in changes])
 
+        return first_number + len(rows)
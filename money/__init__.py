@@ -3,6 +3,7 @@ import money_order
 import other_money_order
 import money_transfer_order
 import partner
+import statement_snapshot
 import wizard
 import report
 import generate_accounting
@@ -11,6 +11,7 @@
     'data': [
         'data/money_data.xml',
         'security/groups.xml',
+        'wizard/open_items_wizard_view.xml',
         'view/money_order_view.xml',
         'view/other_money_order_view.xml',
         'view/money_transfer_order_view.xml',
@@ -21,6 +22,9 @@
         'wizard/bank_statements_wizard_view.xml',
         'report/other_money_statements_view.xml',
         'wizard/other_money_statements_wizard_view.xml',
+        'wizard/auto_reconcile_wizard_view.xml',
+        'data/auto_reconcile_data.xml',
+        'data/statement_snapshot_data.xml',
         'security/ir.model.access.csv',
         'view/partner_view.xml',
         'generate_accounting.xml',
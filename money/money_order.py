@@ -19,9 +19,13 @@
 #
 ##############################################################################
 
+from collections import deque
+from itertools import groupby
 from odoo.exceptions import UserError, ValidationError
 import odoo.addons.decimal_precision as dp
 from odoo import fields, models, api
+from odoo.addons.core.core import insert_rows
+from odoo.tools import float_compare, float_is_zero, float_round
 
 class money_order(models.Model):
     _name = 'money.order'
@@ -161,33 +165,36 @@ class money_order(models.Model):
         if not self.partner_id:
             return {}
 
-        source_lines = []
+        source_lines, warning = [], None
         self.source_ids = []
-        money_invoice = self.env['money.invoice']
         if self.env.context.get('type') == 'get':
-            money_invoice = self.env['money.invoice'].search([
-                                    ('partner_id', '=', self.partner_id.id),
-                                    ('category_id.type', '=', 'income'),
-                                    ('to_reconcile', '!=', 0)])
+            source_lines, warning = self.env['money.invoice'].get_onchange_open_items(
+                self.partner_id.id, 'income')
         if self.env.context.get('type') == 'pay':
-            money_invoice = self.env['money.invoice'].search([
-                                    ('partner_id', '=', self.partner_id.id),
-                                    ('category_id.type', '=', 'expense'),
-                                    ('to_reconcile', '!=', 0)])
+            source_lines, warning = self.env['money.invoice'].get_onchange_open_items(
+                self.partner_id.id, 'expense')
             self.bank_name = self.partner_id.bank_name
             self.bank_num = self.partner_id.bank_num
-        for invoice in money_invoice:
-            source_lines.append({
-                   'name': invoice.id,
-                   'category_id': invoice.category_id.id,
-                   'amount': invoice.amount,
-                   'date': invoice.date,
-                   'reconciled': invoice.reconciled,
-                   'to_reconcile': invoice.to_reconcile,
-                   'this_reconcile': invoice.to_reconcile,
-                   'date_due': invoice.date_due,
-                   })
         self.source_ids = source_lines
+        if warning:
+            return {'warning': warning}
+
+    @api.multi
+    def add_open_items(self, filters=None, limit=None):
+        ''' 按条件把业务伙伴的未核销结算单添加到收付款单的结算单行 '''
+        self.ensure_one()
+        if self.state != 'draft':
+            raise UserError(u'只能在未审核的单据上添加结算单')
+
+        count = self.env['money.invoice'].add_open_items(
+            'money_id', self.id, self.partner_id.id,
+            self.type == 'pay' and 'expense' or 'income', filters, limit)
+        self.invalidate_cache(['source_ids'], self.ids)
+        for field in ('amount', 'advance_payment'):
+            self.env.add_todo(self._fields[field], self)
+        self.recompute()
+
+        return count
 
     @api.multi
     def money_order_done(self):
@@ -206,17 +213,15 @@ class money_order(models.Model):
             total = 0
             for line in order.line_ids:
                 if order.type == 'pay':  # 付款账号余额减少, 退款账号余额增加
-                    if line.bank_id.balance < line.amount:
-                        raise UserError(u'账户余额不足')
-                    line.bank_id.balance -= line.amount
+                    line.bank_id.update_balance(-line.amount, check=True)
                 else:  # 收款账号余额增加, 退款账号余额减少
-                    line.bank_id.balance += line.amount
+                    line.bank_id.update_balance(line.amount)
                 total += line.amount
 
             if order.type == 'pay':
-                order.partner_id.payable -= total + self.discount_amount
+                order.partner_id.update_balance(payable=-(total + order.discount_amount))
             else:
-                order.partner_id.receivable -= total + self.discount_amount
+                order.partner_id.update_balance(receivable=-(total + order.discount_amount))
 
             # 更新结算单的未核销金额、已核销金额
             for source in order.source_ids:
@@ -241,18 +246,15 @@ class money_order(models.Model):
             total = 0
             for line in order.line_ids:
                 if order.type == 'pay':  # 付款账号余额减少
-                    line.bank_id.balance += line.amount
+                    line.bank_id.update_balance(line.amount)
                 else:  # 收款账号余额增加
-                    if line.bank_id.balance < line.amount:
-                        raise UserError(u'账户余额不足')
-                    line.bank_id.balance -= line.amount
+                    line.bank_id.update_balance(-line.amount, check=True)
                 total += line.amount
 
             if order.type == 'pay':
-                order.partner_id.payable += total + self.discount_amount
-
+                order.partner_id.update_balance(payable=total + order.discount_amount)
             else:
-                order.partner_id.receivable += total + self.discount_amount
+                order.partner_id.update_balance(receivable=total + order.discount_amount)
 
             for source in order.source_ids:
                 source.name.to_reconcile = (source.to_reconcile +
@@ -305,6 +307,9 @@ class money_invoice(models.Model):
     _name = 'money.invoice'
     _description = u'结算单'
 
+    # onchange中最多直接带出的未核销结算单张数，超出时只提示合计，按条件分批添加
+    _open_items_onchange_limit = 200
+
     state = fields.Selection([
                           ('draft', u'草稿'),
                           ('done', u'完成')
@@ -351,19 +356,19 @@ class money_invoice(models.Model):
     def money_invoice_done(self):
         for inv in self:
             inv.state = 'done'
-            if self.category_id.type == 'income':
-                inv.partner_id.receivable += inv.amount
-            if self.category_id.type == 'expense':
-                inv.partner_id.payable += inv.amount
+            if inv.category_id.type == 'income':
+                inv.partner_id.update_balance(receivable=inv.amount)
+            if inv.category_id.type == 'expense':
+                inv.partner_id.update_balance(payable=inv.amount)
 
     @api.multi
     def money_invoice_draft(self):
         for inv in self:
             inv.state = 'draft'
-            if self.category_id.type == 'income':
-                inv.partner_id.receivable -= inv.amount
-            if self.category_id.type == 'expense':
-                inv.partner_id.payable -= inv.amount
+            if inv.category_id.type == 'income':
+                inv.partner_id.update_balance(receivable=-inv.amount)
+            if inv.category_id.type == 'expense':
+                inv.partner_id.update_balance(payable=-inv.amount)
 
     @api.model
     def create(self, values):
@@ -380,6 +385,117 @@ class money_invoice(models.Model):
 
         return super(money_invoice, self).unlink()
 
+    @api.model
+    def _open_items_where(self, partner_id, way, filters=None):
+        '''
+        业务伙伴未核销结算单的查询条件，way为结算单类别的类型(income/expense)，
+        filters可以包含date_from、date_to、amount_min、amount_max(按未核销金额)、
+        reference(按编号或发票号模糊查询)和exclude_ids
+        '''
+        filters = filters or {}
+        where = ['inv.partner_id = %s', 'cat.type = %s', 'inv.to_reconcile != 0']
+        params = [partner_id, way]
+        for key, condition in (('date_from', 'inv.date >= %s'),
+                               ('date_to', 'inv.date <= %s'),
+                               ('amount_min', 'inv.to_reconcile >= %s'),
+                               ('amount_max', 'inv.to_reconcile <= %s')):
+            if filters.get(key):
+                where.append(condition)
+                params.append(filters[key])
+
+        if filters.get('reference'):
+            where.append('(inv.name ILIKE %s OR inv.bill_number ILIKE %s)')
+            params.extend(['%%%s%%' % filters['reference']] * 2)
+        if filters.get('exclude_ids'):
+            where.append('inv.id NOT IN %s')
+            params.append(tuple(filters['exclude_ids']))
+
+        return ' AND '.join(where), params
+
+    @api.model
+    def get_open_items_summary(self, partner_id, way, filters=None):
+        ''' 用一条聚合查询返回业务伙伴未核销结算单的张数和金额合计 '''
+        where, params = self._open_items_where(partner_id, way, filters)
+        self.env.cr.execute('''
+            SELECT count(*) AS count,
+                   COALESCE(sum(inv.amount), 0) AS amount,
+                   COALESCE(sum(inv.reconciled), 0) AS reconciled,
+                   COALESCE(sum(inv.to_reconcile), 0) AS to_reconcile,
+                   min(inv.date) AS date_from,
+                   max(inv.date) AS date_to
+            FROM money_invoice inv
+            JOIN core_category cat ON inv.category_id = cat.id
+            WHERE %s
+        ''' % where, params)
+
+        return self.env.cr.dictfetchone()
+
+    @api.model
+    def get_open_items(self, partner_id, way, filters=None, offset=0, limit=None):
+        ''' 按日期分页返回业务伙伴的未核销结算单，每一项都是可以直接写入结算单行的值 '''
+        where, params = self._open_items_where(partner_id, way, filters)
+        self.env.cr.execute('''
+            SELECT inv.id AS name, inv.category_id, inv.date, inv.amount,
+                   inv.reconciled, inv.to_reconcile,
+                   inv.to_reconcile AS this_reconcile, inv.date_due
+            FROM money_invoice inv
+            JOIN core_category cat ON inv.category_id = cat.id
+            WHERE %s
+            ORDER BY inv.date, inv.id
+            LIMIT %%s OFFSET %%s
+        ''' % where, params + [limit, offset or 0])
+
+        return self.env.cr.dictfetchall()
+
+    @api.model
+    def get_onchange_open_items(self, partner_id, way, limit=None):
+        '''
+        onchange中带出的未核销结算单：不超过limit张时返回(结算单行的值, None)，
+        超过时不返回明细，只返回([], 带有张数和金额合计的警告)，需要通过"选择结算单"按条件添加
+        '''
+        limit = limit or self._open_items_onchange_limit
+        items = self.get_open_items(partner_id, way, limit=limit + 1)
+        if len(items) <= limit:
+            return items, None
+
+        summary = self.get_open_items_summary(partner_id, way)
+        return [], {
+            'title': u'未核销结算单过多',
+            'message': u'该业务伙伴有%s张未核销结算单，未核销金额合计%s，'
+                       u'请保存后通过"选择结算单"按条件添加' % (
+                           summary['count'], summary['to_reconcile']),
+        }
+
+    @api.model
+    def add_open_items(self, link_column, link_id, partner_id, way,
+                       filters=None, limit=None):
+        '''
+        把符合条件的未核销结算单用一条INSERT ... SELECT写成link_column指向link_id的结算单行，
+        本次核销金额默认为未核销金额，已经在单据上的结算单不会重复添加，返回添加的行数
+        '''
+        where, params = self._open_items_where(partner_id, way, filters)
+        self.env.cr.execute('''
+            INSERT INTO source_order_line (%s, name, category_id, date, amount,
+                reconciled, to_reconcile, this_reconcile, date_due,
+                create_uid, create_date, write_uid, write_date)
+            SELECT %%s, inv.id, inv.category_id, inv.date, inv.amount,
+                   inv.reconciled, inv.to_reconcile, inv.to_reconcile,
+                   inv.date_due, %%s, (now() at time zone 'UTC'),
+                   %%s, (now() at time zone 'UTC')
+            FROM money_invoice inv
+            JOIN core_category cat ON inv.category_id = cat.id
+            WHERE %s
+              AND NOT EXISTS (SELECT 1 FROM source_order_line line
+                              WHERE line.%s = %%s AND line.name = inv.id)
+            ORDER BY inv.date, inv.id
+            LIMIT %%s
+        ''' % (link_column, where, link_column),
+            [link_id, self.env.uid, self.env.uid] + params + [link_id, limit])
+        count = self.env.cr.rowcount
+        self.env['source.order.line'].invalidate_cache()
+
+        return count
+
 
 class source_order_line(models.Model):
     _name = 'source.order.line'
@@ -431,6 +547,12 @@ class reconcile_order(models.Model):
         ('pay_to_pay', u'应付转应付'),
     ]
 
+    STRATEGY_SELECTION = [
+        ('oldest', u'先到期先核销'),
+        ('amount', u'金额一致'),
+        ('reference', u'单据编号一致'),
+    ]
+
     @api.model
     def create(self, values):
         # 生成订单编号
@@ -511,24 +633,13 @@ class reconcile_order(models.Model):
         return result
 
     @api.multi
-    def _get_money_invoice(self, way='income'):
-        money_invoice = self.env['money.invoice'].search([
-                                    ('category_id.type', '=', way),
-                                    ('partner_id', '=', self.partner_id.id),
-                                    ('to_reconcile', '!=', 0)])
-        result = []
-        for invoice in money_invoice:
-            result.append((0, 0, {
-                   'name': invoice.id,
-                   'category_id': invoice.category_id.id,
-                   'amount': invoice.amount,
-                   'date': invoice.date,
-                   'reconciled': invoice.reconciled,
-                   'to_reconcile': invoice.to_reconcile,
-                   'date_due': invoice.date_due,
-                   'this_reconcile': invoice.to_reconcile,
-                   }))
-        return result
+    def _get_money_invoice(self, way='income', warnings=None):
+        source_lines, warning = self.env['money.invoice'].get_onchange_open_items(
+            self.partner_id.id, way)
+        if warning and warnings is not None:
+            warnings.append(warning['message'])
+
+        return [(0, 0, line) for line in source_lines]
 
     @api.onchange('partner_id', 'to_partner_id', 'business_type')
     def onchange_partner_id(self):
@@ -540,26 +651,44 @@ class reconcile_order(models.Model):
         self.receivable_source_ids = None
         self.payable_source_ids = None
 
-        money_order = self.env['money.order']
-        money_invoice = self.env['money.invoice']
+        # 未核销结算单过多时不带出明细，只提示合计
+        warnings = []
 
         if self.business_type == 'adv_pay_to_get':  # 预收冲应收
             self.advance_payment_ids = self._get_money_order('get')
-            self.receivable_source_ids = self._get_money_invoice('income')
+            self.receivable_source_ids = self._get_money_invoice('income', warnings)
 
         if self.business_type == 'adv_get_to_pay':  # 预付冲应付
             self.advance_payment_ids = self._get_money_order('pay')
-            self.payable_source_ids = self._get_money_invoice('expense')
+            self.payable_source_ids = self._get_money_invoice('expense', warnings)
 
         if self.business_type == 'get_to_pay':  # 应收冲应付
-            self.receivable_source_ids = self._get_money_invoice('income')
-            self.payable_source_ids = self._get_money_invoice('expense')
+            self.receivable_source_ids = self._get_money_invoice('income', warnings)
+            self.payable_source_ids = self._get_money_invoice('expense', warnings)
 
         if self.business_type == 'get_to_get':  # 应收转应收
-            self.receivable_source_ids = self._get_money_invoice('income')
+            self.receivable_source_ids = self._get_money_invoice('income', warnings)
 
         if self.business_type == 'pay_to_pay':  # 应付转应付
-            self.payable_source_ids = self._get_money_invoice('expense')
+            self.payable_source_ids = self._get_money_invoice('expense', warnings)
+
+        if warnings:
+            return {'warning': {'title': u'未核销结算单过多',
+                                'message': u'\n'.join(warnings)}}
+
+    @api.multi
+    def add_open_items(self, way, filters=None, limit=None):
+        ''' 按条件把业务伙伴的应收(income)/应付(expense)未核销结算单添加到核销单 '''
+        self.ensure_one()
+        if self.state != 'draft':
+            raise UserError(u'只能在未审核的单据上添加结算单')
+
+        count = self.env['money.invoice'].add_open_items(
+            way == 'expense' and 'payable_reconcile_id' or 'receivable_reconcile_id',
+            self.id, self.partner_id.id, way, filters, limit)
+        self.invalidate_cache(['receivable_source_ids', 'payable_source_ids'], self.ids)
+
+        return count
 
     @api.multi
     def _get_or_pay(self, line, business_type,
@@ -584,11 +713,11 @@ class reconcile_order(models.Model):
                    })
 
             if business_type == 'get_to_get':
-                to_partner_id.receivable += line.this_reconcile
-                partner_id.receivable -= line.this_reconcile
+                to_partner_id.update_balance(receivable=line.this_reconcile)
+                partner_id.update_balance(receivable=-line.this_reconcile)
             if business_type == 'pay_to_pay':
-                to_partner_id.payable += line.this_reconcile
-                partner_id.payable -= line.this_reconcile
+                to_partner_id.update_balance(payable=line.this_reconcile)
+                partner_id.update_balance(payable=-line.this_reconcile)
 
         return True
 
@@ -638,6 +767,205 @@ class reconcile_order(models.Model):
             order.state = 'done'
         return True
 
+    @api.model
+    def _get_open_payments(self, way, partner_ids=None):
+        ''' 取出并锁定已审核、还有未核销金额的收/付款单，按业务伙伴、日期排序 '''
+        where, params = '', [way]
+        if partner_ids:
+            where = 'AND partner_id IN %s'
+            params.append(tuple(partner_ids))
+
+        self.env.cr.execute('''
+            SELECT id, partner_id, date, amount, reconciled, to_reconcile,
+                   origin_name
+            FROM money_order
+            WHERE state = 'done' AND type = %%s AND to_reconcile > 0 %s
+            ORDER BY partner_id, date, id
+            FOR UPDATE
+        ''' % where, params)
+
+        return self.env.cr.dictfetchall()
+
+    @api.model
+    def _get_open_invoices(self, way, partner_ids=None):
+        ''' 取出并锁定已审核、还有未核销金额的结算单，按业务伙伴、到期日排序 '''
+        where, params = '', [way]
+        if partner_ids:
+            where = 'AND inv.partner_id IN %s'
+            params.append(tuple(partner_ids))
+
+        self.env.cr.execute('''
+            SELECT inv.id, inv.partner_id, inv.category_id, inv.date,
+                   inv.date_due, inv.amount, inv.reconciled, inv.to_reconcile,
+                   inv.name, inv.bill_number
+            FROM money_invoice inv
+            JOIN core_category cat ON inv.category_id = cat.id
+            WHERE inv.state = 'done' AND cat.type = %%s
+              AND inv.to_reconcile > 0 %s
+            ORDER BY inv.partner_id, COALESCE(inv.date_due, inv.date),
+                     inv.date, inv.id
+            FOR UPDATE OF inv
+        ''' % where, params)
+
+        return self.env.cr.dictfetchall()
+
+    @api.model
+    def _match_open_items(self, payments, invoices, strategy='oldest'):
+        '''
+        按核销策略把同一业务伙伴的收/付款单和结算单配对，返回[(收付款单, 结算单, 核销金额)]：
+        oldest 按到期日先后依次核销，amount 只核销未核销金额一致的结算单，
+        reference 只核销编号或发票号与收付款单原始单据编号一致的结算单
+        '''
+        digits = self.env['decimal.precision'].precision_get('Amount')
+        for row in payments + invoices:
+            row['rest'] = row['to_reconcile']
+
+        if strategy == 'amount':
+            candidates = {}
+            for invoice in invoices:
+                candidates.setdefault(float_round(
+                    invoice['rest'], precision_digits=digits), deque()).append(invoice)
+            get_candidates = lambda payment: candidates.get(float_round(
+                payment['rest'], precision_digits=digits), deque())
+        elif strategy == 'reference':
+            candidates = {}
+            for invoice in invoices:
+                for ref in set([invoice['name'], invoice['bill_number']]):
+                    if ref:
+                        candidates.setdefault(ref, deque()).append(invoice)
+            get_candidates = lambda payment: candidates.get(
+                payment['origin_name'], deque())
+        else:
+            candidates = deque(invoices)
+            get_candidates = lambda payment: candidates
+
+        matches = []
+        for payment in payments:
+            open_invoices = get_candidates(payment)
+            while open_invoices and not float_is_zero(payment['rest'], precision_digits=digits):
+                invoice = open_invoices[0]
+                if float_is_zero(invoice['rest'], precision_digits=digits):
+                    open_invoices.popleft()
+                    continue
+
+                if (strategy == 'amount' and float_compare(
+                        invoice['rest'], payment['rest'], precision_digits=digits)):
+                    break
+
+                amount = float_round(min(payment['rest'], invoice['rest']),
+                                     precision_digits=digits)
+                payment['rest'] -= amount
+                invoice['rest'] -= amount
+                matches.append((payment, invoice, amount))
+
+        return matches
+
+    @api.model
+    def _apply_reconcile_amounts(self, table, amounts):
+        ''' 用一条UPDATE把{id: 核销金额}累加到table的已核销金额，并从未核销金额中扣减 '''
+        if not amounts:
+            return True
+
+        self.env.cr.execute('''
+            UPDATE %s t
+            SET reconciled = COALESCE(t.reconciled, 0) + d.amount,
+                to_reconcile = t.to_reconcile - d.amount
+            FROM (VALUES %s) AS d (id, amount)
+            WHERE t.id = d.id
+        ''' % (table, ', '.join(['(%s, %s::numeric)'] * len(amounts))),
+            [value for item in amounts.iteritems() for value in item])
+
+        return True
+
+    @api.model
+    def auto_reconcile(self, way='get', strategy='oldest', partner_ids=None, date=None):
+        '''
+        自动核销：按策略把所有(或指定)业务伙伴已审核的预收/预付款单与应收/应付结算单配对，
+        way为get时预收冲应收，为pay时预付冲应付；
+        未核销金额用集合UPDATE一次写回，每个业务伙伴生成一张已审核的核销单留痕，返回生成的核销单
+        '''
+        if way not in ('get', 'pay'):
+            raise UserError(u'自动核销只支持收款或付款')
+        if strategy not in dict(self.STRATEGY_SELECTION):
+            raise UserError(u'不支持的核销策略：%s' % strategy)
+
+        date = date or fields.Date.context_today(self)
+        invoice_type, business_type, source_column = {
+            'get': ('income', 'adv_pay_to_get', 'receivable_reconcile_id'),
+            'pay': ('expense', 'adv_get_to_pay', 'payable_reconcile_id'),
+        }[way]
+
+        invoices = dict((partner_id, list(rows)) for partner_id, rows in groupby(
+            self._get_open_invoices(invoice_type, partner_ids),
+            key=lambda row: row['partner_id']))
+        matches = []
+        for partner_id, payments in groupby(
+                self._get_open_payments(way, partner_ids), key=lambda row: row['partner_id']):
+            if partner_id in invoices:
+                matches.extend(self._match_open_items(
+                    list(payments), invoices[partner_id], strategy))
+
+        if not matches:
+            return self.browse()
+
+        # 同一张单据在本次核销中的所有金额汇总成一行
+        payment_amounts, invoice_amounts = {}, {}
+        partner_payments, partner_invoices = {}, {}
+        for payment, invoice, amount in matches:
+            payment_amounts[payment['id']] = payment_amounts.get(payment['id'], 0) + amount
+            invoice_amounts[invoice['id']] = invoice_amounts.get(invoice['id'], 0) + amount
+            partner_payments.setdefault(payment['partner_id'], {})[payment['id']] = payment
+            partner_invoices.setdefault(invoice['partner_id'], {})[invoice['id']] = invoice
+
+        self._apply_reconcile_amounts('money_order', payment_amounts)
+        self._apply_reconcile_amounts('money_invoice', invoice_amounts)
+
+        partner_ids = sorted(partner_payments)
+        note = u'自动核销：%s' % dict(self.STRATEGY_SELECTION)[strategy]
+        order_ids = insert_rows(
+            self.env, 'reconcile_order',
+            ['name', 'partner_id', 'business_type', 'date', 'state', 'note'],
+            [(self.env['ir.sequence'].next_by_code(self._name), partner_id,
+              business_type, date, 'done', note) for partner_id in partner_ids])
+        orders = dict(zip(partner_ids, order_ids))
+
+        insert_rows(
+            self.env, 'advance_payment',
+            ['pay_reconcile_id', 'name', 'date', 'amount', 'reconciled',
+             'to_reconcile', 'this_reconcile'],
+            [(orders[partner_id], payment['id'], payment['date'], payment['amount'],
+              payment['reconciled'], payment['to_reconcile'], payment_amounts[payment['id']])
+             for partner_id in partner_ids
+             for payment in partner_payments[partner_id].itervalues()])
+        insert_rows(
+            self.env, 'source_order_line',
+            [source_column, 'name', 'category_id', 'date', 'amount',
+             'reconciled', 'to_reconcile', 'this_reconcile', 'date_due'],
+            [(orders[partner_id], invoice['id'], invoice['category_id'], invoice['date'],
+              invoice['amount'], invoice['reconciled'], invoice['to_reconcile'],
+              invoice_amounts[invoice['id']], invoice['date_due'])
+             for partner_id in partner_ids
+             for invoice in partner_invoices[partner_id].itervalues()])
+
+        self.env['money.order'].invalidate_cache(['reconciled', 'to_reconcile'])
+        self.env['money.invoice'].invalidate_cache(['reconciled', 'to_reconcile'])
+        self.invalidate_cache()
+
+        # 依赖核销金额的存储字段(如发货单、入库单的收付款状态)需要重新计算
+        for model, ids in (('money.order', payment_amounts), ('money.invoice', invoice_amounts)):
+            self.env[model].browse(list(ids)).modified(['reconciled', 'to_reconcile'])
+        self.recompute()
+
+        return self.browse(order_ids)
+
+    @api.model
+    def cron_auto_reconcile(self, strategy='oldest'):
+        ''' 定时任务：对所有业务伙伴分别做预收冲应收、预付冲应付的自动核销 '''
+        for way in ('get', 'pay'):
+            self.auto_reconcile(way=way, strategy=strategy)
+
+        return True
+
 
 class advance_payment(models.Model):
     _name = 'advance.payment'
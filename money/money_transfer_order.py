@@ -86,22 +86,16 @@ class money_transfer_order(models.Model):
                 if line.amount == 0:
                     raise UserError('转账金额不能为0')
                 if out_currency_id == company_currency_id :
-                    if line.out_bank_id.balance < line.amount:
-                        raise UserError('转出账户余额不足')
-                    else:
-                        line.out_bank_id.balance -= line.amount
+                    line.out_bank_id.update_balance(-line.amount, check=True, message=u'转出账户余额不足')
                     if in_currency_id == company_currency_id :
-                        line.in_bank_id.balance += line.amount
+                        line.in_bank_id.update_balance(line.amount)
                     else:
-                        line.in_bank_id.balance += line.currency_amount
+                        line.in_bank_id.update_balance(line.currency_amount)
                 if out_currency_id != company_currency_id :
-                    if line.out_bank_id.balance < line.currency_amount:
-                        raise UserError('转出账户余额不足')
-                    if in_currency_id == company_currency_id:
-                        line.in_bank_id.balance += line.amount
-                        line.out_bank_id.balance -= line.currency_amount
-                    else:
+                    line.out_bank_id.update_balance(-line.currency_amount, check=True, message=u'转出账户余额不足')
+                    if in_currency_id != company_currency_id:
                         raise UserError('系统不支持外币转外币')
+                    line.in_bank_id.update_balance(line.amount)
 
             transfer.state = 'done'
         return True
@@ -111,11 +105,8 @@ class money_transfer_order(models.Model):
         '''转账单的反审核按钮'''
         for transfer in self:
             for line in transfer.line_ids:
-                if line.in_bank_id.balance < line.amount:
-                    raise UserError('转入账户余额不足')
-                else:
-                    line.in_bank_id.balance -= line.amount
-                    line.out_bank_id.balance += line.amount
+                line.in_bank_id.update_balance(-line.amount, check=True, message=u'转入账户余额不足')
+                line.out_bank_id.update_balance(line.amount)
             transfer.state = 'draft'
         return True
 
@@ -108,11 +108,9 @@ class other_money_order(models.Model):
 
             # 根据单据类型更新账户余额
             if other.type == 'other_pay':
-                if other.bank_id.balance < other.total_amount:
-                    raise UserError(u'账户余额不足')
-                other.bank_id.balance -= other.total_amount
+                other.bank_id.update_balance(-other.total_amount, check=True)
             else:
-                other.bank_id.balance += other.total_amount
+                other.bank_id.update_balance(other.total_amount)
             other.state = 'done'
         return True
 
@@ -122,11 +120,9 @@ class other_money_order(models.Model):
         for other in self:
             # 根据单据类型更新账户余额
             if other.type == 'other_pay':
-                other.bank_id.balance += other.total_amount
+                other.bank_id.update_balance(other.total_amount)
             else:
-                if other.bank_id.balance < other.total_amount:
-                    raise UserError(u'账户余额不足')
-                other.bank_id.balance -= other.total_amount
+                other.bank_id.update_balance(-other.total_amount, check=True)
             other.state = 'draft'
         return True
 
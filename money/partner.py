@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from odoo import fields, models, api
+from odoo.exceptions import UserError
 import odoo.addons.decimal_precision as dp
 
 
@@ -69,6 +70,25 @@ class partner(models.Model):
                            inverse=_set_payable_init,
                         help=u'供应商的应付期初余额')
 
+    @api.multi
+    def update_balance(self, receivable=0, payable=0):
+        '''
+        把变化量累加到应收、应付余额上：读取和累加在同一条UPDATE中完成，
+        并发审核同一个业务伙伴的单据时持有行锁依次累加，不会互相覆盖
+        '''
+        if not self.ids or not (receivable or payable):
+            return True
+
+        self.env.cr.execute('''
+            UPDATE partner
+            SET receivable = COALESCE(receivable, 0) + %s,
+                payable = COALESCE(payable, 0) + %s
+            WHERE id IN %s
+        ''', (receivable, payable, tuple(self.ids)))
+        self.invalidate_cache(['receivable', 'payable'], self.ids)
+
+        return True
+
     @api.multi
     def partner_statements(self):
         self.ensure_one()
@@ -129,6 +149,32 @@ class bank_account(models.Model):
                                inverse=_set_init_balance,
                                help=u'资金的期初余额')
 
+    @api.multi
+    def update_balance(self, amount, check=False, message=u'账户余额不足'):
+        '''
+        把amount累加到账户余额上并返回新的余额：读取、检查和累加在同一条UPDATE中完成，
+        check为True时累加之后余额小于0则不更新并报错，多个收银终端同时扣减同一账户时不会透支
+        '''
+        self.ensure_one()
+        where = 'id = %s'
+        params = [amount, self.id]
+        if check:
+            where += ' AND COALESCE(balance, 0) + %s >= 0'
+            params.append(amount)
+
+        self.env.cr.execute('''
+            UPDATE bank_account
+            SET balance = COALESCE(balance, 0) + %%s
+            WHERE %s
+            RETURNING balance
+        ''' % where, params)
+        row = self.env.cr.fetchone()
+        if not row:
+            raise UserError(message)
+        self.invalidate_cache(['balance'], self.ids)
+
+        return row[0]
+
     @api.multi
     def bank_statements(self):
         self.ensure_one()
@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
+import statements_balance
 import bank_statements
 import other_money_statements
@@ -6,24 +6,15 @@ from odoo import fields, models, api, tools
 
 class bank_statements_report(models.Model):
     _name = "bank.statements.report"
+    _inherit = 'statements.balance.mixin'
     _description = u"现金银行报表"
     _auto = False
     _order = 'date'
 
-    @api.one
-    @api.depends('get', 'pay', 'bank_id')
-    def _compute_balance(self):
-        # 相邻的两条记录，bank_id不同，重新计算账户余额
-        pre_record = self.search([('id', '=', self.id - 1), ('bank_id', '=', self.bank_id.id)])
-        if pre_record:
-            if pre_record.name != u'期初余额':
-                before_balance = pre_record.this_balance
-            else:
-                before_balance = pre_record.get
-        else:
-            before_balance = 0
-        self.balance += before_balance + self.get - self.pay
-        self.this_balance = self.balance
+    _balance_key = 'bank_id'
+    _balance_delta = 'get - pay'
+    _balance_order = 'date'
+    _balance_field = 'balance'
 
     bank_id = fields.Many2one('bank.account', string=u'账户名称', readonly=True)
     date = fields.Date(string=u'日期', readonly=True)
@@ -32,32 +23,16 @@ class bank_statements_report(models.Model):
                        digits=dp.get_precision('Amount'))
     pay = fields.Float(string=u'支出', readonly=True,
                        digits=dp.get_precision('Amount'))
-    balance = fields.Float(string=u'账户余额',
-                           compute='_compute_balance', readonly=True,
+    balance = fields.Float(string=u'账户余额', readonly=True,
                            digits=dp.get_precision('Amount'))
-    this_balance = fields.Float(string=u'账户余额',
+    this_balance = fields.Float(string=u'账户余额', readonly=True,
                                 digits=dp.get_precision('Amount'))
     partner_id = fields.Many2one('partner', string=u'往来单位', readonly=True)
     note = fields.Char(string=u'备注', readonly=True)
 
-    def init(self):
-        # union money_order, other_money_order, money_transfer_order
-        cr = self._cr
-        tools.drop_view_if_exists(cr, 'bank_statements_report')
-        cr.execute("""
-            CREATE or REPLACE VIEW bank_statements_report AS (
-            SELECT  ROW_NUMBER() OVER(ORDER BY bank_id,date) AS id,
-                    bank_id,
-                    date,
-                    name,
-                    get,
-                    pay,
-                    balance,
-                    0 AS this_balance,
-                    partner_id,
-                    note
-            FROM
-                (
+    def _statement_lines_sql(self):
+        # 对账单明细行：收付款单、其他收支单和资金转换单的收支
+        return """
                 SELECT mol.bank_id,
                         mo.date,
                         mo.name,
@@ -104,8 +79,39 @@ class bank_statements_report(models.Model):
                 FROM money_transfer_order_line AS mtol
                 LEFT JOIN money_transfer_order AS mto ON mtol.transfer_id = mto.id
                 WHERE mto.state = 'done'
-                ) AS bs)
-        """)
+        """
+
+    def init(self):
+        # union money_order, other_money_order, money_transfer_order
+        # 账户余额用窗口函数按账户累计，不再逐条查找上一条记录
+        cr = self._cr
+        tools.drop_view_if_exists(cr, 'bank_statements_report')
+        cr.execute("""
+            CREATE or REPLACE VIEW bank_statements_report AS (
+            SELECT  id,
+                    bank_id,
+                    date,
+                    name,
+                    get,
+                    pay,
+                    %(balance)s AS balance,
+                    %(balance)s AS this_balance,
+                    partner_id,
+                    note
+            FROM
+            (
+            SELECT  ROW_NUMBER() OVER(ORDER BY bank_id,date) AS id,
+                    bank_id,
+                    date,
+                    name,
+                    get,
+                    pay,
+                    partner_id,
+                    note
+            FROM
+                (%(lines)s) AS bs) AS lines)
+        """ % {'balance': self._balance_window_sql(),
+               'lines': self._statement_lines_sql()})
 
     @api.multi
     def find_source_order(self):
@@ -153,4 +159,26 @@ class bank_statements_report(models.Model):
             'res_id': transfer_order.id
         }
 
+
+class bank_statements_report_line(models.TransientModel):
+    _name = "bank.statements.report.line"
+    _description = u"现金银行报表明细"
+
+    bank_id = fields.Many2one('bank.account', string=u'账户名称', readonly=True)
+    date = fields.Date(string=u'日期', readonly=True)
+    name = fields.Char(string=u'单据编号', readonly=True)
+    get = fields.Float(string=u'收入', readonly=True,
+                       digits=dp.get_precision('Amount'))
+    pay = fields.Float(string=u'支出', readonly=True,
+                       digits=dp.get_precision('Amount'))
+    balance = fields.Float(string=u'账户余额', readonly=True,
+                           digits=dp.get_precision('Amount'))
+    partner_id = fields.Many2one('partner', string=u'往来单位', readonly=True)
+    note = fields.Char(string=u'备注', readonly=True)
+
+    @api.multi
+    def find_source_order(self):
+        # 按单据编号查看原始单据，与现金银行报表相同
+        return self.env['bank.statements.report'].new({'name': self.name}).find_source_order()
+
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, api
+
+
+class statements_balance_mixin(models.AbstractModel):
+    '''
+    对账单报表的余额：视图中用窗口函数按(业务伙伴/账户, id)累计余额，不再逐条查找上一条记录；
+    日期范围模式不读视图，在同一条查询中从月度快照算出开始日期之前的期初余额，
+    再累计范围内每条明细行的余额，对账单向导都使用日期范围模式
+    '''
+    _name = 'statements.balance.mixin'
+    _description = u'对账单余额'
+
+    # 余额的分组字段和每条记录对余额的影响
+    _balance_key = 'partner_id'
+    _balance_delta = 'amount - pay_amount - discount_money'
+    # 日期范围模式中明细行的排序和余额字段，排序与视图中生成id的ROW_NUMBER相同
+    _balance_order = 'done_date'
+    _balance_field = 'balance_amount'
+
+    @api.model
+    def _balance_window_sql(self):
+        ''' 视图中累计余额的窗口函数，外层查询需要有id和_balance_key、_balance_delta用到的列 '''
+        return 'SUM(%s) OVER (PARTITION BY %s ORDER BY id ROWS UNBOUNDED PRECEDING)' % (
+            self._balance_delta, self._balance_key)
+
+    def _statement_lines_sql(self):
+        '''
+        对账单明细行的查询，需要有date列和_balance_key、_balance_delta用到的列，
+        默认直接取报表本身，视图中的明细行需要另外拼接余额列时由各个报表重写
+        '''
+        return 'SELECT * FROM %s' % self._table
+
+    @api.model
+    def get_statement_lines(self, key_id, from_date, to_date):
+        '''
+        日期范围模式：返回(期初余额, 明细行)，期初余额取from_date之前最近的月度快照，
+        再加上快照之后、from_date之前的明细行；范围内的明细行直接从_statement_lines_sql()
+        按业务伙伴/账户和日期过滤，不经过累计全部历史的报表视图，余额在期初余额的基础上累计
+        '''
+        snapshot_date = self.env['money.statement.snapshot'].get_snapshot_date(
+            self._name, from_date)
+        self.env.cr.execute('''
+            WITH opening AS (
+                SELECT COALESCE(sum(delta), 0) AS opening_balance
+                FROM (
+                    SELECT balance AS delta
+                    FROM money_statement_snapshot
+                    WHERE model = %%(model)s AND res_id = %%(key_id)s
+                      AND date = %%(snapshot_date)s::date
+                    UNION ALL
+                    SELECT %(delta)s
+                    FROM (%(lines)s) lines
+                    WHERE %(key)s = %%(key_id)s AND date < %%(from_date)s
+                      AND (%%(snapshot_date)s::date IS NULL
+                           OR date >= %%(snapshot_date)s::date)
+                ) deltas
+            )
+            SELECT lines.*, opening_balance,
+                   opening_balance + SUM(%(delta)s) OVER (
+                       ORDER BY %(order)s ROWS UNBOUNDED PRECEDING) AS statement_balance
+            FROM opening
+            LEFT JOIN (
+                SELECT *
+                FROM (%(lines)s) lines
+                WHERE %(key)s = %%(key_id)s
+                  AND date >= %%(from_date)s AND date <= %%(to_date)s
+            ) lines ON TRUE
+            ORDER BY %(order)s
+        ''' % {
+            'delta': self._balance_delta,
+            'lines': self._statement_lines_sql(),
+            'key': self._balance_key,
+            'order': self._balance_order,
+        }, {
+            'model': self._name,
+            'key_id': key_id,
+            'from_date': from_date,
+            'to_date': to_date,
+            'snapshot_date': snapshot_date or None,
+        })
+
+        opening, lines = 0, []
+        for line in self.env.cr.dictfetchall():
+            opening = line.pop('opening_balance')
+            balance = line.pop('statement_balance')
+            # 范围内没有明细行时只有一行全部为空的期初余额
+            if line[self._balance_key] is not None:
+                line[self._balance_field] = balance
+                lines.append(line)
+
+        return opening, lines
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import odoo.addons.decimal_precision as dp
+from odoo import models, fields, api
+
+
+class money_statement_snapshot(models.Model):
+    '''
+    对账单快照：按(报表, 截止日期, 业务伙伴/账户)保存截止日期之前(不含)的余额，
+    每月初或者会计期间结账时生成，对账单的日期范围模式从最近的快照取期初余额，只需要扫描快照之后的明细行；
+    单据审核、反审核时删除截止日期晚于单据日期的快照
+    '''
+    _name = 'money.statement.snapshot'
+    _description = u'对账单快照'
+    _order = 'date desc'
+
+    # 生成快照的对账单报表，没有安装的模块会被跳过
+    STATEMENT_MODELS = ('customer.statements.report',
+                        'supplier.statements.report',
+                        'bank.statements.report')
+
+    date = fields.Date(
+        u'截止日期', required=True, index=True,
+        help=u'快照保存该日期之前(不含)的余额')
+    model = fields.Char(
+        u'对账单', required=True,
+        help=u'快照对应的对账单报表模型')
+    res_id = fields.Integer(
+        u'业务伙伴/账户', required=True,
+        help=u'客户、供应商对账单为业务伙伴id，现金银行报表为账户id')
+    balance = fields.Float(
+        u'余额', digits=dp.get_precision('Amount'),
+        help=u'截止日期之前的余额')
+
+    def init(self):
+        self._cr.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS money_statement_snapshot_key_index
+            ON money_statement_snapshot (model, date, res_id)
+        ''')
+
+    @api.model
+    def get_snapshot_date(self, model, date):
+        ''' 返回model不晚于date的最近一个快照的截止日期，没有快照的时候返回False '''
+        if not date:
+            return False
+
+        self.env.cr.execute('''
+            SELECT max(date) FROM money_statement_snapshot
+            WHERE model = %s AND date <= %s
+        ''', (model, date))
+        snapshot_date = self.env.cr.fetchone()[0]
+
+        return snapshot_date and fields.Date.to_string(snapshot_date) or False
+
+    @api.model
+    def create_snapshot(self, model, date):
+        '''
+        生成model截止日期为date的快照，在上一个快照的基础上只累加两个快照之间的明细行，
+        已经存在的同一日期的快照会被重新生成，余额为0的业务伙伴/账户不保存
+        '''
+        self.env.cr.execute('''
+            DELETE FROM money_statement_snapshot WHERE model = %s AND date = %s
+        ''', (model, date))
+        last_date = self.get_snapshot_date(model, date)
+
+        report = self.env[model]
+        self.env.cr.execute('''
+            INSERT INTO money_statement_snapshot (model, date, res_id, balance)
+            SELECT %%(model)s, %%(date)s, res_id, sum(delta)
+            FROM (
+                SELECT res_id, balance AS delta
+                FROM money_statement_snapshot
+                WHERE model = %%(model)s AND date = %%(last_date)s::date
+                UNION ALL
+                SELECT %(key)s, %(delta)s
+                FROM (%(lines)s) lines
+                WHERE %(key)s IS NOT NULL AND date < %%(date)s
+                  AND (%%(last_date)s::date IS NULL OR date >= %%(last_date)s::date)
+            ) balances
+            GROUP BY res_id
+            HAVING sum(delta) != 0
+        ''' % {
+            'key': report._balance_key,
+            'delta': report._balance_delta,
+            'lines': report._statement_lines_sql(),
+        }, {
+            'model': model,
+            'date': date,
+            'last_date': last_date or None,
+        })
+        self.invalidate_cache()
+
+        return True
+
+    @api.model
+    def invalidate_snapshots(self, date):
+        ''' 截止日期晚于date的快照包含了该日期的单据，单据审核、反审核之后需要删除 '''
+        if date:
+            self.env.cr.execute('DELETE FROM money_statement_snapshot WHERE date > %s', (date,))
+            self.invalidate_cache()
+
+        return True
+
+    @api.model
+    def create_snapshots(self, date):
+        ''' 为所有已安装的对账单报表生成截止日期为date的快照 '''
+        for model in self.STATEMENT_MODELS:
+            if model in self.env and self.get_snapshot_date(model, date) != date:
+                self.create_snapshot(model, date)
+
+        return True
+
+    @api.model
+    def cron_create_snapshot(self):
+        ''' 定时任务：生成截止到本月第一天的快照 '''
+        return self.create_snapshots(fields.Date.context_today(self)[:8] + '01')
+
+
+class statement_snapshot_document(models.AbstractModel):
+    '''
+    会影响对账单的单据：已审核单据中影响余额的字段(_snapshot_fields)变化时，删除截止日期晚于单据日期的对账单快照；
+    直接用SQL修改单据时不经过这里，需要自行调用money.statement.snapshot的invalidate_snapshots
+    '''
+    _name = 'statement.snapshot.document'
+    _description = u'影响对账单的单据'
+
+    # 对账单明细行的日期、金额、业务伙伴/账户来自这些字段
+    _snapshot_fields = ('state', 'date')
+
+    @api.multi
+    def write(self, vals):
+        if not set(vals) & set(self._snapshot_fields):
+            return super(statement_snapshot_document, self).write(vals)
+
+        dates = [order.date for order in self if order.state == 'done']
+        res = super(statement_snapshot_document, self).write(vals)
+        dates.extend(order.date for order in self if order.state == 'done')
+
+        dates = filter(None, dates)
+        if dates:
+            self.env['money.statement.snapshot'].invalidate_snapshots(min(dates))
+
+        return res
+
+
+class statement_snapshot_document_line(models.AbstractModel):
+    '''
+    会影响对账单的单据明细：已审核单据的明细中影响余额的字段变化或者明细被删除时，按单据日期删除快照
+    '''
+    _name = 'statement.snapshot.document.line'
+    _description = u'影响对账单的单据明细'
+
+    # 明细所属单据的字段和影响余额的字段
+    _snapshot_order = None
+    _snapshot_fields = ()
+
+    @api.multi
+    def _invalidate_snapshots(self):
+        dates = [line[self._snapshot_order].date for line in self
+                 if line[self._snapshot_order].state == 'done']
+        dates = filter(None, dates)
+        if dates:
+            self.env['money.statement.snapshot'].invalidate_snapshots(min(dates))
+
+    @api.multi
+    def write(self, vals):
+        if set(vals) & set(self._snapshot_fields + (self._snapshot_order,)):
+            self._invalidate_snapshots()
+            res = super(statement_snapshot_document_line, self).write(vals)
+            self._invalidate_snapshots()
+            return res
+
+        return super(statement_snapshot_document_line, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._invalidate_snapshots()
+        return super(statement_snapshot_document_line, self).unlink()
+
+
+class money_order(models.Model):
+    _name = 'money.order'
+    _inherit = ['money.order', 'statement.snapshot.document']
+
+    _snapshot_fields = ('state', 'date', 'type', 'partner_id', 'discount_amount', 'line_ids')
+
+
+class money_order_line(models.Model):
+    _name = 'money.order.line'
+    _inherit = ['money.order.line', 'statement.snapshot.document.line']
+
+    _snapshot_order = 'money_id'
+    _snapshot_fields = ('bank_id', 'amount')
+
+
+class money_invoice(models.Model):
+    _name = 'money.invoice'
+    _inherit = ['money.invoice', 'statement.snapshot.document']
+
+    _snapshot_fields = ('state', 'date', 'partner_id', 'category_id', 'amount')
+
+
+class other_money_order(models.Model):
+    _name = 'other.money.order'
+    _inherit = ['other.money.order', 'statement.snapshot.document']
+
+    _snapshot_fields = ('state', 'date', 'type', 'bank_id', 'line_ids')
+
+
+class other_money_order_line(models.Model):
+    _name = 'other.money.order.line'
+    _inherit = ['other.money.order.line', 'statement.snapshot.document.line']
+
+    _snapshot_order = 'other_money_id'
+    _snapshot_fields = ('amount', 'tax_amount')
+
+
+class money_transfer_order(models.Model):
+    _name = 'money.transfer.order'
+    _inherit = ['money.transfer.order', 'statement.snapshot.document']
+
+    _snapshot_fields = ('state', 'date', 'line_ids')
+
+
+class money_transfer_order_line(models.Model):
+    _name = 'money.transfer.order.line'
+    _inherit = ['money.transfer.order.line', 'statement.snapshot.document.line']
+
+    _snapshot_order = 'transfer_id'
+    _snapshot_fields = ('out_bank_id', 'in_bank_id', 'amount')
+
+
+class checkout_wizard(models.TransientModel):
+    _inherit = 'checkout.wizard'
+
+    @api.multi
+    def button_checkout(self):
+        res = super(checkout_wizard, self).button_checkout()
+        # 结账之后生成截止到下一个会计期间第一天的对账单快照
+        if self.period_id and self.period_id.is_closed:
+            _, date_end = self.env['finance.period'].get_period_month_date_range(self.period_id)
+            date = datetime.datetime.strptime(date_end, '%Y-%m-%d') + datetime.timedelta(days=1)
+            self.env['money.statement.snapshot'].create_snapshots(date.strftime('%Y-%m-%d'))
+
+        return res
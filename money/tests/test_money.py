@@ -68,6 +68,57 @@ class test_money_order(TransactionCase):
         self.partner_id = False
         self.env['money.order'].onchange_partner_id()
 
+    def test_open_items(self):
+        '''测试按条件分页带出未核销结算单'''
+        jd = self.env.ref('core.jd')
+        invoice_obj = self.env['money.invoice']
+        invoices = invoice_obj
+        for i in range(3):
+            invoices |= invoice_obj.create({
+                'partner_id': jd.id, 'date': '2016-03-0%s' % (i + 1),
+                'name': 'open/item/%s' % i,
+                'category_id': self.env.ref('money.core_category_sale').id,
+                'amount': 100.0 * (i + 1),
+                'reconciled': 0,
+                'to_reconcile': 100.0 * (i + 1)})
+
+        filters = {'date_from': '2016-03-01', 'date_to': '2016-03-31'}
+        summary = invoice_obj.get_open_items_summary(jd.id, 'income', filters)
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['to_reconcile'], 600.0)
+        # 分页和按编号、金额过滤
+        items = invoice_obj.get_open_items(jd.id, 'income', filters, offset=1, limit=1)
+        self.assertEqual([item['name'] for item in items], [invoices[1].id])
+        items = invoice_obj.get_open_items(jd.id, 'income', dict(
+            filters, reference='item/2', amount_min=300))
+        self.assertEqual([item['this_reconcile'] for item in items], [300.0])
+        # 应付结算单中没有这些结算单
+        self.assertFalse(invoice_obj.get_open_items(jd.id, 'expense', filters))
+
+        # 超过onchange带出的张数时只返回警告
+        lines, warning = invoice_obj.get_onchange_open_items(jd.id, 'income', limit=1)
+        self.assertFalse(lines)
+        self.assertTrue(warning)
+
+        # 通过向导按条件添加到收付款单，重复添加不会产生重复的行
+        self.env.ref('money.get_40000').money_order_done()
+        money = self.env['money.order'].with_context({'type': 'get'}).create({
+            'partner_id': jd.id, 'date': '2016-03-10',
+            'line_ids': [(0, 0, {'bank_id': self.env.ref('core.comm').id,
+                                 'amount': 1000.0})],
+            'type': 'get'})
+        wizard = self.env['open.items.wizard'].with_context({
+            'active_model': 'money.order', 'active_id': money.id}).create(
+            dict(filters, limit=2))
+        self.assertEqual(wizard.way, 'income')
+        self.assertEqual(wizard.item_count, 3)
+        wizard.button_add_items()
+        self.assertEqual(money.source_ids.mapped('name'), invoices[:2])
+        self.assertEqual(money.advance_payment, 700.0)
+        self.assertEqual(money.add_open_items(filters), 1)
+        self.assertEqual(money.source_ids.mapped('name'), invoices)
+        self.assertEqual(money.advance_payment, 400.0)
+
     def test_money_order_done(self):
         ''' 测试收付款审核  '''
         # 余额不足不能付款
@@ -464,3 +515,21 @@ class test_partner(TransactionCase):
         self.assertEqual(bank.balance, bank.init_balance + balance)
         # 测试   资金如果有前期初值，删掉已前的单据   的 if 判断
         bank._set_init_balance()
+
+    def test_update_balance(self):
+        '''账户余额和应收应付余额按变化量累加'''
+        bank = self.env.ref('core.comm')
+        balance = bank.balance
+        self.assertEqual(bank.update_balance(100), balance + 100)
+        self.assertEqual(bank.balance, balance + 100)
+        # 余额不足时不扣减
+        with self.assertRaises(UserError):
+            bank.update_balance(-(balance + 101), check=True)
+        self.assertEqual(bank.balance, balance + 100)
+        self.assertEqual(bank.update_balance(-(balance + 100), check=True), 0)
+
+        partner = self.env.ref('core.jd')
+        receivable, payable = partner.receivable, partner.payable
+        partner.update_balance(receivable=10, payable=-5)
+        self.assertEqual(partner.receivable, receivable + 10)
+        self.assertEqual(partner.payable, payable - 5)
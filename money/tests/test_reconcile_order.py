@@ -154,3 +154,50 @@ class test_reconcile_order(TransactionCase):
             reconcile_pay_to_pay_partner_same.reconcile_order_done()
 
         self.env.ref('money.reconcile_get_to_get').reconcile_order_done()
+
+    def test_auto_reconcile(self):
+        '''测试自动核销'''
+        for invoice in (self.get_invoice, self.pay_invoice):
+            if invoice.state == 'draft':
+                invoice.money_invoice_done()
+        reconcile = self.env['reconcile.order']
+        jd, lenovo = self.env.ref('core.jd'), self.env.ref('core.lenovo')
+        money_get = self.env.ref('money.get_40000')
+        money_get.origin_name = 'invoice/201600661'
+        get_to_reconcile = money_get.to_reconcile
+
+        # 不支持的核销策略
+        with self.assertRaises(UserError):
+            reconcile.auto_reconcile('get', 'unknown', [jd.id])
+        # 没有未核销金额一致的结算单
+        self.assertFalse(reconcile.auto_reconcile('get', 'amount', [jd.id]))
+
+        # 单据编号一致：预收冲应收
+        orders = reconcile.auto_reconcile('get', 'reference', [jd.id])
+        self.assertEqual(orders.state, 'done')
+        self.assertEqual(orders.business_type, 'adv_pay_to_get')
+        self.assertEqual(orders.advance_payment_ids.name, money_get)
+        self.assertEqual(orders.advance_payment_ids.this_reconcile, 300.0)
+        self.assertEqual(orders.receivable_source_ids.name, self.get_invoice)
+        self.assertEqual(self.get_invoice.reconciled, 300.0)
+        self.assertEqual(self.get_invoice.to_reconcile, 0)
+        self.assertEqual(money_get.to_reconcile, get_to_reconcile - 300.0)
+
+        # 先到期先核销：预付冲应付，通过向导执行
+        money_pay = self.env.ref('money.pay_2000')
+        money_pay.money_order_done()
+        wizard = self.env['auto.reconcile.wizard'].create({
+            'way': 'pay',
+            'strategy': 'oldest',
+            'partner_ids': [(6, 0, [lenovo.id])],
+        })
+        wizard.button_auto_reconcile()
+        self.assertEqual(self.pay_invoice.reconciled, 600.0)
+        self.assertEqual(self.pay_invoice.to_reconcile, 0)
+        self.assertEqual(money_pay.to_reconcile, 1400.0)
+        self.assertTrue(reconcile.search([('partner_id', '=', lenovo.id),
+                                          ('business_type', '=', 'adv_get_to_pay'),
+                                          ('state', '=', 'done')]))
+
+        # 定时任务
+        self.assertTrue(reconcile.cron_auto_reconcile())
@@ -17,8 +17,14 @@ class test_report(TransactionCase):
         # 执行向导
         statement = self.env['bank.statements.report.wizard'].create({'bank_id': self.env.ref('core.comm').id,
                                                                       'from_date': '2016-11-01', 'to_date': '2016-11-03'})
-        # 输出报表
-        statement.confirm_bank_statements()
+        # 输出报表：第一行是期初余额，最后一行的余额是结束日期的账户余额
+        action = statement.confirm_bank_statements()
+        lines = self.env[action['res_model']].search(action['domain'], order='id')
+        self.assertEqual(lines[0].name, u'期初')
+        self.assertAlmostEqual(lines[-1].balance, lines[0].balance + sum(
+            line.get - line.pay for line in lines[1:]))
+        for line in lines[1:]:
+            line.find_source_order()
         # 测试现金银行对账单向导：'结束日期不能小于开始日期！'
         statement_date_error = self.env['bank.statements.report.wizard'].create({'bank_id':self.env.ref('core.comm').id,
                                                                                 'from_date': '2016-11-03', 'to_date': '2016-11-02'})
@@ -34,6 +40,66 @@ class test_report(TransactionCase):
             self.assertNotEqual(str(money.balance), 'zxy')
             money.find_source_order()
 
+    def test_bank_report_balance(self):
+        ''' 测试现金银行报表的累计余额和日期范围模式 '''
+        self.env.ref('money.get_40000').money_order_done()
+        self.env.ref('money.other_get_60').other_money_done()
+        comm = self.env.ref('core.comm')
+        report = self.env['bank.statements.report']
+        lines = report.search([('bank_id', '=', comm.id)], order='id')
+        balance = 0
+        for line in lines:
+            balance += line.get - line.pay
+            self.assertAlmostEqual(line.balance, balance)
+            self.assertAlmostEqual(line.this_balance, balance)
+
+        # 期初余额是开始日期之前的合计，范围内的余额在期初余额基础上累计，与视图的余额一致
+        last = lines[-1]
+        opening, range_lines = report.get_statement_lines(comm.id, last.date, last.date)
+        self.assertAlmostEqual(opening, sum(
+            line.get - line.pay for line in lines if line.date < last.date))
+        self.assertEqual(len(range_lines), len(lines.filtered(lambda line: line.date == last.date)))
+        self.assertAlmostEqual(range_lines[-1]['balance'], last.balance)
+        # 范围内没有明细行时只返回期初余额
+        opening, range_lines = report.get_statement_lines(comm.id, '2099-01-01', '2099-12-31')
+        self.assertAlmostEqual(opening, last.balance)
+        self.assertEqual(range_lines, [])
+
+    def test_statement_snapshot(self):
+        ''' 测试对账单快照 '''
+        money_get = self.env.ref('money.get_40000')
+        money_get.money_order_done()
+        self.env.ref('money.other_get_60').other_money_done()
+        comm = self.env.ref('core.comm')
+        report = self.env['bank.statements.report']
+        snapshot = self.env['money.statement.snapshot']
+        lines = report.search([('bank_id', '=', comm.id)])
+        balance = sum(line.get - line.pay for line in lines if line.date < '2016-03-01')
+
+        snapshot.create_snapshots('2016-03-01')
+        self.assertEqual(snapshot.get_snapshot_date('bank.statements.report', '2016-06-01'),
+                         '2016-03-01')
+        comm_snapshot = snapshot.search([('model', '=', 'bank.statements.report'),
+                                         ('res_id', '=', comm.id)])
+        self.assertAlmostEqual(comm_snapshot.balance, balance)
+        # 期初余额从快照取得，结果与直接累计明细行一致
+        opening, _ = report.get_statement_lines(comm.id, '2016-06-01', '2016-12-31')
+        self.assertAlmostEqual(opening, sum(
+            line.get - line.pay for line in lines if line.date < '2016-06-01'))
+
+        # 已审核单据修改不影响余额的字段时保留快照，修改明细金额时删除快照
+        money_get.note = u'修改备注'
+        self.assertEqual(snapshot.get_snapshot_date('bank.statements.report', '2016-06-01'),
+                         '2016-03-01')
+        money_get.line_ids[0].amount += 1
+        self.assertFalse(snapshot.get_snapshot_date('bank.statements.report', '2016-06-01'))
+        money_get.line_ids[0].amount -= 1
+
+        # 单据反审核之后删除包含该单据的快照
+        snapshot.create_snapshots('2016-03-01')
+        money_get.money_order_draft()
+        self.assertFalse(snapshot.get_snapshot_date('bank.statements.report', '2016-06-01'))
+
     def test_other_money_report(self):
         ''' 测试其他收支单明细表'''
         # 执行向导
@@ -2,3 +2,5 @@
 import partner_statements_wizard
 import bank_statements_wizard
 import other_money_statements_wizard
+import auto_reconcile_wizard
+import open_items_wizard
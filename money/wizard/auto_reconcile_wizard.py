@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from odoo import fields, models, api
+
+
+class auto_reconcile_wizard(models.TransientModel):
+    _name = 'auto.reconcile.wizard'
+    _description = u'自动核销向导'
+
+    way = fields.Selection([
+        ('get', u'预收冲应收'),
+        ('pay', u'预付冲应付'),
+    ], string=u'业务类型', required=True, default='get',
+        help=u'预收冲应收：核销客户的收款单和应收结算单；预付冲应付：核销供应商的付款单和应付结算单')
+    strategy = fields.Selection(
+        lambda self: self.env['reconcile.order'].STRATEGY_SELECTION,
+        string=u'核销策略', required=True, default='oldest',
+        help=u'先到期先核销：按结算单到期日先后依次核销；'
+             u'金额一致：只核销未核销金额与收付款单一致的结算单；'
+             u'单据编号一致：只核销编号或发票号与收付款单原始单据编号一致的结算单')
+    partner_ids = fields.Many2many('partner', string=u'业务伙伴',
+                                   help=u'为空时核销所有业务伙伴')
+    date = fields.Date(string=u'核销日期', required=True,
+                       default=lambda self: fields.Date.context_today(self),
+                       help=u'生成的核销单的单据日期')
+
+    @api.multi
+    def button_auto_reconcile(self):
+        ''' 自动核销，完成后打开生成的核销单 '''
+        self.ensure_one()
+        orders = self.env['reconcile.order'].auto_reconcile(
+            way=self.way, strategy=self.strategy,
+            partner_ids=self.partner_ids.ids, date=self.date)
+
+        return {
+            'name': u'自动核销',
+            'type': 'ir.actions.act_window',
+            'res_model': 'reconcile.order',
+            'view_type': 'form',
+            'view_mode': 'tree,form',
+            'domain': [('id', 'in', orders.ids)],
+        }
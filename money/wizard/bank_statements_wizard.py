@@ -24,16 +24,36 @@ class partner_statements_report_wizard(models.Model):
         if self.from_date > self.to_date:
             raise UserError(u'结束日期不能小于开始日期！')
 
-        view = self.env.ref('money.bank_statements_report_tree')
+        # 日期范围模式：期初余额从快照算出，范围内的明细行和余额一次查出，生成报表明细
+        line_obj = self.env['bank.statements.report.line']
+        opening, lines = self.env['bank.statements.report'].get_statement_lines(
+            self.bank_id.id, self.from_date, self.to_date)
+        line_ids = [line_obj.create({
+            'bank_id': self.bank_id.id,
+            'date': self.from_date,
+            'name': u'期初',
+            'balance': opening}).id]
+        for line in lines:
+            line_ids.append(line_obj.create({
+                'bank_id': line['bank_id'],
+                'date': line['date'],
+                'name': line['name'],
+                'get': line['get'],
+                'pay': line['pay'],
+                'balance': line['balance'],
+                'partner_id': line['partner_id'],
+                'note': line['note']}).id)
+
+        view = self.env.ref('money.bank_statements_report_line_tree')
 
         return {
                 'name': u'现金银行报表:' + self.bank_id.name,
                 'view_type': 'form',
                 'view_mode': 'tree',
-                'res_model': 'bank.statements.report',
+                'res_model': 'bank.statements.report.line',
                 'view_id': False,
                 'views': [(view.id, 'tree')],
                 'limit': 65535,
                 'type': 'ir.actions.act_window',
-                'domain':[('bank_id', '=', self.bank_id.id), ('date', '>=', self.from_date), ('date', '<=', self.to_date)]
+                'domain': [('id', 'in', line_ids)]
                 }
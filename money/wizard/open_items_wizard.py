@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import odoo.addons.decimal_precision as dp
+from odoo.exceptions import UserError
+from odoo import fields, models, api
+
+
+class open_items_wizard(models.TransientModel):
+    _name = 'open.items.wizard'
+    _description = u'选择结算单向导'
+
+    @api.model
+    def _get_default_way(self):
+        ''' 收付款单按类型，核销单按业务类型确定带出应收还是应付结算单 '''
+        order = self._get_order()
+        if not order:
+            return 'income'
+        if order._name == 'money.order':
+            return order.type == 'pay' and 'expense' or 'income'
+        if order.business_type in ('adv_get_to_pay', 'pay_to_pay'):
+            return 'expense'
+        return 'income'
+
+    way = fields.Selection([
+        ('income', u'应收结算单'),
+        ('expense', u'应付结算单'),
+    ], string=u'结算单类型', required=True, default=_get_default_way,
+        help=u'要添加的结算单类型，收付款单上不能修改')
+    date_from = fields.Date(string=u'开始日期',
+                            help=u'只添加该日期之后(含)的结算单')
+    date_to = fields.Date(string=u'结束日期',
+                          help=u'只添加该日期之前(含)的结算单')
+    amount_min = fields.Float(string=u'最小未核销金额',
+                              digits=dp.get_precision('Amount'),
+                              help=u'只添加未核销金额不小于该金额的结算单')
+    amount_max = fields.Float(string=u'最大未核销金额',
+                              digits=dp.get_precision('Amount'),
+                              help=u'只添加未核销金额不大于该金额的结算单')
+    reference = fields.Char(string=u'单据编号',
+                            help=u'按结算单编号或发票号模糊查询')
+    limit = fields.Integer(string=u'添加张数', default=200,
+                           help=u'按日期先后最多添加的结算单张数，为0时添加全部')
+    item_count = fields.Integer(string=u'符合条件张数', compute='_compute_summary',
+                                help=u'符合条件的未核销结算单张数')
+    item_to_reconcile = fields.Float(string=u'符合条件未核销金额', compute='_compute_summary',
+                                     digits=dp.get_precision('Amount'),
+                                     help=u'符合条件的未核销结算单的未核销金额合计')
+
+    @api.model
+    def _get_order(self):
+        ''' 向导的单据取自上下文中的active_model和active_id '''
+        model = self.env.context.get('active_model')
+        if model not in ('money.order', 'reconcile.order'):
+            return None
+
+        return self.env[model].browse(self.env.context.get('active_id'))
+
+    @api.multi
+    def _get_filters(self):
+        return {
+            'date_from': self.date_from,
+            'date_to': self.date_to,
+            'amount_min': self.amount_min,
+            'amount_max': self.amount_max,
+            'reference': self.reference,
+        }
+
+    @api.one
+    @api.depends('way', 'date_from', 'date_to', 'amount_min', 'amount_max', 'reference')
+    def _compute_summary(self):
+        order = self._get_order()
+        if not order:
+            return
+        summary = self.env['money.invoice'].get_open_items_summary(
+            order.partner_id.id, self.way, self._get_filters())
+        self.item_count = summary['count']
+        self.item_to_reconcile = summary['to_reconcile']
+
+    @api.multi
+    def button_add_items(self):
+        ''' 把符合条件的结算单添加到单据上 '''
+        self.ensure_one()
+        order = self._get_order()
+        if not order:
+            raise UserError(u'只能在收付款单或核销单上选择结算单')
+        if order._name == 'money.order':
+            order.add_open_items(self._get_filters(), self.limit or None)
+        else:
+            order.add_open_items(self.way, self._get_filters(), self.limit or None)
+
+        return True
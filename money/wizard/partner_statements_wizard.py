@@ -20,19 +20,83 @@ class partner_statements_report_wizard(models.TransientModel):
                           help=u'查看本次报表的结束日期')  # 默认当前日期
 
     @api.multi
-    def partner_statements_without_goods(self):
-        # 业务伙伴对账单: 不带商品明细
+    def _create_statement_lines(self, with_goods=False):
+        '''
+        日期范围模式生成对账单明细，第一行为期初余额，期初余额从快照算出，范围内的明细行和余额一次查出；
+        with_goods为True时在每张出入库单据下面列出商品明细，返回生成的明细id
+        '''
         if self.from_date > self.to_date:
             raise UserError(u'结束日期不能小于开始日期！')
 
+        is_customer = bool(self._context.get('default_customer'))
+        report_model = is_customer and 'customer.statements.report' or 'supplier.statements.report'
+        line_obj = self.env[report_model + '.with.goods']
+        opening, lines = self.env[report_model].get_statement_lines(
+            self.partner_id.id, self.from_date, self.to_date)
+
+        res_ids = [line_obj.create({
+            'partner_id': self.partner_id.id,
+            'date': self.from_date,
+            'name': u'期初',
+            'balance_amount': opening}).id]
+        for line in lines:
+            vals = {
+                'partner_id': line['partner_id'],
+                'name': line['name'],
+                'date': line['date'],
+                'done_date': line['done_date'],
+                'order_amount': line[is_customer and 'sale_amount' or 'purchase_amount'],
+                'benefit_amount': line['benefit_amount'],
+                'amount': line['amount'],
+                'pay_amount': line['pay_amount'],
+                'discount_money': line['discount_money'],
+                'balance_amount': line['balance_amount'],
+                'note': line['note'],
+                'move_id': line['move_id'] or False}
+            if is_customer:
+                vals['fee'] = line['fee']
+            res_ids.append(line_obj.create(vals).id)
+
+            if not with_goods or not line['move_id']:
+                continue
+            # 销售退货单、采购入库单取入库明细，销售发货单、采购退货单取出库明细
+            move = self.env['wh.move'].browse(line['move_id'])
+            if (line['amount'] < 0) == is_customer:
+                goods_lines = move.line_in_ids
+            else:
+                goods_lines = move.line_out_ids
+            for goods_line in goods_lines:
+                res_ids.append(line_obj.create({
+                        'goods_code': goods_line.goods_id.code,
+                        'goods_name': goods_line.goods_id.name,
+                        'attribute_id': goods_line.attribute_id.id,
+                        'uom_id': goods_line.uom_id.id,
+                        'quantity': goods_line.goods_qty,
+                        'price': goods_line.price,
+                        'discount_amount': goods_line.discount_amount,
+                        'without_tax_amount': goods_line.amount,
+                        'tax_amount': goods_line.tax_amount,
+                        'order_amount': goods_line.subtotal,
+                        'balance_amount': line['balance_amount']
+                        }).id)
+
+        return res_ids
+
+    @api.multi
+    def _get_statement_action(self, res_ids, with_goods=False):
+        ''' 打开生成的对账单明细 '''
         if self._context.get('default_customer'):  # 客户
-            view = self.env.ref('sell.customer_statements_report_tree')
+            view = self.env.ref(with_goods and 'sell.customer_statements_report_with_goods_tree'
+                                or 'sell.customer_statements_report_without_goods_tree')
             name = u'客户对账单:' + self.partner_id.name
-            res_model = 'customer.statements.report'
+            res_model = 'customer.statements.report.with.goods'
+            context = {'is_customer': True, 'is_supplier': False}
         else:  # 供应商
-            view = self.env.ref('buy.supplier_statements_report_tree')
+            view = self.env.ref(with_goods and 'buy.supplier_statements_report_with_goods_tree'
+                                or 'buy.supplier_statements_report_without_goods_tree')
             name = u'供应商对账单:' + self.partner_id.name
-            res_model = 'supplier.statements.report'
+            res_model = 'supplier.statements.report.with.goods'
+            context = {'is_customer': False, 'is_supplier': True}
 
         return {
                 'name': name,
@@ -43,151 +107,19 @@ class partner_statements_report_wizard(models.TransientModel):
                 'views': [(view.id, 'tree')],
                 'limit': 65535,
                 'type': 'ir.actions.act_window',
-                'domain':[('partner_id', '=', self.partner_id.id), ('date', '>=', self.from_date), ('date', '<=', self.to_date)]
+                'domain': [('id', 'in', res_ids)],
+                'context': context,
                 }
 
+    @api.multi
+    def partner_statements_without_goods(self):
+        # 业务伙伴对账单: 不带商品明细
+        return self._get_statement_action(self._create_statement_lines())
+
     @api.multi
     def partner_statements_with_goods(self):
         # 业务伙伴对账单: 带商品明细
-        res_ids = []
-        if self.from_date > self.to_date:
-            raise UserError(u'结束日期不能小于开始日期！')
-
-        if self._context.get('default_customer'):  # 客户
-            reports = self.env['customer.statements.report'].search([('partner_id', '=', self.partner_id.id),
-                                                                    ('date', '>=', self.from_date),
-                                                                    ('date', '<=', self.to_date)])
-            for report in reports:
-                # 生成带商品明细的对账单记录
-                res_ids.append(self.env['customer.statements.report.with.goods'].create({
-                        'partner_id': report.partner_id.id,
-                        'name': report.name,
-                        'date': report.date,
-                        'done_date': report.done_date,
-                        'order_amount': report.sale_amount,
-                        'benefit_amount': report.benefit_amount,
-                        'fee': report.fee,
-                        'amount': report.amount,
-                        'pay_amount': report.pay_amount,
-                        'discount_money': report.discount_money,
-                        'balance_amount': report.balance_amount,
-                        'note': report.note,
-                        'move_id': report.move_id.id}).id)
-
-                # 生成带商品明细的对账单记录
-                if report.move_id:
-                    if report.amount < 0: # 销售退货单
-                        for line in report.move_id.line_in_ids:
-                            res_ids.append(self.env['customer.statements.report.with.goods'].create({
-                                    'goods_code': line.goods_id.code,
-                                    'goods_name': line.goods_id.name,
-                                    'attribute_id': line.attribute_id.id,
-                                    'uom_id': line.uom_id.id,
-                                    'quantity': line.goods_qty,
-                                    'price': line.price,
-                                    'discount_amount': line.discount_amount,
-                                    'without_tax_amount': line.amount,
-                                    'tax_amount': line.tax_amount,
-                                    'order_amount': line.subtotal,
-                                    'balance_amount': report.balance_amount
-                                    }).id)
-                    else:
-                        for line in report.move_id.line_out_ids: # 销售发货单
-                            res_ids.append(self.env['customer.statements.report.with.goods'].create({
-                                    'goods_code': line.goods_id.code,
-                                    'goods_name': line.goods_id.name,
-                                    'attribute_id': line.attribute_id.id,
-                                    'uom_id': line.uom_id.id,
-                                    'quantity': line.goods_qty,
-                                    'price': line.price,
-                                    'discount_amount': line.discount_amount,
-                                    'without_tax_amount': line.amount,
-                                    'tax_amount': line.tax_amount,
-                                    'order_amount': line.subtotal,
-                                    'balance_amount': report.balance_amount
-                                    }).id)
-
-            view = self.env.ref('sell.customer_statements_report_with_goods_tree')
-
-            return {
-                    'name': u'客户对账单:' + self.partner_id.name,
-                    'view_type': 'form',
-                    'view_mode': 'tree',
-                    'res_model': 'customer.statements.report.with.goods',
-                    'view_id': False,
-                    'views': [(view.id, 'tree')],
-                    'limit': 65535,
-                    'type': 'ir.actions.act_window',
-                    'domain':[('id', 'in', res_ids)],
-                    'context': {'is_customer': True, 'is_supplier': False},
-                    }
-        else:  # 供应商
-            reports = self.env['supplier.statements.report'].search([('partner_id', '=', self.partner_id.id),
-                                                                    ('date', '>=', self.from_date),
-                                                                    ('date', '<=', self.to_date)])
-            for report in reports:
-                # 生成带商品明细的对账单记录
-                res_ids.append(self.env['supplier.statements.report.with.goods'].create({
-                        'partner_id': report.partner_id.id,
-                        'name': report.name,
-                        'date': report.date,
-                        'done_date': report.done_date,
-                        'order_amount': report.purchase_amount,
-                        'benefit_amount': report.benefit_amount,
-                        'amount': report.amount,
-                        'pay_amount': report.pay_amount,
-                        'discount_money': report.discount_money,
-                        'balance_amount': report.balance_amount,
-                        'note': report.note,
-                        'move_id': report.move_id.id}).id)
-
-                # 生成带商品明细的对账单记录
-                if report.move_id:
-                    if report.amount < 0: # 采购退货单
-                        for line in report.move_id.line_out_ids:
-                            res_ids.append(self.env['supplier.statements.report.with.goods'].create({
-                                    'goods_code': line.goods_id.code,
-                                    'goods_name': line.goods_id.name,
-                                    'attribute_id': line.attribute_id.id,
-                                    'uom_id': line.uom_id.id,
-                                    'quantity': line.goods_qty,
-                                    'price': line.price,
-                                    'discount_amount': line.discount_amount,
-                                    'without_tax_amount': line.amount,
-                                    'tax_amount': line.tax_amount,
-                                    'order_amount': line.subtotal,
-                                    'balance_amount': report.balance_amount
-                                    }).id)
-                    else: # 采购入库单
-                        for line in report.move_id.line_in_ids:
-                            res_ids.append(self.env['supplier.statements.report.with.goods'].create({
-                                    'goods_code': line.goods_id.code,
-                                    'goods_name': line.goods_id.name,
-                                    'attribute_id': line.attribute_id.id,
-                                    'uom_id': line.uom_id.id,
-                                    'quantity': line.goods_qty,
-                                    'price': line.price,
-                                    'discount_amount': line.discount_amount,
-                                    'without_tax_amount': line.amount,
-                                    'tax_amount': line.tax_amount,
-                                    'order_amount': line.subtotal,
-                                    'balance_amount': report.balance_amount
-                                    }).id)
-
-            view = self.env.ref('buy.supplier_statements_report_with_goods_tree')
-
-            return {
-                    'name': u'供应商对账单:' + self.partner_id.name,
-                    'view_type': 'form',
-                    'view_mode': 'tree',
-                    'res_model': 'supplier.statements.report.with.goods',
-                    'view_id': False,
-                    'views': [(view.id, 'tree')],
-                    'limit': 65535,
-                    'type': 'ir.actions.act_window',
-                    'domain':[('id', 'in', res_ids)],
-                    'context': {'is_customer': False, 'is_supplier': True},
-                    }
+        return self._get_statement_action(self._create_statement_lines(with_goods=True), with_goods=True)
 
     @api.onchange('from_date')
     def onchange_from_date(self):
@@ -9,6 +9,8 @@ class sell_summary_partner(models.Model):
     _name = 'sell.summary.partner'
     _inherit = 'report.base'
     _description = u'销售汇总表（按客户）'
+    _order = 'partner ASC'
+    _sql_pushdown = True
 
     id_lists = fields.Text(u'移动明细行id列表')
     c_category = fields.Char(u'客户类别')
@@ -124,10 +126,6 @@ class sell_summary_partner(models.Model):
                 context.get('warehouse_id')[0] or '',
         }
 
-    def _compute_order(self, result, order):
-        order = order or 'partner ASC'
-        return super(sell_summary_partner, self)._compute_order(result, order)
-
     def collect_data_by_sql(self, sql_type='out'):
         collection = self.execute_sql(sql_type='out')
 
@@ -9,6 +9,8 @@ class sell_summary_staff(models.Model):
     _name = 'sell.summary.staff'
     _inherit = 'report.base'
     _description = u'销售汇总表（按销售人员）'
+    _order = 'staff ASC'
+    _sql_pushdown = True
 
     id_lists = fields.Text(u'移动明细行id列表')
     staff = fields.Char(u'销售人员')
@@ -124,10 +126,6 @@ class sell_summary_staff(models.Model):
                 context.get('warehouse_id')[0] or '',
         }
 
-    def _compute_order(self, result, order):
-        order = order or 'staff ASC'
-        return super(sell_summary_staff, self)._compute_order(result, order)
-
     def collect_data_by_sql(self, sql_type='out'):
         collection = self.execute_sql(sql_type='out')
 
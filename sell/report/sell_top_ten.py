@@ -8,6 +8,8 @@ class sell_top_ten(models.Model):
     _name = 'sell.top.ten'
     _inherit = 'report.base'
     _description = u'销量前十商品'
+    _order = 'qty DESC'
+    _sql_pushdown = True
 
     goods = fields.Char(u'商品名称')
     warehouse = fields.Char(u'仓库')
@@ -62,7 +62,14 @@ class test_customer_statements(TransactionCase):
     def test_customer_statements_find_source(self):
         '''查看客户对账单明细'''
         # 查看客户对账单明细不带商品明细
-        self.statement.partner_statements_without_goods()
+        action = self.statement.partner_statements_without_goods()
+        lines = self.env[action['res_model']].search(action['domain'], order='id')
+        # 第一行是期初余额，之后的余额在期初余额的基础上累计
+        self.assertEqual(lines[0].name, u'期初')
+        with self.assertRaises(UserError):
+            lines[0].find_source_order()
+        self.assertAlmostEqual(lines[-1].balance_amount, lines[0].balance_amount + sum(
+            line.amount - line.pay_amount - line.discount_money for line in lines[1:]))
         customer_statement = self.env['customer.statements.report'].search([])
         customer_statement_init = self.env['customer.statements.report'].search([('move_id', '=', False),
                                                                                  ('amount', '!=', 0)])
@@ -74,10 +81,11 @@ class test_customer_statements(TransactionCase):
             report.find_source_order()
 
         # 查看客户对账单带商品明细
-        self.statement.partner_statements_with_goods()
-        customer_statement_goods = self.env['customer.statements.report.with.goods'].search([('name', '!=', False)])
-        customer_statement_goods_init = self.env['customer.statements.report.with.goods'].search([('move_id', '=', False),
-                                                         ('amount', '!=', 0)])
+        action = self.statement.partner_statements_with_goods()
+        customer_statement_goods = self.env['customer.statements.report.with.goods'].search(
+            action['domain'] + [('name', '!=', False), ('name', '!=', u'期初')])
+        customer_statement_goods_init = self.env['customer.statements.report.with.goods'].search(
+            action['domain'] + [('move_id', '=', False), ('amount', '!=', 0)])
 
         # 如果对账单中是期初余额行，点击查看按钮应报错
         with self.assertRaises(UserError):
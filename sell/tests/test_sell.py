@@ -381,6 +381,16 @@ class test_sell_delivery(TransactionCase):
         delivery._get_sell_money_state()
         self.assertEqual(delivery.money_state, u'全部收款')
 
+    def test_auto_reconcile_money_state(self):
+        '''测试自动核销之后更新收款状态'''
+        self.delivery.sell_delivery_done()
+        self.assertEqual(self.delivery.money_state, u'未收款')
+
+        self.env['reconcile.order'].auto_reconcile(
+            'get', 'oldest', [self.delivery.partner_id.id])
+        self.assertEqual(self.delivery.invoice_id.to_reconcile, 0)
+        self.assertEqual(self.delivery.money_state, u'全部收款')
+
     def test_get_sell_return_state(self):
         '''测试返回退款状态'''
         #  未退款
@@ -6,5 +6,8 @@ import inventory
 import production
 import warehouse_move_line
 import move_matching
+import stock_layer
+import average_cost
+import stock_snapshot
 import wizard
 import report
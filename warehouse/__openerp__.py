@@ -47,6 +47,7 @@
         'action/warehouse_action.xml',
         'menu/warehouse_menu.xml',
         'data/sequence.xml',
+        'data/stock_snapshot_data.xml',
         'security/ir.model.access.csv',
         'home_page_data.xml'
     ],
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import odoo.addons.decimal_precision as dp
+from utils import safe_division
+from odoo import models, fields, api
+
+
+class wh_average_cost(models.Model):
+    '''
+    移动平均成本：按(产品, 仓库, 属性)保存库存类型仓库当前的结存数量和结存金额，
+    每一条已审核的单行只在审核和反审核的时候做一次加减，
+    公司的存货计价方法为移动平均法时，出库成本直接取 结存金额 / 结存数量
+    '''
+    _name = 'wh.average.cost'
+    _description = u'移动平均成本'
+
+    goods_id = fields.Many2one(
+        'goods', u'产品', required=True, ondelete='cascade',
+        help=u'结存对应的产品')
+    warehouse_id = fields.Many2one(
+        'warehouse', u'仓库', required=True, ondelete='cascade',
+        help=u'结存所在的仓库')
+    attribute_id = fields.Many2one(
+        'attribute', u'属性', ondelete='cascade',
+        help=u'结存对应的产品属性')
+    qty = fields.Float(
+        u'结存数量', digits=dp.get_precision('Quantity'),
+        help=u'当前的结存数量')
+    value = fields.Float(
+        u'结存金额', digits=dp.get_precision('Amount'),
+        help=u'当前的结存金额')
+
+    def init(self):
+        cr = self._cr
+        cr.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS wh_average_cost_key_index
+            ON wh_average_cost (goods_id, warehouse_id, COALESCE(attribute_id, 0))
+        ''')
+
+        # 安装模块时根据已经审核的单行初始化结存
+        cr.execute('SELECT 1 FROM wh_average_cost LIMIT 1')
+        if cr.fetchone():
+            return
+
+        cr.execute('''
+            INSERT INTO wh_average_cost (goods_id, warehouse_id, attribute_id, qty, value)
+            SELECT goods_id, warehouse_id, attribute_id, sum(qty), sum(value)
+            FROM (
+                SELECT line.goods_id, line.warehouse_dest_id AS warehouse_id,
+                       line.attribute_id, line.goods_qty AS qty, line.cost AS value
+                FROM wh_move_line line
+                JOIN warehouse wh ON line.warehouse_dest_id = wh.id
+                WHERE line.state = 'done' AND wh.type = 'stock'
+                UNION ALL
+                SELECT line.goods_id, line.warehouse_id AS warehouse_id,
+                       line.attribute_id, - line.goods_qty AS qty, - line.cost AS value
+                FROM wh_move_line line
+                JOIN warehouse wh ON line.warehouse_id = wh.id
+                WHERE line.state = 'done' AND wh.type = 'stock'
+            ) moves
+            GROUP BY goods_id, warehouse_id, attribute_id
+        ''')
+
+    @api.model
+    def update_average(self, goods, warehouse, attribute, qty, value):
+        ''' 在(产品, 仓库, 属性)的结存上加上qty数量和value金额 '''
+        if warehouse.type != 'stock' or not goods.is_using_matching():
+            return True
+
+        self.env.cr.execute('''
+            INSERT INTO wh_average_cost (goods_id, warehouse_id, attribute_id, qty, value)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (goods_id, warehouse_id, COALESCE(attribute_id, 0)) DO UPDATE
+            SET qty = wh_average_cost.qty + EXCLUDED.qty,
+                value = wh_average_cost.value + EXCLUDED.value
+        ''', (goods.id, warehouse.id, attribute.id or None, qty, value))
+        self.invalidate_cache()
+        self.env['goods'].invalidate_cost_quotes([(goods.id, warehouse.id)])
+
+        return True
+
+    @api.model
+    def apply_line(self, line, sign=1, qty=None, cost=None):
+        ''' 将单行的入库和出库计入结存，sign为-1时冲回 '''
+        qty = line.goods_qty if qty is None else qty
+        cost = line.cost if cost is None else cost
+
+        self.update_average(line.goods_id, line.warehouse_dest_id,
+                            line.attribute_id, sign * qty, sign * cost)
+        self.update_average(line.goods_id, line.warehouse_id,
+                            line.attribute_id, - sign * qty, - sign * cost)
+
+        return True
+
+    @api.model
+    def get_average(self, goods, warehouse, attribute=None):
+        ''' 返回结存(数量, 金额)，没有指定属性的时候汇总该产品所有属性的结存 '''
+        where, params = 'goods_id = %s AND warehouse_id = %s', [goods.id, warehouse.id]
+        if attribute:
+            where += ' AND attribute_id = %s'
+            params.append(attribute.id)
+
+        self.env.cr.execute('''
+            SELECT COALESCE(sum(qty), 0), COALESCE(sum(value), 0)
+            FROM wh_average_cost
+            WHERE %s
+        ''' % where, params)
+
+        return self.env.cr.fetchone()
+
+    @api.model
+    def get_cost(self, goods, warehouse, qty, attribute=None, ignore=None):
+        '''
+        按照移动平均法计算出库成本，返回(成本, 单位成本)，没有结存的时候返回None
+        @ignore: 一个move_line列表，计算成本的时候把这些已审核单行的影响从结存中去掉
+        '''
+        stock_qty, stock_value = self.get_average(goods, warehouse, attribute=attribute)
+        if ignore:
+            for line in self.env['wh.move.line'].browse(ignore):
+                if line.state != 'done' or line.goods_id != goods or \
+                        (attribute and line.attribute_id != attribute):
+                    continue
+
+                if line.warehouse_dest_id == warehouse:
+                    stock_qty, stock_value = stock_qty - line.goods_qty, stock_value - line.cost
+                if line.warehouse_id == warehouse:
+                    stock_qty, stock_value = stock_qty + line.goods_qty, stock_value + line.cost
+
+        if stock_qty <= 0:
+            return None
+
+        cost_unit = safe_division(stock_value, stock_qty)
+        return cost_unit * qty, cost_unit
+
+    @api.model
+    def revaluate(self, line):
+        '''
+        单行反审核之后，按照审核时间重新计算该单行之后同一(产品, 仓库, 属性)上出库单行的成本，
+        只需要重放该单行之后的单行，不需要从头计算整个历史
+        '''
+        if line.goods_id.get_cost_method() != 'average' or not line.cost_time:
+            return True
+
+        line_obj = self.env['wh.move.line']
+        for warehouse in (line.warehouse_id, line.warehouse_dest_id):
+            if warehouse.type != 'stock':
+                continue
+
+            later_lines = line_obj.search([
+                ('state', '=', 'done'),
+                ('goods_id', '=', line.goods_id.id),
+                ('attribute_id', '=', line.attribute_id.id),
+                '|', ('warehouse_id', '=', warehouse.id),
+                ('warehouse_dest_id', '=', warehouse.id),
+                '|', ('cost_time', '>', line.cost_time),
+                '&', ('cost_time', '=', line.cost_time), ('id', '>', line.id),
+            ], order='cost_time, id')
+            if not later_lines:
+                continue
+
+            self.env.cr.execute('''
+                SELECT qty, value FROM wh_average_cost
+                WHERE goods_id = %s AND warehouse_id = %s
+                  AND COALESCE(attribute_id, 0) = %s
+            ''', (line.goods_id.id, warehouse.id, line.attribute_id.id or 0))
+            stock_qty, stock_value = self.env.cr.fetchone() or (0, 0)
+
+            # 先从当前结存中去掉后续单行的影响，得到反审核单行审核时的结存，再依次重放后续单行
+            for later in later_lines:
+                tag = later.warehouse_dest_id == warehouse and 1 or -1
+                stock_qty -= tag * later.goods_qty
+                stock_value -= tag * later.cost
+
+            for later in later_lines:
+                if later.warehouse_dest_id == warehouse:
+                    stock_qty += later.goods_qty
+                    stock_value += later.cost
+                    continue
+
+                cost = later.cost
+                if stock_qty > 0 and not later.goods_id.is_using_batch():
+                    cost = safe_division(stock_value, stock_qty) * later.goods_qty
+                    if abs(cost - later.cost) > 1e-6:
+                        # 单行的write会把成本的差额同步计入结存
+                        later.write({'cost': cost})
+
+                stock_qty -= later.goods_qty
+                stock_value -= cost
+
+        return True
+
+
+class wh_move_line(models.Model):
+    _inherit = 'wh.move.line'
+
+    @api.multi
+    def write(self, vals):
+        if not any(field in vals for field in ('state', 'cost', 'cost_unit')):
+            return super(wh_move_line, self).write(vals)
+
+        done_costs = {line.id: line.cost for line in self if line.state == 'done'}
+        res = super(wh_move_line, self).write(vals)
+
+        average_obj = self.env['wh.average.cost']
+        for line in self:
+            if line.id not in done_costs:
+                if line.state == 'done':
+                    average_obj.apply_line(line)
+            elif line.state != 'done':
+                # 反审核时冲回该单行，并重新计算其后出库单行的成本
+                average_obj.apply_line(line, sign=-1, cost=done_costs.get(line.id))
+                average_obj.revaluate(line)
+            elif line.cost != done_costs.get(line.id):
+                average_obj.apply_line(line, qty=0, cost=line.cost - done_costs.get(line.id))
+
+        return res
+
+    def get_average_cost(self, cost):
+        '''
+        公司使用移动平均法时，出库单行的成本取结存的平均成本，否则返回先进先出计算的成本；
+        移动平均法下出库仍然要和入库匹配：入库单行的qty_remaining由匹配记录得出，
+        库存余额表、盘点、呆滞料报表和库存数量都按qty_remaining统计，只是成本不再取匹配的结果
+        '''
+        self.ensure_one()
+        if self.goods_id.get_cost_method() == 'average' and not self.goods_id.is_using_batch():
+            average = self.env['wh.average.cost'].get_cost(
+                self.goods_id, self.warehouse_id, self.goods_qty,
+                attribute=self.attribute_id)
+            if average:
+                return average[0]
+
+        return cost
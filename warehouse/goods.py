@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from odoo.osv import osv
-from utils import safe_division
+from utils import safe_division, iter_buffered
 from odoo.exceptions import UserError
 from odoo import models, fields, api
 
@@ -53,15 +53,81 @@ class goods(models.Model):
 
         return self.cost
 
+    def _get_cost_quote_cache(self, warehouse):
+        # 成本报价缓存保存在当前数据库游标上，按(产品id, 仓库id)分组，事务提交或者回滚之后整体失效
+        cr = self.env.cr
+        cache = getattr(cr, '_cost_quote_cache', None)
+        if cache is None:
+            cache = cr._cost_quote_cache = {}
+
+            def clear_cache():
+                cr._cost_quote_cache = None
+
+            cr.after('commit', clear_cache)
+            cr.after('rollback', clear_cache)
+
+        return cache.setdefault((self.id, warehouse.id), {})
+
+    @api.model
+    def invalidate_cost_quotes(self, keys):
+        # 库存层或者移动平均结存发生变化时，清除对应(产品id, 仓库id)的成本报价缓存
+        cache = getattr(self.env.cr, '_cost_quote_cache', None)
+        if cache:
+            for key in keys:
+                cache.pop(tuple(key), None)
+
+        return True
+
+    def _quote_matching_records(self, warehouse, qty, attribute=None, ignore=None):
+        # 同一事务中对同一(产品, 仓库, 属性)的多次报价共用已经读取过的库存层，
+        # 任意数量的报价都只在缓存的库存层不够时才继续查询数据库
+        quotes = self._get_cost_quote_cache(warehouse)
+        key = ('fifo', attribute and attribute.id, tuple(sorted(ignore or [])))
+        if key not in quotes:
+            quotes[key] = ([], self._get_matching_lines(
+                warehouse, attribute=attribute, ignore=ignore))
+
+        buffered, layers = quotes[key]
+        matching_records, cost, _ = self._allocate_layers(
+            iter_buffered(buffered, layers), qty)
+
+        return matching_records, cost
+
+    def _quote_cost_unit(self, warehouse, attribute=None, ignore=None):
+        # 移动平均单位成本和最后一次入库的单位成本同样按事务缓存
+        quotes = self._get_cost_quote_cache(warehouse)
+        ignore_key = tuple(sorted(ignore or []))
+        if self.get_cost_method() == 'average':
+            key = ('average', attribute and attribute.id, ignore_key)
+            if key not in quotes:
+                quotes[key] = self.env['wh.average.cost'].get_cost(
+                    self, warehouse, 1, attribute=attribute, ignore=ignore)
+
+            if quotes[key]:
+                return quotes[key][1]
+
+        key = ('last', ignore_key)
+        if key not in quotes:
+            quotes[key] = self._get_cost(warehouse, ignore=ignore)
+
+        return quotes[key]
+
     def get_suggested_cost_by_warehouse(
             self, warehouse, qty, lot_id=None, attribute=None, ignore_move=None):
         # 存在一种情况，计算一条line的成本的时候，先done掉该line，之后在通过该函数
         # 查询成本，此时百分百搜到当前的line，所以添加ignore参数来忽略掉指定的line
+        if ignore_move and isinstance(ignore_move, (long, int)):
+            ignore_move = [ignore_move]
+
+        if not lot_id and self.get_cost_method() == 'average':
+            cost_unit = self._quote_cost_unit(warehouse, attribute=attribute, ignore=ignore_move)
+            return cost_unit * qty, cost_unit
+
         if lot_id:
             records, cost = self.get_matching_records_by_lot(lot_id, qty, suggested=True)
         else:
-            records, cost = self.get_matching_records(
-                warehouse, qty, attribute=attribute, ignore_stock=True, ignore=ignore_move)
+            records, cost = self._quote_matching_records(
+                warehouse, qty, attribute=attribute, ignore=ignore_move)
 
         matching_qty = sum(record.get('qty') for record in records)
         if matching_qty:
@@ -69,9 +135,34 @@ class goods(models.Model):
             if matching_qty >= qty:
                 return cost, cost_unit
         else:
-            cost_unit = self._get_cost(warehouse, ignore=ignore_move)
+            cost_unit = self._quote_cost_unit(warehouse, ignore=ignore_move)
         return cost_unit * qty, cost_unit
 
+    @api.model
+    def quote_costs(self, quotes):
+        '''
+        批量报价：quotes为[{'goods_id': , 'warehouse_id': , 'qty': , 'attribute_id': , 'lot_id': }]，
+        一次调用返回所有单行的[(成本, 单位成本)]，同一(产品, 仓库)的单行共用缓存的库存层
+        '''
+        res = []
+        for quote in quotes:
+            goods = self.browse(quote.get('goods_id'))
+            warehouse = self.env['warehouse'].browse(quote.get('warehouse_id'))
+            if not goods or not warehouse or not quote.get('qty'):
+                res.append((0, 0))
+                continue
+
+            res.append(goods.get_suggested_cost_by_warehouse(
+                warehouse, quote.get('qty'),
+                lot_id=self.env['wh.move.line'].browse(quote.get('lot_id')),
+                attribute=self.env['attribute'].browse(quote.get('attribute_id'))))
+
+        return res
+
+    def get_cost_method(self):
+        # 存货计价方法取自当前用户所在公司，没有设置的时候使用先进先出法
+        return self.env.user.company_id.cost_method or 'fifo'
+
     def is_using_matching(self):
         if self.no_stock:
             return False
@@ -95,47 +186,83 @@ class goods(models.Model):
         return [{'line_in_id': lot_id.id, 'qty': qty, 'uos_qty': uos_qty}], \
             lot_id.get_real_cost_unit() * qty
 
-    def get_matching_records(self, warehouse, qty, uos_qty=0,
-                             attribute=None, ignore_stock=False, ignore=None):
-        # @ignore_stock: 当参数指定为True的时候，此时忽略库存警告
-        # @ignore: 一个move_line列表，指定查询成本的时候跳过这些move
+    def _get_matching_lines(self, warehouse, attribute=None, ignore=None):
+        # 库存类型仓库的入库行直接从库存层中按先进先出的顺序读取，其他仓库才回退到全量搜索
+        self.ensure_one()
+        if warehouse.type == 'stock':
+            return self.env['wh.stock.layer'].iter_layers(
+                self, warehouse, attribute=attribute, ignore=ignore)
+
+        domain = [
+            ('qty_remaining', '>', 0),
+            ('state', '=', 'done'),
+            ('warehouse_dest_id', '=', warehouse.id),
+            ('goods_id', '=', self.id)
+        ]
+        if ignore:
+            domain.append(('id', 'not in', ignore))
+
+        if attribute:
+            domain.append(('attribute_id', '=', attribute.id))
+
+        return ({
+            'line_id': line.id,
+            'qty_remaining': line.qty_remaining,
+            'uos_qty_remaining': line.uos_qty_remaining,
+            'cost_unit': line.get_real_cost_unit(),
+        } for line in self.env['wh.move.line'].search(domain, order='cost_time, id'))
+
+    def _allocate_layers(self, layers, qty, uos_qty=0, consumed=None):
+        # 按先进先出的顺序在layers上分配出库数量，返回匹配记录、成本以及未分配的数量
+        # @consumed: {入库行id: [数量, 辅助数量]}，记录已经被同一批出库行分配掉但还没有写入数据库的数量
         matching_records = []
-        for goods in self:
-            domain = [
-                ('qty_remaining', '>', 0),
-                ('state', '=', 'done'),
-                ('warehouse_dest_id', '=', warehouse.id),
-                ('goods_id', '=', goods.id)
-            ]
-            if ignore:
-                if isinstance(ignore, (long, int)):
-                    ignore = [ignore]
+        qty_to_go, uos_qty_to_go, cost = qty, uos_qty, 0
+        for line in layers:
+            if qty_to_go <= 0 and uos_qty_to_go <= 0:
+                break
 
-                domain.append(('id', 'not in', ignore))
+            qty_remaining = line.get('qty_remaining')
+            uos_qty_remaining = line.get('uos_qty_remaining')
+            if consumed is not None:
+                used = consumed.setdefault(line.get('line_id'), [0, 0])
+                qty_remaining -= used[0]
+                uos_qty_remaining -= used[1]
+                if qty_remaining <= 0:
+                    continue
 
-            if attribute:
-                domain.append(('attribute_id', '=', attribute.id))
+            matching_qty = min(qty_remaining, qty_to_go)
+            matching_uos_qty = qty_remaining == qty_to_go and \
+                uos_qty_to_go or uos_qty_remaining
 
-            # TODO @zzx需要在大量数据的情况下评估一下速度
-            lines = self.env['wh.move.line'].search(domain, order='cost_time, id')
+            matching_records.append({'line_in_id': line.get('line_id'),
+                                     'qty': matching_qty, 'uos_qty': matching_uos_qty})
 
-            qty_to_go, uos_qty_to_go, cost = qty, uos_qty, 0
-            for line in lines:
-                if qty_to_go <= 0 and uos_qty_to_go <= 0:
-                    break
+            if consumed is not None:
+                used[0] += matching_qty
+                used[1] += matching_uos_qty
 
-                matching_qty = min(line.qty_remaining, qty_to_go)
-                matching_uos_qty = line.qty_remaining == qty_to_go and \
-                    uos_qty_to_go or line.uos_qty_remaining
+            cost += matching_qty * line.get('cost_unit')
+            qty_to_go -= matching_qty
+            uos_qty_to_go -= matching_uos_qty
 
-                matching_records.append({'line_in_id': line.id,
-                                         'qty': matching_qty, 'uos_qty': matching_uos_qty})
+        return matching_records, cost, qty_to_go
 
-                cost += matching_qty * line.get_real_cost_unit()
-                qty_to_go -= matching_qty
-                uos_qty_to_go -= matching_uos_qty
-            else:
-                if not ignore_stock and qty_to_go > 0:
-                    raise UserError(u'产品%s的库存数量不够本次出库行为' % (goods.name,))
+    def get_matching_records(self, warehouse, qty, uos_qty=0,
+                             attribute=None, ignore_stock=False, ignore=None):
+        # @ignore_stock: 当参数指定为True的时候，此时忽略库存警告
+        # @ignore: 一个move_line列表，指定查询成本的时候跳过这些move
+        if ignore and isinstance(ignore, (long, int)):
+            ignore = [ignore]
+
+        for goods in self:
+            lines = goods._get_matching_lines(
+                warehouse, attribute=attribute, ignore=ignore)
+
+            matching_records, cost, qty_to_go = goods._allocate_layers(
+                lines, qty, uos_qty)
+            if not ignore_stock and qty_to_go > 0:
+                raise UserError(u'产品%s的库存数量不够本次出库行为' % (goods.name,))
 
             return matching_records, cost
+
+        return [], 0
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from odoo.osv import osv
+from collections import OrderedDict
 import odoo.addons.decimal_precision as dp
-from utils import safe_division
+from utils import safe_division, iter_buffered
 from odoo import models, fields, api
 from odoo.exceptions import UserError
 
@@ -26,6 +27,76 @@ class wh_move_matching(models.Model):
         digits=dp.get_precision('Quantity'), required=True,
         help=u'出库单行产品的辅助数量')
 
+    @api.model
+    def update_qty_remaining(self, matching_records, sign=-1):
+        '''
+        增量维护入库单行上的剩余数量：将匹配记录的数量按入库单行汇总之后，
+        用一条UPDATE直接加到(sign=1)或者扣减(sign=-1)入库单行的qty_remaining/uos_qty_remaining上，
+        不再通过matching_in_ids重新读取所有匹配记录来计算
+        '''
+        deltas = OrderedDict()
+        for matching in matching_records:
+            if not matching.get('line_in_id'):
+                continue
+
+            delta = deltas.setdefault(matching.get('line_in_id'), [0, 0])
+            delta[0] += matching.get('qty') or 0
+            delta[1] += matching.get('uos_qty') or 0
+
+        if not deltas:
+            return True
+
+        params = []
+        for line_id, delta in deltas.iteritems():
+            params.extend([line_id, sign * delta[0], sign * delta[1]])
+
+        self.env.cr.execute('''
+            UPDATE wh_move_line line
+            SET qty_remaining = line.qty_remaining + delta.qty,
+                uos_qty_remaining = line.uos_qty_remaining + delta.uos_qty
+            FROM (VALUES %s) AS delta (id, qty, uos_qty)
+            WHERE line.id = delta.id
+        ''' % ', '.join(['(%s, %s::numeric, %s::numeric)'] * len(deltas)), params)
+
+        line_obj = self.env['wh.move.line']
+        line_obj.invalidate_cache(['qty_remaining', 'uos_qty_remaining', 'matching_in_ids'], deltas.keys())
+        line_obj.invalidate_cache(['matching_out_ids'])
+
+        return True
+
+    def _get_matching_values(self):
+        return [{
+            'line_in_id': matching.line_in_id.id,
+            'qty': matching.qty,
+            'uos_qty': matching.uos_qty,
+        } for matching in self]
+
+    @api.model
+    def create(self, vals):
+        matching = super(wh_move_matching, self).create(vals)
+        self.update_qty_remaining(matching._get_matching_values(), sign=-1)
+
+        return matching
+
+    @api.multi
+    def write(self, vals):
+        if not any(field in vals for field in ('line_in_id', 'qty', 'uos_qty')):
+            return super(wh_move_matching, self).write(vals)
+
+        self.update_qty_remaining(self._get_matching_values(), sign=1)
+        res = super(wh_move_matching, self).write(vals)
+        self.update_qty_remaining(self._get_matching_values(), sign=-1)
+
+        return res
+
+    @api.multi
+    def unlink(self):
+        matching_records = self._get_matching_values()
+        res = super(wh_move_matching, self).unlink()
+        self.update_qty_remaining(matching_records, sign=1)
+
+        return res
+
     def create_matching(self, line_in_id, line_out_id, qty, uos_qty):
         res = {
             'line_out_id': line_out_id,
@@ -36,6 +107,34 @@ class wh_move_matching(models.Model):
 
         return self.create(res)
 
+    @api.model
+    def create_matchings(self, matching_records):
+        '''
+        批量写入匹配记录，matching_records中每一项包含line_in_id、line_out_id、qty、uos_qty，
+        写入之后每个被匹配的入库单行的剩余数量只更新一次
+        '''
+        if not matching_records:
+            return self
+
+        params = []
+        for matching in matching_records:
+            params.extend([matching.get('line_in_id'), matching.get('line_out_id'),
+                           matching.get('qty'), matching.get('uos_qty'),
+                           self.env.uid, self.env.uid])
+
+        self.env.cr.execute('''
+            INSERT INTO wh_move_matching (line_in_id, line_out_id, qty, uos_qty,
+                create_uid, create_date, write_uid, write_date)
+            VALUES %s
+            RETURNING id
+        ''' % ', '.join(["(%s, %s, %s, %s, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')"] *
+                         len(matching_records)), params)
+        matchings = self.browse([row[0] for row in self.env.cr.fetchall()])
+
+        self.update_qty_remaining(matching_records, sign=-1)
+
+        return matchings
+
 
 class wh_move_line(models.Model):
     _inherit = 'wh.move.line'
@@ -59,29 +158,142 @@ class wh_move_line(models.Model):
         'wh.move.matching', 'line_out_id', string=u'关联的出库',
         help=u'关联的出库单行')
 
-    # 这样的function字段的使用方式需要验证一下
-    @api.one
-    @api.depends('goods_qty', 'matching_in_ids.qty', 'matching_in_ids.uos_qty')
+    # 剩余数量只在产品数量改变时整体重新计算，匹配记录的增删改由wh.move.matching增量维护
+    @api.multi
+    @api.depends('goods_qty', 'goods_uos_qty')
     def _get_qty_remaining(self):
-        self.qty_remaining = self.goods_qty - \
-            sum(match.qty for match in self.matching_in_ids)
-        self.uos_qty_remaining = self.goods_uos_qty - \
-            sum(match.uos_qty for match in self.matching_in_ids)
+        matched = {}
+        line_ids = [line.id for line in self if isinstance(line.id, (int, long))]
+        if line_ids:
+            self.env.cr.execute('''
+                SELECT line_in_id, sum(qty), sum(uos_qty)
+                FROM wh_move_matching
+                WHERE line_in_id IN %s
+                GROUP BY line_in_id
+            ''', (tuple(line_ids),))
+            matched = {line_id: (qty, uos_qty) for line_id, qty, uos_qty in self.env.cr.fetchall()}
+
+        for line in self:
+            qty, uos_qty = matched.get(line.id, (0, 0))
+            line.qty_remaining = line.goods_qty - qty
+            line.uos_qty_remaining = line.goods_uos_qty - uos_qty
+
+    @api.model
+    def check_qty_remaining(self, line_ids=None, fix=False):
+        '''
+        一致性检查：根据wh.move.matching重新推导所有(或者指定的)单行的剩余数量，
+        返回与数据库中保存的值不一致的单行id列表，fix为True时同时修正这些单行及其库存层
+        '''
+        where, params = '', []
+        if line_ids:
+            where, params = 'AND line.id IN %s', [tuple(line_ids)]
+
+        self.env.cr.execute('''
+            SELECT line.id,
+                   line.goods_qty - COALESCE(matched.qty, 0),
+                   line.goods_uos_qty - COALESCE(matched.uos_qty, 0)
+            FROM wh_move_line line
+            LEFT JOIN (SELECT line_in_id, sum(qty) AS qty, sum(uos_qty) AS uos_qty
+                       FROM wh_move_matching
+                       GROUP BY line_in_id) matched ON matched.line_in_id = line.id
+            WHERE (line.qty_remaining IS DISTINCT FROM
+                       line.goods_qty - COALESCE(matched.qty, 0)
+                   OR line.uos_qty_remaining IS DISTINCT FROM
+                       line.goods_uos_qty - COALESCE(matched.uos_qty, 0))
+              %s
+        ''' % where, params)
+        inconsistent = self.env.cr.fetchall()
+
+        if fix and inconsistent:
+            for line_id, qty_remaining, uos_qty_remaining in inconsistent:
+                self.env.cr.execute('''
+                    UPDATE wh_move_line
+                    SET qty_remaining = %s, uos_qty_remaining = %s
+                    WHERE id = %s
+                ''', (qty_remaining, uos_qty_remaining, line_id))
+
+            line_ids = [row[0] for row in inconsistent]
+            self.invalidate_cache(['qty_remaining', 'uos_qty_remaining'], line_ids)
+            self.env['wh.stock.layer'].sync_lines(line_ids)
+
+        return [row[0] for row in inconsistent]
+
+    # 这些字段改变的时候，需要同步入库单行对应的库存层
+    LAYER_FIELDS = ('state', 'cost', 'cost_unit', 'cost_time', 'goods_qty',
+                    'goods_uos_qty', 'attribute_id', 'warehouse_dest_id')
+
+    @api.multi
+    def write(self, vals):
+        res = super(wh_move_line, self).write(vals)
+        if any(field in vals for field in self.LAYER_FIELDS):
+            lines = 'state' in vals and self or \
+                self.filtered(lambda line: line.state == 'done')
+            self.env['wh.stock.layer'].sync_lines(lines.ids)
+
+        return res
+
+    def batch_matching(self):
+        '''
+        将出库单行按(产品, 仓库, 属性)分组，每组只读取一次库存层，
+        在内存中依次为每一行分配入库行之后批量写入匹配记录，返回已经完成匹配的出库单行
+        '''
+        groups, matched = OrderedDict(), self.browse()
+        for line in self:
+            if line.warehouse_id.type == 'stock' and \
+                    line.goods_id.is_using_matching() and \
+                    not line.goods_id.is_using_batch():
+                line.check_availability()
+                groups.setdefault((line.goods_id, line.warehouse_id, line.attribute_id), []).append(line)
+
+        matching_records, costs, consumed = [], [], {}
+        for (goods, warehouse, attribute), lines in groups.iteritems():
+            buffered = []
+            layers = goods._get_matching_lines(warehouse, attribute=attribute)
+            for line in lines:
+                records, cost, qty_to_go = goods._allocate_layers(
+                    iter_buffered(buffered, layers),
+                    line.goods_qty, line.goods_uos_qty, consumed=consumed)
+                if qty_to_go > 0:
+                    raise UserError(u'产品%s的库存数量不够本次出库行为' % (goods.name,))
+
+                for record in records:
+                    record['line_out_id'] = line.id
+
+                matching_records.extend(records)
+                costs.append((line, cost))
+                matched |= line
+
+        self.env['wh.move.matching'].create_matchings(matching_records)
+        self.env['wh.stock.layer'].consume(matching_records)
+        for line, cost in costs:
+            cost = line.get_average_cost(cost)
+            line.write({
+                'cost_unit': safe_division(cost, line.goods_qty),
+                'cost': cost,
+            })
+
+        return matched
+
+    @api.multi
+    def action_done(self):
+        matched = self.batch_matching()
+        return super(wh_move_line, self.with_context(
+            matched_line_ids=matched.ids)).action_done()
 
     def prev_action_done(self):
         matching_obj = self.env['wh.move.matching']
+        layer_obj = self.env['wh.stock.layer']
         for line in self:
+            # 已经在batch_matching中批量匹配过的出库单行不需要再次匹配
+            if line.id in self.env.context.get('matched_line_ids', []):
+                continue
+
             if line.warehouse_id.type == 'stock' and \
                     line.goods_id.is_using_matching():
                 if line.goods_id.is_using_batch():
                     matching_records, cost = \
                         line.goods_id.get_matching_records_by_lot(
                             self.lot_id, self.goods_qty, self.goods_uos_qty)
-                    for matching in matching_records:
-                        matching_obj.create_matching(
-                            matching.get('line_in_id'),
-                            line.id, matching.get('qty'),
-                            matching.get('uos_qty'))
                 else:
                     matching_records, cost = line.goods_id \
                         .get_matching_records(
@@ -89,12 +301,12 @@ class wh_move_line(models.Model):
                             uos_qty=line.goods_uos_qty,
                             attribute=line.attribute_id)
 
-                    for matching in matching_records:
-                        matching_obj.create_matching(
-                            matching.get('line_in_id'),
-                            line.id, matching.get('qty'),
-                            matching.get('uos_qty'))
+                for matching in matching_records:
+                    matching['line_out_id'] = line.id
 
+                matching_obj.create_matchings(matching_records)
+                layer_obj.consume(matching_records)
+                cost = line.get_average_cost(cost)
                 line.cost_unit = safe_division(cost, line.goods_qty)
                 line.cost = cost
 
@@ -105,7 +317,10 @@ class wh_move_line(models.Model):
             if line.qty_remaining != line.goods_qty:
                 raise UserError(u'当前的入库已经被其他出库匹配，请先取消相关的出库')
 
+            line_in_ids = [matching.line_in_id.id for matching in line.matching_out_ids]
             line.matching_in_ids.unlink()
             line.matching_out_ids.unlink()
+            # 取消出库之后，被匹配的入库单行重新回到库存层中
+            self.env['wh.stock.layer'].sync_lines(line_in_ids)
 
         return super(wh_move_line, self).prev_action_cancel()
@@ -8,6 +8,9 @@ import datetime
 class report_lot_track(models.Model):
     _name = 'report.lot.track'
     _inherit = 'report.base'
+    _order = 'goods DESC'
+    _sql_pushdown = True
+    _python_fields = ('origin',)
 
     goods = fields.Char(u'产品')
     uom = fields.Char(u'单位')
@@ -87,15 +90,18 @@ class report_lot_track(models.Model):
             'goods': context.get('goods') or '',
         }
 
-    def _compute_order(self, result, order):
-        order = order or 'goods DESC'
-        return super(report_lot_track, self)._compute_order(result, order)
+    def report_sql(self):
+        return '''
+        (%s)
+        UNION ALL
+        (%s)
+        ''' % (self._format_sql(sql_type='out'), self._format_sql(sql_type='in'))
 
-    def collect_data_by_sql(self, sql_type='out'):
-        out_collection = self.execute_sql(sql_type='out')
-        in_collection = self.execute_sql(sql_type='in')
+    def compute_python_fields(self, records):
+        self.compute_origin(records)
+        return records
 
-        result = out_collection + in_collection
-        self.compute_origin(result)
+    def collect_data_by_sql(self, sql_type='out'):
+        self.env.cr.execute(self.report_sql())
 
-        return result
+        return self.compute_python_fields(self.env.cr.dictfetchall())
@@ -1,22 +1,55 @@
 # -*- coding: utf-8 -*-
 
-from odoo.osv import osv
+from odoo.osv import osv, expression
 from odoo.http import request
+import babel.dates
 import itertools
 import operator
-import time
-import pickle
-from odoo import models, api
+from dateutil.relativedelta import relativedelta
+from report_cache import get_report_cache
+from odoo import models, fields as odoo_fields, api
 from odoo.exceptions import UserError
 
+SQL_OPERATORS = {
+    '=': '=', '!=': '!=', '>': '>', '<': '<', '>=': '>=', '<=': '<=',
+    'like': 'LIKE', 'ilike': 'ILIKE', 'not like': 'NOT LIKE', 'not ilike': 'NOT ILIKE',
+}
+
+# 分组时可以使用的聚合函数
+SQL_AGGREGATES = ('sum', 'avg', 'min', 'max', 'count', 'bool_and', 'bool_or')
+
+# 按日期分组时各个粒度的显示格式和时间间隔，与odoo标准的read_group一致
+DATE_GROUP_FORMATS = {
+    'day': 'dd MMM yyyy',
+    'week': "'W'w YYYY",
+    'month': 'MMMM yyyy',
+    'quarter': 'QQQ yyyy',
+    'year': 'yyyy',
+}
+DATE_GROUP_INTERVALS = {
+    'day': relativedelta(days=1),
+    'week': relativedelta(weeks=1),
+    'month': relativedelta(months=1),
+    'quarter': relativedelta(months=3),
+    'year': relativedelta(years=1),
+}
+
+
 class report_base(models.Model):
     _name = 'report.base'
     _description = u'使用search_read来直接生成数据的基本类，其他类可以直接异名继承当前类来重用搜索、过滤、分组等函数'
 
     _expired_time = 60
-    _cache_record = False
-    _cache_env = False
-    _cache_time = False
+    # 为空时使用get_report_cache()返回的缓存，可以替换成其他实现了get/set/clear接口的缓存
+    _cache_backend = None
+    # 这些context只影响界面，不影响报表数据，不作为缓存的key
+    _cache_ignore_context = ('params', 'bin_size', 'active_id', 'active_ids',
+                             'active_model', 'group_by', 'search_disable_custom_filters')
+    # 报表的数据可以由report_sql()一条SQL直接得到时设为True，search_read、search_count和read
+    # 会把domain、排序和分页作为外层查询放到数据库中执行，不再把整个结果读到python中处理
+    _sql_pushdown = False
+    # 在python中计算的字段，这些字段上的domain和排序只能在python中处理
+    _python_fields = ()
 
     def select_sql(self, sql_type='out'):
         return ''
@@ -36,18 +69,29 @@ class report_base(models.Model):
     def get_context(self, sql_type='out', context=None):
         return {}
 
-    def execute_sql(self, sql_type='out'):
+    def _format_sql(self, sql_type='out'):
         context = self.get_context(sql_type, context=self.env.context)
         for key, value in context.iteritems():
             if isinstance(context[key], basestring):
                 context[key] = value.encode('utf-8')
 
-        self.env.cr.execute((self.select_sql(sql_type) + self.from_sql(sql_type) + self.where_sql(
+        return (self.select_sql(sql_type) + self.from_sql(sql_type) + self.where_sql(
             sql_type) + self.group_sql(sql_type) + self.order_sql(
-            sql_type)).format(**context))
+            sql_type)).format(**context)
+
+    def execute_sql(self, sql_type='out'):
+        self.env.cr.execute(self._format_sql(sql_type))
 
         return self.env.cr.dictfetchall()
 
+    def report_sql(self):
+        ''' 返回整个报表数据的SQL，_sql_pushdown为True时作为search_read等的子查询 '''
+        return self._format_sql('out')
+
+    def compute_python_fields(self, records):
+        ''' 在SQL查询的结果上计算_python_fields中的字段 '''
+        return records
+
     def collect_data_by_sql(self, sql_type='out'):
         return []
 
@@ -120,8 +164,139 @@ class report_base(models.Model):
     def _compute_domain(self, result, domain):
         return filter(lambda res: self._compute_domain_util(res, domain), result)
 
+    def _read_group_fields(self, groupby):
+        ''' 返回分组字段的[(分组名称, 字段, 日期粒度, SQL表达式)]，有不能在SQL中分组的字段时返回None '''
+        res = []
+        for spec in groupby:
+            field, _, granularity = spec.partition(':')
+            if field not in self._fields or field in self._python_fields:
+                return None
+
+            column = 'report."%s"' % field
+            if self._fields[field].type in ('date', 'datetime'):
+                granularity = granularity or 'month'
+                if granularity not in DATE_GROUP_FORMATS:
+                    return None
+                column = "date_trunc('%s', %s::timestamp)" % (granularity, column)
+            elif granularity:
+                return None
+
+            res.append((spec, field, granularity, column))
+
+        return res
+
+    def _read_group_aggregates(self, fields, groupby_fields):
+        ''' 返回数值字段的[(字段, 聚合函数)]，fields为空时聚合所有数值字段 '''
+        res = []
+        for spec in fields or self._fields.keys():
+            name, _, aggregate = spec.partition(':')
+            field = self._fields.get(name)
+            if not field or name == 'id' or name in groupby_fields \
+                    or field.type not in ('integer', 'float', 'monetary'):
+                continue
+            if name in self._python_fields:
+                return None
+
+            aggregate = (aggregate or getattr(field, 'group_operator', None) or 'sum').lower()
+            if aggregate not in SQL_AGGREGATES:
+                return None
+            res.append((name, aggregate))
+
+        return res
+
+    def _read_group_sql(self, domain, fields, groupby, offset=0, limit=None, orderby=False, lazy=True):
+        '''
+        把report_sql()作为子查询在数据库中分组汇总，所有记录都会参与汇总，
+        报表不支持或者有不能转换成SQL的条件时返回None
+        '''
+        where = self._domain_to_sql(domain)
+        if not self._sql_pushdown or where is None:
+            return None
+
+        groupby_list = lazy and groupby[:1] or groupby
+        groups = self._read_group_fields(groupby_list)
+        if groups is None:
+            return None
+
+        aggregates = self._read_group_aggregates(fields, [group[1] for group in groups])
+        if aggregates is None:
+            return None
+
+        count_field = lazy and groupby and '%s_count' % groupby[0].partition(':')[0] or '__count'
+        select = ['%s AS "%s"' % (column, spec) for spec, _, _, column in groups]
+        select.append('count(*) AS "%s"' % count_field)
+        select.extend('%s(report."%s") AS "%s"' % (aggregate, name, name)
+                      for name, aggregate in aggregates)
+
+        # 分组只能按照分组字段、汇总字段和计数排序
+        order_columns = {count_field: '"%s"' % count_field, '__count': '"%s"' % count_field}
+        order_columns.update((name, '"%s"' % name) for name, _ in aggregates)
+        for spec, field, _, column in groups:
+            order_columns.update({spec: column, field: column})
+
+        order_by = []
+        for field, direction in self._parse_order(orderby):
+            if field not in order_columns:
+                return None
+            order_by.append('%s %s' % (order_columns[field], direction))
+        order_by = order_by or [column for _, _, _, column in groups]
+
+        sql = 'SELECT %s FROM (%s) AS report WHERE %s' % (
+            ', '.join(select), self.report_sql().replace('%', '%%'), where[0])
+        params = list(where[1])
+        if groups:
+            sql += ' GROUP BY %s ORDER BY %s' % (
+                ', '.join(column for _, _, _, column in groups), ', '.join(order_by))
+        if limit:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        if offset:
+            sql += ' OFFSET %s'
+            params.append(offset)
+
+        self.env.cr.execute(sql, params)
+        rows = self.env.cr.dictfetchall()
+
+        # 多对一字段分组时返回(id, 名称)
+        names = {}
+        for spec, field, _, _ in groups:
+            if self._fields[field].type == 'many2one':
+                ids = set(row[spec] for row in rows if row[spec])
+                names[spec] = dict(self.env[self._fields[field].comodel_name].browse(ids).name_get())
+
+        locale = self.env.context.get('lang') or 'en_US'
+        for row in rows:
+            row['__domain'] = []
+            for spec, field, granularity, _ in groups:
+                value = row[spec]
+                if granularity and value:
+                    to_string = self._fields[field].type == 'date' \
+                        and odoo_fields.Date.to_string or odoo_fields.Datetime.to_string
+                    row['__domain'].extend([
+                        (field, '>=', to_string(value)),
+                        (field, '<', to_string(value + DATE_GROUP_INTERVALS[granularity])),
+                    ])
+                    row[spec] = babel.dates.format_date(
+                        value, format=DATE_GROUP_FORMATS[granularity], locale=locale)
+                else:
+                    row['__domain'].append((field, '=', value if value is not None else False))
+                    if spec in names and value:
+                        row[spec] = (value, names[spec].get(value))
+
+            if lazy and len(groupby) > 1:
+                row['__context'] = {'group_by': groupby[1:]}
+
+            row['__domain'].extend(domain or [])
+
+        return self.update_result_none_to_false(rows)
+
     @api.model
-    def read_group(self, domain, fields, groupby, offset=0, limit=80, orderby=False, lazy=True):
+    def read_group(self, domain, fields, groupby, offset=0, limit=None, orderby=False, lazy=True):
+        groupby = isinstance(groupby, basestring) and [groupby] or list(groupby or [])
+        res = self._read_group_sql(domain, fields, groupby, offset=offset,
+                                   limit=limit, orderby=orderby, lazy=lazy)
+        if res is not None:
+            return res
 
         def dict_plus(collect, values):
             for key, value in values.iteritems():
@@ -135,7 +310,8 @@ class report_base(models.Model):
             return collect
 
         res = []
-        values = self.search_read(domain=domain, fields=fields, offset=offset, limit=limit or 80, order=orderby)
+        # 在python中分组时也要汇总所有满足条件的记录，而不只是第一页
+        values = self._compute_domain(self.get_data_from_cache(sql_type='out'), domain)
 
         if groupby:
             key = operator.itemgetter(groupby[0])
@@ -153,13 +329,26 @@ class report_base(models.Model):
 
                 res.append(collect)
 
+        return self._compute_limit_and_offset(res, limit or len(res), offset)
+
+    def _parse_order(self, order):
+        res = []
+        for term in (order or '').split(','):
+            term = term.split()
+            if not term:
+                continue
+
+            direction = len(term) > 1 and term[1].upper() or 'ASC'
+            if direction not in ('ASC', 'DESC'):
+                raise UserError(u'不可识别的排序条件"%s"' % order)
+            res.append((term[0], direction))
+
         return res
 
     def _compute_order(self, result, order):
-        # TODO 暂时不支持多重排序
-        if order:
-            order = order.partition(',')[0].partition(' ')
-            result.sort(key=lambda item: item.get(order[0]), reverse=order[2] == 'ASC')
+        # 多重排序时从最后一个排序字段开始依次做稳定排序
+        for field, direction in reversed(self._parse_order(order or self._order)):
+            result.sort(key=lambda item: item.get(field), reverse=direction == 'DESC')
 
         return result
 
@@ -174,19 +363,175 @@ class report_base(models.Model):
 
         return result
 
+    def _get_cache_backend(self):
+        return self._cache_backend or get_report_cache()
+
+    def _freeze_context_value(self, value):
+        if isinstance(value, dict):
+            return tuple(sorted((key, self._freeze_context_value(val))
+                                for key, val in value.iteritems()))
+        if isinstance(value, (list, tuple, set)):
+            return tuple(self._freeze_context_value(val) for val in value)
+
+        return value
+
+    def _get_cache_key(self, sql_type='out'):
+        # (数据库, 模型)作为namespace，便于按模型清除缓存
+        context = {key: value for key, value in self.env.context.iteritems()
+                   if key not in self._cache_ignore_context
+                   and not key.startswith('search_default_')}
+
+        return ((self.env.cr.dbname, self._name), self.env.uid, sql_type,
+                self._freeze_context_value(context))
+
+    @api.model
+    def clear_report_cache(self):
+        ''' 清除当前报表在所有用户和context下缓存的结果 '''
+        self._get_cache_backend().clear((self.env.cr.dbname, self._name))
+        return True
+
+    def _leaf_to_sql(self, leaf):
+        ''' 将domain中的单个条件转换成(sql, params)，不能在SQL中处理时返回None '''
+        if leaf == expression.TRUE_LEAF:
+            return 'TRUE', []
+        if leaf == expression.FALSE_LEAF:
+            return 'FALSE', []
+
+        field, opto, value = leaf
+        opto = unicode(opto).lower()
+        if field not in self._fields or field in self._python_fields:
+            return None
+
+        column = 'report."%s"' % field
+        if opto in ('like', 'ilike', 'not like', 'not ilike'):
+            pattern = u'%%%s%%' % unicode(value).replace(
+                '\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            if opto.startswith('not'):
+                return '(%s %s %%s OR %s IS NULL)' % (column, SQL_OPERATORS[opto], column), [pattern]
+            return '%s %s %%s' % (column, SQL_OPERATORS[opto]), [pattern]
+
+        if opto in ('in', 'not in'):
+            if not isinstance(value, (list, tuple)):
+                return None
+
+            values = tuple(val for val in value if val is not False and val is not None)
+            with_null = len(values) != len(value)
+            if opto == 'in':
+                sql = values and '%s IN %%s' % column or 'FALSE'
+                sql = with_null and '(%s OR %s IS NULL)' % (sql, column) or sql
+            else:
+                sql = values and '%s NOT IN %%s' % column or 'TRUE'
+                sql = '(%s %s %s IS %sNULL)' % (
+                    sql, with_null and 'AND' or 'OR', column, with_null and 'NOT ' or '')
+
+            return sql, values and [values] or []
+
+        if opto not in SQL_OPERATORS:
+            return None
+
+        if value is False or value is None:
+            if opto not in ('=', '!='):
+                return None
+            return '%s IS %sNULL' % (column, opto == '!=' and 'NOT ' or ''), []
+
+        if opto == '!=':
+            return '(%s != %%s OR %s IS NULL)' % (column, column), [value]
+
+        return '%s %s %%s' % (column, SQL_OPERATORS[opto]), [value]
+
+    def _domain_to_sql(self, domain):
+        ''' 将domain转换成(sql, params)，有不能在SQL中处理的条件时返回None，由python处理 '''
+        try:
+            domain = expression.normalize_domain(list(domain or []))
+        except AssertionError:
+            return None
+
+        stack = []
+        for leaf in reversed(domain):
+            if leaf in (expression.AND_OPERATOR, expression.OR_OPERATOR):
+                if len(stack) < 2:
+                    return None
+                left, right = stack.pop(), stack.pop()
+                stack.append(('(%s %s %s)' % (
+                    left[0], leaf == expression.AND_OPERATOR and 'AND' or 'OR', right[0]),
+                    left[1] + right[1]))
+            elif leaf == expression.NOT_OPERATOR:
+                if not stack:
+                    return None
+                sql, params = stack.pop()
+                stack.append(('(NOT %s)' % sql, params))
+            elif isinstance(leaf, (list, tuple)) and len(leaf) == 3:
+                res = self._leaf_to_sql(tuple(leaf))
+                if res is None:
+                    return None
+                stack.append(res)
+            else:
+                return None
+
+        return len(stack) == 1 and stack[0] or None
+
+    def _order_to_sql(self, order):
+        terms = self._parse_order(order)
+        for field, _ in terms:
+            if field not in self._fields or field in self._python_fields:
+                return None
+
+        return ', '.join('report."%s" %s' % term for term in terms)
+
+    def _search_sql(self, domain, order=None, limit=None, offset=0, count=False):
+        '''
+        把report_sql()作为子查询，在数据库中完成过滤、排序和分页，
+        报表不支持或者domain、排序中有不能转换成SQL的条件时返回None
+        '''
+        if not self._sql_pushdown:
+            return None
+
+        where = self._domain_to_sql(domain)
+        order_by = not count and self._order_to_sql(order or self._order)
+        if where is None or order_by is None:
+            return None
+
+        # 报表SQL中的%已经是最终的字符，作为带参数的查询执行时需要转义
+        sql = 'SELECT %s FROM (%s) AS report WHERE %s' % (
+            count and 'count(*)' or 'report.*', self.report_sql().replace('%', '%%'), where[0])
+        params = list(where[1])
+        if count:
+            self.env.cr.execute(sql, params)
+            return self.env.cr.fetchone()[0]
+
+        # 排序字段相同时按id排序，保证LIMIT/OFFSET分页的结果稳定
+        if 'id' not in [field for field, _ in self._parse_order(order or self._order)]:
+            order_by = ', '.join(filter(None, [order_by, 'report."id"']))
+        sql += ' ORDER BY %s' % order_by
+        if limit:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        if offset:
+            sql += ' OFFSET %s'
+            params.append(offset)
+
+        self.env.cr.execute(sql, params)
+        return self.update_result_none_to_false(
+            self.compute_python_fields(self.env.cr.dictfetchall()))
+
     def get_data_from_cache(self, sql_type='out'):
-        if self._cache_env != (self.env.uid, self.env.context) \
-                or not self._cache_record or self._cache_time + self._expired_time < time.time():
+        cache = self._get_cache_backend()
+        key = self._get_cache_key(sql_type)
 
-            self.__class__._cache_record = self.update_result_none_to_false(
+        result = cache.get(key)
+        if result is None:
+            result = self.update_result_none_to_false(
                 self.collect_data_by_sql(sql_type))
-            self.__class__._cache_time = time.time()
-            self.__class__._cache_env = (self.env.uid, self.env.context)
+            cache.set(key, result, self._expired_time)
 
-        return self._cache_record
+        return result
 
     @api.model
     def search_read(self, domain=None, fields=None, offset=0, limit=80, order=None):
+        result = self._search_sql(domain, order=order, limit=limit, offset=offset)
+        if result is not None:
+            return result
+
         result = self.get_data_from_cache(sql_type='out')
 
         result = self._compute_domain(result, domain)
@@ -197,6 +542,10 @@ class report_base(models.Model):
 
     @api.model
     def search_count(self, domain):
+        count = self._search_sql(domain, count=True)
+        if count is not None:
+            return count
+
         result = self.get_data_from_cache(sql_type='out')
         result = self._compute_domain(result, domain)
 
@@ -208,9 +557,13 @@ class report_base(models.Model):
         fields = fields or []
 
         fields.append('id')
-        for record in self.get_data_from_cache():
-            if record.get('id') in self.ids:
-                res.append({field: record.get(field) for field in fields})
+        records = self._search_sql([('id', 'in', self.ids)])
+        if records is None:
+            records = [record for record in self.get_data_from_cache()
+                       if record.get('id') in self.ids]
+
+        for record in records:
+            res.append({field: record.get(field) for field in fields})
 
         return res
 
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from odoo.tools import config
+
+
+class LocalReportCache(object):
+    '''
+    进程内的报表缓存：最多保存max_entries条结果，超出时淘汰最久没有使用的结果，
+    每条结果在expired_time秒之后过期，行数超过max_records的结果不缓存
+    '''
+
+    def __init__(self, max_entries=32, max_records=200000):
+        self.max_entries = max_entries
+        self.max_records = max_records
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                return None
+
+            # 重新放到末尾，表示最近使用过
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, expired_time=60):
+        if len(value) > self.max_records:
+            return False
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + expired_time)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return True
+
+    def clear(self, namespace=None):
+        ''' 删除namespace(数据库, 模型)下的所有结果，不指定namespace时清空整个缓存 '''
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+                return
+
+            for key in [key for key in self._entries if key[0] == namespace]:
+                del self._entries[key]
+
+
+class SharedReportCache(object):
+    '''
+    多进程共享的报表缓存：client需要提供memcached风格的get(key)、set(key, value, time)接口，
+    清除缓存时只递增namespace的版本号，旧版本的结果由client按过期时间自行淘汰
+    '''
+
+    def __init__(self, client, max_records=200000, prefix='gooderp_report'):
+        self.client = client
+        self.max_records = max_records
+        self.prefix = prefix
+
+    def _version_key(self, namespace):
+        return '%s:%s:%s:version' % ((self.prefix,) + tuple(namespace))
+
+    def _get_version(self, namespace):
+        return self.client.get(self._version_key(namespace)) or 0
+
+    def _make_key(self, key):
+        namespace = key[0]
+        digest = hashlib.md5(repr((key, self._get_version(namespace)))).hexdigest()
+        return '%s:%s' % (self.prefix, digest)
+
+    def get(self, key):
+        value = self.client.get(self._make_key(key))
+        if value is None:
+            return None
+
+        return pickle.loads(value)
+
+    def set(self, key, value, expired_time=60):
+        if len(value) > self.max_records:
+            return False
+
+        self.client.set(self._make_key(key),
+                        pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                        expired_time)
+        return True
+
+    def clear(self, namespace=None):
+        if namespace is not None:
+            self.client.set(self._version_key(namespace),
+                            self._get_version(namespace) + 1, 0)
+
+
+_report_cache = None
+
+
+def get_report_cache():
+    '''
+    返回当前进程使用的报表缓存，配置文件中设置了report_cache_memcached(逗号分隔的服务器地址)
+    并且安装了python-memcached时使用共享缓存，否则使用进程内缓存
+    '''
+    global _report_cache
+    if _report_cache is None:
+        servers = config.get('report_cache_memcached')
+        if servers:
+            try:
+                import memcache
+                _report_cache = SharedReportCache(memcache.Client(servers.split(',')))
+            except ImportError:
+                _report_cache = LocalReportCache()
+        else:
+            _report_cache = LocalReportCache()
+
+    return _report_cache
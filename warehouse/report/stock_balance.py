@@ -2,58 +2,97 @@
 
 from odoo import tools
 import odoo.addons.decimal_precision as dp
-from odoo import models, fields
+from odoo import models, fields, api
 
 
 class report_stock_balance(models.Model):
+    '''
+    库存余额表：按(仓库, 产品, 属性, 批号)保存当前的结存，
+    随库存层在单据审核和反审核的同一个事务中增量更新，查询时直接按索引读取
+    '''
     _name = 'report.stock.balance'
-    _auto = False
+    _order = 'goods, warehouse, goods_qty'
 
-    goods = fields.Char(u'产品')
-    goods_id = fields.Many2one('goods', u'产品')
-    uom = fields.Char(u'单位')
-    uos = fields.Char(u'辅助单位')
+    goods = fields.Char(u'产品', related='goods_id.name', store=True, readonly=True)
+    goods_id = fields.Many2one('goods', u'产品', index=True, ondelete='cascade')
+    uom = fields.Char(u'单位', related='goods_id.uom_id.name', store=True, readonly=True)
+    uos = fields.Char(u'辅助单位', related='goods_id.uos_id.name', store=True, readonly=True)
     lot = fields.Char(u'批号')
-    attribute_id = fields.Char(u'属性')
-    warehouse = fields.Char(u'仓库')
+    attribute_id = fields.Many2one('attribute', u'属性', ondelete='cascade')
+    warehouse = fields.Char(u'仓库', related='warehouse_id.name', store=True, readonly=True)
+    warehouse_id = fields.Many2one('warehouse', u'仓库', index=True, ondelete='cascade')
     goods_qty = fields.Float(u'数量', digits=dp.get_precision('Quantity'))
     goods_uos_qty = fields.Float(u'辅助单位数量', digits=dp.get_precision('Quantity'))
     cost = fields.Float(u'成本', digits=dp.get_precision('Amount'))
 
+    def _auto_init(self):
+        # 旧版本的库存余额表是一个视图，需要先删除视图才能建表
+        tools.drop_view_if_exists(self._cr, 'report_stock_balance')
+        return super(report_stock_balance, self)._auto_init()
+
     def init(self):
         cr = self._cr
-        tools.drop_view_if_exists(cr, 'report_stock_balance')
-        cr.execute(
-            """
-            create or replace view report_stock_balance as (
-                SELECT min(line.id) as id,
-                       goods.name as goods,
-                       goods.id as goods_id,
-                       line.lot as lot,
-                       attribute.name as attribute_id,
-                       uom.name as uom,
-                       uos.name as uos,
-                       wh.name as warehouse,
-                       sum(line.qty_remaining) as goods_qty,
-                       sum(line.uos_qty_remaining) as goods_uos_qty,
-                       sum(line.cost) as cost
-
-                FROM wh_move_line line
-                LEFT JOIN warehouse wh ON line.warehouse_dest_id = wh.id
-                LEFT JOIN goods goods ON line.goods_id = goods.id
-                    LEFT JOIN attribute attribute on attribute.id = line.attribute_id
-                    LEFT JOIN uom uom ON goods.uom_id = uom.id
-                    LEFT JOIN uom uos ON goods.uos_id = uos.id
-
-                WHERE line.qty_remaining > 0
-                  AND wh.type = 'stock'
-                  AND line.state = 'done'
-                  AND ( goods.no_stock is null or goods.no_stock = FALSE)
-
-                GROUP BY wh.name, line.lot, attribute.name, goods.name, goods.id, uom.name, uos.name
-
-                ORDER BY goods.name, wh.name, goods_qty asc
-            )
-        """)
+        cr.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS report_stock_balance_key_index
+            ON report_stock_balance (warehouse_id, goods_id,
+                COALESCE(attribute_id, 0), COALESCE(lot, ''))
+        ''')
+
+        cr.execute('SELECT 1 FROM report_stock_balance LIMIT 1')
+        if cr.fetchone():
+            return
+
+        cr.execute('''
+            SELECT warehouse_id, goods_id, attribute_id, lot,
+                   sum(qty_remaining), sum(uos_qty_remaining),
+                   sum(qty_remaining * cost_unit)
+            FROM wh_stock_layer
+            GROUP BY warehouse_id, goods_id, attribute_id, lot
+        ''')
+        self.apply_deltas({row[:4]: row[4:] for row in cr.fetchall()})
+
+    @api.model
+    def apply_deltas(self, deltas):
+        '''
+        将{(仓库id, 产品id, 属性id, 批号): [数量, 辅助数量, 成本]}的变化量累加到库存余额上，
+        结存数量为0的行直接删除
+        '''
+        deltas = {key: delta for key, delta in deltas.iteritems()
+                  if any(delta)}
+        if not deltas:
+            return True
+
+        params = []
+        for key, delta in deltas.iteritems():
+            params.extend(list(key) + list(delta))
+
+        self.env.cr.execute('''
+            INSERT INTO report_stock_balance (warehouse_id, goods_id, attribute_id,
+                lot, goods_qty, goods_uos_qty, cost, goods, uom, uos, warehouse)
+            SELECT delta.warehouse_id, delta.goods_id, delta.attribute_id,
+                   delta.lot, delta.qty, delta.uos_qty, delta.cost,
+                   goods.name, uom.name, uos.name, wh.name
+            FROM (VALUES %s) AS delta (warehouse_id, goods_id, attribute_id,
+                                       lot, qty, uos_qty, cost)
+            JOIN goods goods ON delta.goods_id = goods.id
+            JOIN warehouse wh ON delta.warehouse_id = wh.id
+            LEFT JOIN uom uom ON goods.uom_id = uom.id
+            LEFT JOIN uom uos ON goods.uos_id = uos.id
+            WHERE goods.no_stock IS NOT TRUE
+            ON CONFLICT (warehouse_id, goods_id, COALESCE(attribute_id, 0),
+                         COALESCE(lot, '')) DO UPDATE
+            SET goods_qty = report_stock_balance.goods_qty + EXCLUDED.goods_qty,
+                goods_uos_qty = report_stock_balance.goods_uos_qty + EXCLUDED.goods_uos_qty,
+                cost = report_stock_balance.cost + EXCLUDED.cost
+        ''' % ', '.join(['(%s::integer, %s::integer, %s::integer, %s::varchar, '
+                         '%s::numeric, %s::numeric, %s::numeric)'] * len(deltas)), params)
+
+        self.env.cr.execute('''
+            DELETE FROM report_stock_balance
+            WHERE goods_id IN %s AND goods_qty <= 0
+        ''', (tuple(set(key[1] for key in deltas)),))
+        self.invalidate_cache()
+
+        return True
 
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
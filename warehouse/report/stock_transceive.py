@@ -8,6 +8,8 @@ import datetime
 class report_stock_transceive(models.Model):
     _name = 'report.stock.transceive'
     _inherit = 'report.base'
+    _order = 'goods, warehouse'
+    _sql_pushdown = True
 
     goods = fields.Char(u'产品')
     attribute = fields.Char(u'属性')
@@ -32,38 +34,80 @@ class report_stock_transceive(models.Model):
         u'入库成本', digits=dp.get_precision('Amount'))
 
     def select_sql(self, sql_type='out'):
+        if sql_type == 'snapshot':
+            return '''
+        SELECT min(snap.line_id) as id,
+                goods.name as goods,
+                att.name as attribute,
+                '' as id_lists,
+                uom.name as uom,
+                wh.name as warehouse,
+                sum(snap.qty) as goods_qty_begain,
+                sum(snap.cost) as cost_begain,
+                sum(snap.qty) as goods_qty_end,
+                sum(snap.cost) as cost_end,
+                0 as goods_qty_out,
+                0 as cost_out,
+                0 as goods_qty_in,
+                0 as cost_in
+            '''
+
+        # 出库的期初和期末取负数，本期发生额分别作为出库和入库
         return '''
         SELECT min(line.id) as id,
                 goods.name as goods,
                 att.name as attribute,
-                array_agg(line.id) as id_lists,
+                array_to_string(array_agg(line.id), ',') as id_lists,
                 uom.name as uom,
                 wh.name as warehouse,
-                sum(case when
+                %(sign)s sum(case when
                     line.date < '{date_start}' THEN line.goods_qty ELSE 0 END)
                     as goods_qty_begain,
-                sum(case when
+                %(sign)s sum(case when
                     line.date < '{date_start}' THEN line.cost ELSE 0 END)
                     as cost_begain,
-                sum(case when
+                %(sign)s sum(case when
                     line.date < '{date_end}' THEN line.goods_qty ELSE 0 END)
                     as goods_qty_end,
-                sum(case when
+                %(sign)s sum(case when
                     line.date < '{date_end}' THEN line.cost ELSE 0 END)
                     as cost_end,
-                sum(case when
+                %(out)s sum(case when
                     line.date < '{date_end}' AND line.date >= '{date_start}'
                   THEN
                     line.goods_qty ELSE 0 END)
-                    as goods_qty,
-                sum(case when
+                    as goods_qty_out,
+                %(out)s sum(case when
                     line.date < '{date_end}' AND line.date >= '{date_start}'
                   THEN
                     line.cost ELSE 0 END)
-                    as cost
-        '''
+                    as cost_out,
+                %(in)s sum(case when
+                    line.date < '{date_end}' AND line.date >= '{date_start}'
+                  THEN
+                    line.goods_qty ELSE 0 END)
+                    as goods_qty_in,
+                %(in)s sum(case when
+                    line.date < '{date_end}' AND line.date >= '{date_start}'
+                  THEN
+                    line.cost ELSE 0 END)
+                    as cost_in
+        ''' % {
+            'sign': sql_type == 'out' and '-' or '',
+            'out': sql_type == 'out' and '1 *' or '0 *',
+            'in': sql_type == 'in' and '1 *' or '0 *',
+        }
 
     def from_sql(self, sql_type='out'):
+        if sql_type == 'snapshot':
+            return '''
+        FROM wh_stock_snapshot snap
+            LEFT JOIN goods goods ON snap.goods_id = goods.id
+            LEFT JOIN attribute att ON snap.attribute_id = att.id
+            LEFT JOIN uom uom ON snap.uom_id = uom.id
+            LEFT JOIN warehouse wh ON snap.warehouse_id = wh.id
+            '''
+
         return '''
         FROM wh_move_line line
             LEFT JOIN goods goods ON line.goods_id = goods.id
@@ -73,13 +117,23 @@ class report_stock_transceive(models.Model):
         ''' % (sql_type == 'out' and 'warehouse_id' or 'warehouse_dest_id')
 
     def where_sql(self, sql_type='out'):
+        if sql_type == 'snapshot':
+            return '''
+        WHERE snap.date = '{snapshot_date}'
+          AND wh.name ilike '%{warehouse}%'
+          AND goods.name ilike '%{goods}%'
+            '''
+
+        # 快照之前的单行已经计入快照的结存，不需要再扫描
         return '''
         WHERE line.state = 'done'
           AND wh.type = 'stock'
           AND line.date < '{date_end}'
           AND wh.name ilike '%{warehouse}%'
           AND goods.name ilike '%{goods}%'
-        '''
+        ''' + (self.get_snapshot_date() and '''
+          AND line.date >= '{snapshot_date}'
+        ''' or '')
 
     def group_sql(self, sql_type='out'):
         return '''
@@ -91,6 +145,11 @@ class report_stock_transceive(models.Model):
         ORDER BY goods.name, wh.name
         '''
 
+    def get_snapshot_date(self):
+        # 不晚于开始日期的最近一个库存快照
+        return self.env['wh.stock.snapshot'].get_snapshot_date(
+            self.env.context.get('date_start'))
+
     def get_context(self, sql_type='out', context=None):
         date_end = datetime.datetime.strptime(
             context.get('date_end'), '%Y-%m-%d') + datetime.timedelta(days=1)
@@ -99,80 +158,72 @@ class report_stock_transceive(models.Model):
         return {
             'date_start': context.get('date_start') or '',
             'date_end': date_end,
+            'snapshot_date': self.get_snapshot_date() or '',
             'warehouse': context.get('warehouse') or '',
             'goods': context.get('goods') or '',
         }
 
-    def get_record_key(self, record, sql_type='out'):
-        return (
-            record.get('goods'),
-            record.get('uom'),
-            record.get('warehouse'),
-            record.get('attribute'))
-
-    def unzip_record_key(self, key):
-        return {
-            'goods': key[0],
-            'uom': key[1],
-            'warehouse': key[2],
-            'attribute': key[3],
-        }
-
-    def get_default_value_by_record(self, record, sql_type='out'):
-        return {
-            'id': record.get('id'),
-        }
+    def report_sql(self):
+        sqls = [self._format_sql(sql_type='in'), self._format_sql(sql_type='out')]
+        # 期初和期末加上快照中的结存
+        if self.get_snapshot_date():
+            sqls.append(self._format_sql(sql_type='snapshot'))
 
-    def update_record_value(self, value, record, sql_type='out'):
-        tag = sql_type == 'out' and -1 or 1
-
-        value.update({
-                'goods_qty_begain': value.get('goods_qty_begain', 0) +
-                    (tag * record.get('goods_qty_begain', 0)),
-                'cost_begain': value.get('cost_begain', 0) +
-                    (tag * record.get('cost_begain', 0)),
-                'goods_qty_end': value.get('goods_qty_end', 0) +
-                    (tag * record.get('goods_qty_end', 0)),
-                'cost_end': value.get('cost_end', 0) +
-                    (tag * record.get('cost_end', 0)),
-
-                'goods_qty_out': value.get('goods_qty_out', 0) +
-                    (sql_type == 'out' and record.get('goods_qty', 0) or 0),
-                'cost_out': value.get('cost_out', 0) +
-                    (sql_type == 'out' and record.get('cost', 0) or 0),
-                'goods_qty_in': value.get('goods_qty_in', 0) +
-                    (sql_type == 'in' and record.get('goods_qty', 0) or 0),
-                'cost_in': value.get('cost_in', 0) +
-                    (sql_type == 'in' and record.get('cost', 0) or 0),
-                'id_lists': value.get('id_lists', []) + record.get('id_lists', []),
-            })
-
-    def compute_history_stock_by_collect(self, res, records, sql_type='out'):
-        for record in records:
-            record_key = self.get_record_key(record, sql_type=sql_type)
-            if not res.get(record_key):
-                res[record_key] = self.get_default_value_by_record(
-                    record, sql_type=sql_type)
-
-            self.update_record_value(
-                res[record_key], record, sql_type=sql_type)
+        return '''
+        SELECT min(id) as id,
+                goods,
+                attribute,
+                COALESCE(string_to_array(string_agg(NULLIF(id_lists, ''), ','), ',')::integer[],
+                         ARRAY[]::integer[]) as id_lists,
+                uom,
+                warehouse,
+                sum(goods_qty_begain) as goods_qty_begain,
+                sum(cost_begain) as cost_begain,
+                sum(goods_qty_end) as goods_qty_end,
+                sum(cost_end) as cost_end,
+                sum(goods_qty_out) as goods_qty_out,
+                sum(cost_out) as cost_out,
+                sum(goods_qty_in) as goods_qty_in,
+                sum(cost_in) as cost_in
+        FROM (%s) AS transceive
+        GROUP BY goods, attribute, uom, warehouse
+        ORDER BY goods, warehouse
+        ''' % ' UNION ALL '.join('(%s)' % sql for sql in sqls)
 
     def collect_data_by_sql(self, sql_type='out'):
-        out_collection = self.execute_sql(sql_type='out')
-        in_collection = self.execute_sql(sql_type='in')
+        self.env.cr.execute(self.report_sql())
 
-        res = {}
-        self.compute_history_stock_by_collect(
-            res, in_collection, sql_type='in')
-        self.compute_history_stock_by_collect(
-            res, out_collection, sql_type='out')
+        return self.env.cr.dictfetchall()
 
-        result = []
-        for key, value in res.iteritems():
-            value.update(self.unzip_record_key(key))
-            result.append(value)
-
-        return result
+    def _get_source_move_line_ids(self, row):
+        '''
+        报表行对应的所有库存调拨单行：直接按行的产品、属性、单位、仓库从wh_move_line中查找，
+        不使用报表中的id_lists，因为快照之前的单行已经合并进快照，不在id_lists中
+        '''
+        self.env.cr.execute('''
+            SELECT DISTINCT line.id
+            FROM wh_move_line line
+                LEFT JOIN goods goods ON line.goods_id = goods.id
+                LEFT JOIN attribute att ON line.attribute_id = att.id
+                LEFT JOIN uom uom ON line.uom_id = uom.id
+                JOIN warehouse wh ON wh.id IN (line.warehouse_id, line.warehouse_dest_id)
+            WHERE line.state = 'done'
+              AND wh.type = 'stock'
+              AND line.date < %(date_end)s
+              AND goods.name IS NOT DISTINCT FROM %(goods)s
+              AND att.name IS NOT DISTINCT FROM %(attribute)s
+              AND uom.name IS NOT DISTINCT FROM %(uom)s
+              AND wh.name IS NOT DISTINCT FROM %(warehouse)s
+            ORDER BY line.id
+        ''', {
+            'date_end': self.get_context(context=self.env.context).get('date_end'),
+            'goods': row.get('goods'),
+            'attribute': row.get('attribute'),
+            'uom': row.get('uom'),
+            'warehouse': row.get('warehouse'),
+        })
+
+        return [line_id for line_id, in self.env.cr.fetchall()]
 
     @api.multi
     def find_source_move_line(self):
@@ -183,7 +234,7 @@ class report_stock_transceive(models.Model):
 
         for line in move_line_lists:
             if line.get('id') == self.id:
-                move_line_ids = line.get('id_lists')
+                move_line_ids = self._get_source_move_line_ids(line)
 
         view = self.env.ref('warehouse.wh_move_line_tree')
         return {
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import odoo.addons.decimal_precision as dp
+from odoo import models, fields, api
+
+
+class wh_stock_layer(models.Model):
+    '''
+    库存层：每一条已审核、调入库存类型仓库并且还有剩余数量的入库单行对应一条记录，
+    按照(产品, 仓库, 属性, 审核时间)排序，用来在出库匹配时按先进先出顺序快速取得入库行，
+    而不需要每次都对wh.move.line做一次全量的search
+    '''
+    _name = 'wh.stock.layer'
+    _description = u'库存层'
+    _order = 'cost_time, line_id'
+
+    # 每次从数据库中取出的库存层数量，匹配只会读取实际消耗掉的库存层
+    _fetch_size = 100
+
+    line_id = fields.Many2one(
+        'wh.move.line', u'入库', required=True, index=True,
+        ondelete='cascade',
+        help=u'库存层对应的入库单行')
+    goods_id = fields.Many2one(
+        'goods', u'产品', required=True, ondelete='cascade',
+        help=u'库存层对应的产品')
+    warehouse_id = fields.Many2one(
+        'warehouse', u'仓库', required=True, ondelete='cascade',
+        help=u'库存层所在的仓库')
+    attribute_id = fields.Many2one(
+        'attribute', u'属性', ondelete='cascade',
+        help=u'库存层对应的产品属性')
+    lot = fields.Char(
+        u'批号',
+        help=u'入库单行的批号')
+    cost_time = fields.Datetime(
+        u'审核时间',
+        help=u'入库单行的审核时间，用来确定先进先出的顺序')
+    qty_remaining = fields.Float(
+        u'剩余数量', digits=dp.get_precision('Quantity'),
+        help=u'入库单行的剩余数量')
+    uos_qty_remaining = fields.Float(
+        u'剩余辅助数量', digits=dp.get_precision('Quantity'),
+        help=u'入库单行的剩余辅助数量')
+    cost_unit = fields.Float(
+        u'单位成本', digits=dp.get_precision('Amount'),
+        help=u'入库单行的实际单位成本')
+
+    _sql_constraints = [
+        ('line_uniq', 'unique(line_id)', u'一个入库单行只能有一个库存层'),
+    ]
+
+    def init(self):
+        cr = self._cr
+        cr.execute('''
+            CREATE INDEX IF NOT EXISTS wh_stock_layer_fifo_index
+            ON wh_stock_layer (goods_id, warehouse_id, cost_time, line_id)
+        ''')
+        cr.execute('''
+            CREATE INDEX IF NOT EXISTS wh_stock_layer_attribute_fifo_index
+            ON wh_stock_layer (goods_id, warehouse_id, attribute_id, cost_time, line_id)
+        ''')
+
+        # 升级模块时，为已经存在的入库单行补齐库存层
+        cr.execute('''
+            INSERT INTO wh_stock_layer (line_id, goods_id, warehouse_id,
+                attribute_id, lot, cost_time, qty_remaining, uos_qty_remaining,
+                cost_unit)
+            %s
+              AND NOT EXISTS (SELECT 1 FROM wh_stock_layer layer
+                              WHERE layer.line_id = line.id)
+        ''' % self._select_layer_sql())
+
+    def _select_layer_sql(self):
+        return '''
+            SELECT line.id,
+                   line.goods_id,
+                   line.warehouse_dest_id,
+                   line.attribute_id,
+                   line.lot,
+                   line.cost_time,
+                   line.qty_remaining,
+                   line.uos_qty_remaining,
+                   CASE WHEN line.goods_qty != 0
+                        THEN line.cost / line.goods_qty ELSE 0 END
+            FROM wh_move_line line
+            LEFT JOIN warehouse wh ON line.warehouse_dest_id = wh.id
+            WHERE line.state = 'done'
+              AND wh.type = 'stock'
+              AND line.qty_remaining > 0
+        '''
+
+    @api.model
+    def sync_lines(self, line_ids):
+        ''' 根据入库单行当前的状态、剩余数量和成本重新生成对应的库存层 '''
+        line_ids = tuple(set(line_ids))
+        if not line_ids:
+            return True
+
+        self.env.cr.execute('''
+            SELECT DISTINCT goods_id, warehouse_dest_id FROM wh_move_line
+            WHERE id IN %s
+        ''', (line_ids,))
+        self.env['goods'].invalidate_cost_quotes(self.env.cr.fetchall())
+        old_layers = self._read_balance_layers(line_ids)
+
+        self.env.cr.execute('''
+            DELETE FROM wh_stock_layer
+            WHERE line_id IN %%s
+              AND line_id NOT IN (SELECT qualified.id FROM (%s) qualified)
+        ''' % self._select_layer_sql(), (line_ids,))
+        self.env.cr.execute('''
+            INSERT INTO wh_stock_layer (line_id, goods_id, warehouse_id,
+                attribute_id, lot, cost_time, qty_remaining, uos_qty_remaining,
+                cost_unit)
+            %s
+              AND line.id IN %%s
+            ON CONFLICT (line_id) DO UPDATE
+            SET goods_id = EXCLUDED.goods_id,
+                warehouse_id = EXCLUDED.warehouse_id,
+                attribute_id = EXCLUDED.attribute_id,
+                lot = EXCLUDED.lot,
+                cost_time = EXCLUDED.cost_time,
+                qty_remaining = EXCLUDED.qty_remaining,
+                uos_qty_remaining = EXCLUDED.uos_qty_remaining,
+                cost_unit = EXCLUDED.cost_unit
+        ''' % self._select_layer_sql(), (line_ids,))
+        self.invalidate_cache()
+
+        # 库存层的变化同步计入库存余额表
+        deltas = {}
+        for sign, layers in ((-1, old_layers), (1, self._read_balance_layers(line_ids))):
+            for layer in layers:
+                delta = deltas.setdefault(layer[:4], [0, 0, 0])
+                delta[0] += sign * layer[4]
+                delta[1] += sign * layer[5]
+                delta[2] += sign * layer[6]
+        self.env['report.stock.balance'].apply_deltas(deltas)
+
+        return True
+
+    def _read_balance_layers(self, line_ids):
+        # 返回库存层的(仓库, 产品, 属性, 批号, 剩余数量, 剩余辅助数量, 剩余成本)
+        self.env.cr.execute('''
+            SELECT warehouse_id, goods_id, attribute_id, lot,
+                   qty_remaining, uos_qty_remaining, qty_remaining * cost_unit
+            FROM wh_stock_layer
+            WHERE line_id IN %s
+        ''', (line_ids,))
+
+        return self.env.cr.fetchall()
+
+    @api.model
+    def consume(self, matching_records):
+        ''' 出库匹配之后，从对应的库存层上扣减掉本次匹配的数量，消耗完的库存层直接删除 '''
+        if not matching_records:
+            return True
+
+        deltas = {}
+        for matching in matching_records:
+            delta = deltas.setdefault(matching.get('line_in_id'), [0, 0])
+            delta[0] += matching.get('qty')
+            delta[1] += matching.get('uos_qty')
+
+        self.env.cr.execute('''
+            UPDATE wh_stock_layer layer
+            SET qty_remaining = layer.qty_remaining - delta.qty,
+                uos_qty_remaining = layer.uos_qty_remaining - delta.uos_qty
+            FROM (VALUES %s) AS delta (line_id, qty, uos_qty)
+            WHERE layer.line_id = delta.line_id
+            RETURNING layer.warehouse_id, layer.goods_id, layer.attribute_id, layer.lot,
+                      delta.qty, delta.uos_qty, delta.qty * layer.cost_unit
+        ''' % ', '.join(['(%s, %s::numeric, %s::numeric)'] * len(deltas)),
+            [value for line_id, delta in deltas.iteritems()
+             for value in (line_id, delta[0], delta[1])])
+
+        balance_deltas = {}
+        for row in self.env.cr.fetchall():
+            delta = balance_deltas.setdefault(row[:4], [0, 0, 0])
+            delta[0] -= row[4]
+            delta[1] -= row[5]
+            delta[2] -= row[6]
+        self.env['goods'].invalidate_cost_quotes(
+            set((key[1], key[0]) for key in balance_deltas))
+        self.env['report.stock.balance'].apply_deltas(balance_deltas)
+
+        self.env.cr.execute('''
+            DELETE FROM wh_stock_layer
+            WHERE line_id IN %s AND qty_remaining <= 0
+        ''', (tuple(deltas.keys()),))
+        self.invalidate_cache()
+
+        return True
+
+    @api.model
+    def iter_layers(self, goods, warehouse, attribute=None, ignore=None):
+        '''
+        按照先进先出的顺序依次返回库存层(line_id, qty_remaining, uos_qty_remaining, cost_unit)，
+        每次只从数据库中取_fetch_size条，调用方停止迭代之后就不会再继续查询
+        '''
+        where, params = ['goods_id = %s', 'warehouse_id = %s'], [
+            goods.id, warehouse.id]
+        if attribute:
+            where.append('attribute_id = %s')
+            params.append(attribute.id)
+
+        if ignore:
+            where.append('line_id NOT IN %s')
+            params.append(tuple(ignore))
+
+        last_key = None
+        while True:
+            page_where, page_params = list(where), list(params)
+            if last_key:
+                # cost_time为空的库存层排在最后，与ORM中 order='cost_time, id' 的顺序一致
+                if last_key[0]:
+                    page_where.append(
+                        '(cost_time > %s OR cost_time IS NULL '
+                        'OR (cost_time = %s AND line_id > %s))')
+                    page_params.extend([last_key[0], last_key[0], last_key[1]])
+                else:
+                    page_where.append('cost_time IS NULL AND line_id > %s')
+                    page_params.append(last_key[1])
+
+            self.env.cr.execute('''
+                SELECT line_id, cost_time, qty_remaining, uos_qty_remaining,
+                       cost_unit
+                FROM wh_stock_layer
+                WHERE %s
+                ORDER BY cost_time, line_id
+                LIMIT %s
+            ''' % (' AND '.join(page_where), self._fetch_size), page_params)
+
+            layers = self.env.cr.dictfetchall()
+            for layer in layers:
+                yield layer
+
+            if len(layers) < self._fetch_size:
+                break
+
+            last_key = (layers[-1].get('cost_time'), layers[-1].get('line_id'))
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import odoo.addons.decimal_precision as dp
+from odoo import models, fields, api
+
+
+class wh_stock_snapshot(models.Model):
+    '''
+    库存快照：按(截止日期, 产品, 仓库, 属性, 单位)保存截止日期之前(不含)所有已审核单行的结存数量和成本，
+    在会计期间结账或者定时任务中生成，商品收发明细表直接从最近的快照取期初，只需要扫描快照之后的单行
+    '''
+    _name = 'wh.stock.snapshot'
+    _description = u'库存快照'
+    _order = 'date desc'
+
+    date = fields.Date(
+        u'截止日期', required=True, index=True,
+        help=u'快照保存该日期之前(不含)的结存')
+    period_id = fields.Many2one(
+        'finance.period', u'会计期间', ondelete='set null',
+        help=u'结账时生成的快照对应的会计期间')
+    goods_id = fields.Many2one(
+        'goods', u'产品', required=True, ondelete='cascade',
+        help=u'结存对应的产品')
+    warehouse_id = fields.Many2one(
+        'warehouse', u'仓库', required=True, ondelete='cascade',
+        help=u'结存所在的仓库')
+    attribute_id = fields.Many2one(
+        'attribute', u'属性', ondelete='cascade',
+        help=u'结存对应的产品属性')
+    uom_id = fields.Many2one(
+        'uom', u'单位', ondelete='cascade',
+        help=u'单行上的单位')
+    line_id = fields.Many2one(
+        'wh.move.line', u'最后单行', ondelete='set null',
+        help=u'计入该结存的最后一条单行，作为收发明细表中的记录id')
+    qty = fields.Float(
+        u'结存数量', digits=dp.get_precision('Quantity'),
+        help=u'截止日期之前的结存数量')
+    cost = fields.Float(
+        u'结存成本', digits=dp.get_precision('Amount'),
+        help=u'截止日期之前的结存成本')
+
+    def init(self):
+        self._cr.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS wh_stock_snapshot_key_index
+            ON wh_stock_snapshot (date, goods_id, warehouse_id,
+                COALESCE(attribute_id, 0), COALESCE(uom_id, 0))
+        ''')
+
+    @api.model
+    def get_snapshot_date(self, date):
+        ''' 返回不晚于date的最近一个快照的截止日期，没有快照的时候返回False '''
+        if not date:
+            return False
+
+        self.env.cr.execute('''
+            SELECT max(date) FROM wh_stock_snapshot WHERE date <= %s
+        ''', (date,))
+        snapshot_date = self.env.cr.fetchone()[0]
+
+        return snapshot_date and fields.Date.to_string(snapshot_date) or False
+
+    @api.model
+    def create_snapshot(self, date, period=None):
+        '''
+        生成截止日期为date的快照，在上一个快照的基础上只累加两个快照之间的单行，
+        已经存在的同一日期的快照会被重新生成
+        '''
+        self.env.cr.execute('DELETE FROM wh_stock_snapshot WHERE date = %s', (date,))
+        last_date = self.get_snapshot_date(date)
+
+        self.env.cr.execute('''
+            INSERT INTO wh_stock_snapshot (date, period_id, goods_id, warehouse_id,
+                attribute_id, uom_id, line_id, qty, cost)
+            SELECT %(date)s, %(period_id)s, goods_id, warehouse_id, attribute_id,
+                   uom_id, max(line_id), sum(qty), sum(cost)
+            FROM (
+                SELECT goods_id, warehouse_id, attribute_id, uom_id, line_id, qty, cost
+                FROM wh_stock_snapshot
+                WHERE date = %(last_date)s::date
+                UNION ALL
+                SELECT line.goods_id, line.warehouse_dest_id, line.attribute_id,
+                       line.uom_id, line.id, line.goods_qty, line.cost
+                FROM wh_move_line line
+                JOIN warehouse wh ON line.warehouse_dest_id = wh.id
+                WHERE line.state = 'done' AND wh.type = 'stock'
+                  AND line.date < %(date)s
+                  AND (%(last_date)s::date IS NULL OR line.date >= %(last_date)s::date)
+                UNION ALL
+                SELECT line.goods_id, line.warehouse_id, line.attribute_id,
+                       line.uom_id, line.id, - line.goods_qty, - line.cost
+                FROM wh_move_line line
+                JOIN warehouse wh ON line.warehouse_id = wh.id
+                WHERE line.state = 'done' AND wh.type = 'stock'
+                  AND line.date < %(date)s
+                  AND (%(last_date)s::date IS NULL OR line.date >= %(last_date)s::date)
+            ) moves
+            GROUP BY goods_id, warehouse_id, attribute_id, uom_id
+            HAVING sum(qty) != 0 OR sum(cost) != 0
+        ''', {
+            'date': date,
+            'period_id': period and period.id or None,
+            'last_date': last_date or None,
+        })
+        self.invalidate_cache()
+
+        return True
+
+    @api.model
+    def invalidate_snapshots(self, date):
+        ''' 截止日期晚于date的快照包含了该日期的单行，单行变化之后需要删除 '''
+        if date:
+            self.env.cr.execute('DELETE FROM wh_stock_snapshot WHERE date > %s', (date,))
+            self.invalidate_cache()
+
+        return True
+
+    @api.model
+    def cron_create_snapshot(self):
+        ''' 定时任务：生成截止到本月第一天的快照 '''
+        date = fields.Date.context_today(self)[:8] + '01'
+        if self.get_snapshot_date(date) != date:
+            self.create_snapshot(date)
+
+        return True
+
+
+class wh_move_line(models.Model):
+    _inherit = 'wh.move.line'
+
+    SNAPSHOT_FIELDS = ('state', 'date', 'goods_id', 'attribute_id', 'uom_id',
+                       'warehouse_id', 'warehouse_dest_id', 'goods_qty', 'cost',
+                       'cost_unit')
+
+    @api.multi
+    def write(self, vals):
+        if not any(field in vals for field in self.SNAPSHOT_FIELDS):
+            return super(wh_move_line, self).write(vals)
+
+        dates = [line.date for line in self if line.state == 'done']
+        res = super(wh_move_line, self).write(vals)
+        dates.extend(line.date for line in self if line.state == 'done')
+
+        dates = filter(None, dates)
+        if dates:
+            self.env['wh.stock.snapshot'].invalidate_snapshots(min(dates))
+
+        return res
+
+
+class checkout_wizard(models.TransientModel):
+    _inherit = 'checkout.wizard'
+
+    @api.multi
+    def button_checkout(self):
+        res = super(checkout_wizard, self).button_checkout()
+        # 结账之后生成截止到下一个会计期间第一天的库存快照
+        if self.period_id and self.period_id.is_closed:
+            _, date_end = self.env['finance.period'].get_period_month_date_range(self.period_id)
+            date = datetime.datetime.strptime(date_end, '%Y-%m-%d') + datetime.timedelta(days=1)
+            self.env['wh.stock.snapshot'].create_snapshot(
+                date.strftime('%Y-%m-%d'), period=self.period_id)
+
+        return res
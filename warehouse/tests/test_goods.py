@@ -97,3 +97,96 @@ class TestGoods(TransactionCase):
         suggested_cost, _ = suggested_cost_func(
             self.hd_warehouse, 24, ignore_move=self.others_in_keyboard_mouse.id)
         self.assertEqual(suggested_cost, 24 * 80)
+
+    def test_stock_layer(self):
+        # 已审核的入库单行按照先进先出的顺序生成库存层
+        layers = self.env['wh.stock.layer'].search([
+            ('goods_id', '=', self.goods_keyboard_mouse.id),
+            ('warehouse_id', '=', self.hd_warehouse.id)])
+        self.assertEqual(layers.mapped('line_id').ids,
+                         [self.others_in_keyboard_mouse.id, self.others_in_2_keyboard_mouse.id])
+        self.assertEqual(layers[0].qty_remaining, self.others_in_keyboard_mouse.qty_remaining)
+        self.assertEqual(layers[0].cost_unit, 120)
+        self.assertEqual(layers[1].cost_unit, 80)
+
+        # 每次只读取一条库存层时，匹配结果应该保持一致
+        layer_class = self.env['wh.stock.layer'].__class__
+        layer_class._fetch_size = 1
+        try:
+            records, cost = self.goods_keyboard_mouse.get_matching_records(self.hd_warehouse, 72)
+        finally:
+            layer_class._fetch_size = 100
+        self.assertEqual(cost, 48 * 120 + 24 * 80)
+        self.assertEqual([record.get('line_in_id') for record in records],
+                         [self.others_in_keyboard_mouse.id, self.others_in_2_keyboard_mouse.id])
+
+        # 修改入库成本之后，库存层的单位成本同步更新
+        self.others_in_2_keyboard_mouse.cost = 48 * 90
+        self.assertEqual(layers[1].cost_unit, 90)
+
+        # 取消入库之后，对应的库存层被删除
+        self.others_in_2.cancel_approved_order()
+        layers = self.env['wh.stock.layer'].search([
+            ('goods_id', '=', self.goods_keyboard_mouse.id),
+            ('warehouse_id', '=', self.hd_warehouse.id)])
+        self.assertEqual(layers.mapped('line_id'), self.others_in_keyboard_mouse)
+
+    def test_average_cost(self):
+        # 公司的存货计价方法使用移动平均法
+        self.env.user.company_id.cost_method = 'average'
+        average_obj = self.env['wh.average.cost']
+
+        qty, value = average_obj.get_average(self.goods_keyboard_mouse, self.hd_warehouse)
+        cost, cost_unit = self.goods_keyboard_mouse.get_suggested_cost_by_warehouse(self.hd_warehouse, 24)
+        self.assertAlmostEqual(cost_unit, value / qty)
+        self.assertAlmostEqual(cost, 24 * value / qty)
+
+        others_out = self.env['wh.out'].create({
+            'warehouse_id': self.hd_warehouse.id,
+            'warehouse_dest_id': self.browse_ref('warehouse.warehouse_others').id,
+            'line_out_ids': [(0, 0, {
+                'goods_id': self.goods_keyboard_mouse.id,
+                'goods_qty': 24,
+                'goods_uos_qty': 1,
+                'type': 'out',
+            })],
+        })
+        remaining = sum(self.env['wh.move.line'].search([
+            ('goods_id', '=', self.goods_keyboard_mouse.id),
+            ('warehouse_dest_id', '=', self.hd_warehouse.id),
+            ('state', '=', 'done')]).mapped('qty_remaining'))
+        others_out.approve_order()
+        out_line = others_out.line_out_ids
+        # 出库成本取平均成本，出库之后平均成本不变
+        self.assertAlmostEqual(out_line.cost, 24 * value / qty)
+        # 出库仍然和入库匹配，库存数量按入库单行的剩余数量统计
+        self.assertAlmostEqual(sum(out_line.matching_out_ids.mapped('qty')), 24)
+        self.assertAlmostEqual(sum(self.env['wh.move.line'].search([
+            ('goods_id', '=', self.goods_keyboard_mouse.id),
+            ('warehouse_dest_id', '=', self.hd_warehouse.id),
+            ('state', '=', 'done')]).mapped('qty_remaining')), remaining - 24)
+        stock_qty, stock_value = average_obj.get_average(self.goods_keyboard_mouse, self.hd_warehouse)
+        self.assertAlmostEqual(stock_qty, qty - 24)
+        self.assertAlmostEqual(stock_value, value - out_line.cost)
+
+        # 反审核出库之前的第二次入库，之后的出库按照第一次入库时的平均成本重新计算
+        self.others_in_2.cancel_approved_order()
+        qty, value = qty - 48, value - 48 * 80
+        self.assertAlmostEqual(out_line.cost, 24 * value / qty)
+        stock_qty, stock_value = average_obj.get_average(self.goods_keyboard_mouse, self.hd_warehouse)
+        self.assertAlmostEqual(stock_qty, qty - 24)
+        self.assertAlmostEqual(stock_value, value - out_line.cost)
+
+    def test_quote_costs(self):
+        # 同一张单据的所有行一次报价，同一产品和仓库的行共用读取过的库存层
+        quotes = self.env['goods'].quote_costs([
+            {'goods_id': self.goods_keyboard_mouse.id, 'warehouse_id': self.hd_warehouse.id, 'qty': 72},
+            {'goods_id': self.goods_keyboard_mouse.id, 'warehouse_id': self.hd_warehouse.id, 'qty': 24},
+            {'goods_id': self.goods_keyboard_mouse.id, 'warehouse_id': False, 'qty': 24},
+        ])
+        self.assertEqual([quote[0] for quote in quotes], [48 * 120 + 24 * 80, 24 * 120, 0])
+
+        # 入库成本改变后对应的报价缓存失效
+        self.others_in_keyboard_mouse.cost = 48 * 100
+        suggested_cost, _ = self.goods_keyboard_mouse.get_suggested_cost_by_warehouse(self.hd_warehouse, 24)
+        self.assertEqual(suggested_cost, 24 * 100)
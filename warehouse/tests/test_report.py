@@ -1,9 +1,22 @@
 # -*- coding: utf-8 -*-
 from odoo.tests.common import TransactionCase
 from odoo.exceptions import UserError
+from odoo.addons.warehouse.report.report_cache import LocalReportCache, SharedReportCache
 import operator
 
 
+class FakeCacheClient(object):
+    ''' 测试中代替memcached的客户端 '''
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, time=0):
+        self.values[key] = value
+
+
 class TestReport(TransactionCase):
     def setUp(self):
         super(TestReport, self).setUp()
@@ -105,10 +118,10 @@ class TestReport(TransactionCase):
             (u'鼠标', 'ms160301', u'总仓', 1),
         ]
         domain_results = lot_track.with_context(context).search_read(domain=domain, order='qty DESC')
-        self.assertEqual(sorted(domain_results, key=operator.itemgetter('qty')), domain_results)
+        self.assertEqual(sorted(domain_results, key=operator.itemgetter('qty'), reverse=True), domain_results)
 
         domain_results = lot_track.with_context(context).search_read(domain=domain, order='qty ASC')
-        self.assertEqual(sorted(domain_results, key=operator.itemgetter('qty'), reverse=True), domain_results)
+        self.assertEqual(sorted(domain_results, key=operator.itemgetter('qty')), domain_results)
 
         self.assertEqual(len(domain_results), len(real_results))
         for result in domain_results:
@@ -135,6 +148,42 @@ class TestReport(TransactionCase):
             domain = [('goods', 'lg', u'鼠标')]
             lot_track.with_context(context).search_read(domain=domain)
 
+    def test_report_sql_pushdown(self):
+        stock_transceive = self.env['report.stock.transceive'].create({})
+        self.transceive_wizard.date_start = '2016-02-01'
+        transceive = stock_transceive.with_context(self.transceive_wizard.open_report().get('context'))
+
+        def python_search_read(**kwargs):
+            # 关闭SQL下推，得到python中过滤、排序和分页的结果
+            transceive.__class__._sql_pushdown = False
+            try:
+                transceive.clear_report_cache()
+                return transceive.search_read(**kwargs), transceive.search_count(kwargs.get('domain'))
+            finally:
+                transceive.__class__._sql_pushdown = True
+
+        # 按文字排序的结果依赖数据库的collation，只比较记录是否一致
+        key = operator.itemgetter('id')
+        for kwargs, ordered in [
+            ({'domain': []}, False),
+            ({'domain': [('warehouse', '=', u'总仓')], 'order': 'goods_qty_in DESC'}, True),
+            ({'domain': ['|', ('goods', 'ilike', u'鼠'), ('goods_qty_out', '>', 0)]}, False),
+            ({'domain': [('warehouse', 'in', [u'上海仓']), ('attribute', '=', False)]}, False),
+            ({'domain': [('goods', 'not ilike', u'网线')], 'order': 'goods_qty_in DESC, goods',
+              'limit': 2, 'offset': 1}, True),
+        ]:
+            results, count = python_search_read(**kwargs)
+            sql_results = transceive.search_read(**kwargs)
+            if not ordered:
+                results, sql_results = sorted(results, key=key), sorted(sql_results, key=key)
+            self.assertEqual(sql_results, results)
+            self.assertEqual(transceive.search_count(kwargs.get('domain')), count)
+
+        # 不能转换成SQL的domain和排序仍然在python中处理
+        self.assertEqual(transceive._domain_to_sql([('goods', 'child_of', 1)]), None)
+        self.assertEqual(transceive._order_to_sql('no_field DESC'), None)
+        self.assertEqual(self.env['report.lot.track']._leaf_to_sql(('origin', '=', u'入库')), None)
+
     def test_lot_track_read_group(self):
         lot_track = self.env['report.lot.track'].create({})
         self.track_wizard.date_start = '2016-02-01'
@@ -170,6 +219,43 @@ class TestReport(TransactionCase):
             )
             self.assertTrue(result in real_results)
 
+    def test_report_read_group(self):
+        stock_transceive = self.env['report.stock.transceive'].create({})
+        self.transceive_wizard.date_start = '2016-02-01'
+        transceive = stock_transceive.with_context(self.transceive_wizard.open_report().get('context'))
+        records = transceive.search_read(domain=[], limit=None)
+
+        # 分组汇总所有记录，不受分页的影响
+        results = transceive.read_group([], ['goods_qty_in', 'cost_in'], ['warehouse'], limit=1, orderby='goods_qty_in DESC')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].get('warehouse'), u'总仓')
+        self.assertEqual(results[0].get('warehouse_count'),
+                         len([record for record in records if record.get('warehouse') == u'总仓']))
+        self.assertAlmostEqual(results[0].get('goods_qty_in'),
+                               sum(record.get('goods_qty_in') for record in records
+                                   if record.get('warehouse') == u'总仓'))
+        self.assertEqual(results[0].get('__domain'), [('warehouse', '=', u'总仓')])
+
+        # 不分层展开时按所有分组字段汇总
+        results = transceive.read_group([('goods', '=', u'网线')], ['goods_qty_out:max'],
+                                        ['goods', 'warehouse'], lazy=False)
+        self.assertEqual(sorted((result.get('warehouse'), result.get('__count'), result.get('goods_qty_out'))
+                                for result in results),
+                         sorted([(u'总仓', 1, 120), (u'上海仓', 1, 0)]))
+
+        # 按日期粒度分组
+        lot_track = self.env['report.lot.track'].with_context(self.track_wizard.open_report().get('context'))
+        results = lot_track.read_group([], ['qty'], ['date:year'])
+        self.assertEqual(sum(result.get('date_count') for result in results),
+                         lot_track.search_count([]))
+        for result in results:
+            self.assertEqual(lot_track.search_count(result.get('__domain')), result.get('date_count'))
+
+        # 不能在SQL中分组的字段在python中汇总
+        results = lot_track.read_group([], ['qty'], ['origin'])
+        self.assertEqual(sum(result.get('origin_count') for result in results),
+                         lot_track.search_count([]))
+
     def test_stock_transceive_search_read(self):
         stock_transceive = self.env['report.stock.transceive'].create({})
         self.transceive_wizard.date_start = '2016-02-01'
@@ -201,3 +287,124 @@ class TestReport(TransactionCase):
             self.assertTrue(result in real_results)
 
         stock_transceive.with_context(context).find_source_move_line()
+
+    def test_stock_transceive_source_lines(self):
+        ''' 查看库存调拨明细时不受库存快照的影响 '''
+        stock_transceive = self.env['report.stock.transceive'].create({})
+        self.transceive_wizard.date_start = '2016-02-01'
+        transceive = stock_transceive.with_context(self.transceive_wizard.open_report().get('context'))
+
+        def source_line_ids():
+            result = {}
+            for record in transceive.search_read(domain=[]):
+                action = transceive.browse(record.get('id')).find_source_move_line()
+                result[(record.get('goods'), record.get('warehouse'))] = sorted(action['domain'][0][2])
+            return result
+
+        line_ids = source_line_ids()
+        self.assertTrue(all(line_ids.values()))
+        self.env['wh.stock.snapshot'].create_snapshot(self.transceive_wizard.date_start)
+        self.assertEqual(source_line_ids(), line_ids)
+
+    def test_report_cache(self):
+        # 进程内缓存按LRU淘汰，并且限制缓存的行数
+        cache = LocalReportCache(max_entries=2, max_records=2)
+        cache.set((('db', 'a'), 1), [1])
+        cache.set((('db', 'b'), 1), [2])
+        self.assertEqual(cache.get((('db', 'a'), 1)), [1])
+        cache.set((('db', 'c'), 1), [3])
+        self.assertEqual(cache.get((('db', 'b'), 1)), None)
+        self.assertEqual(cache.get((('db', 'a'), 1)), [1])
+        self.assertFalse(cache.set((('db', 'd'), 1), [1, 2, 3]))
+
+        # 过期之后的结果不再返回
+        cache.set((('db', 'e'), 1), [4], expired_time=-1)
+        self.assertEqual(cache.get((('db', 'e'), 1)), None)
+
+        cache.clear(('db', 'a'))
+        self.assertEqual(cache.get((('db', 'a'), 1)), None)
+        self.assertEqual(cache.get((('db', 'c'), 1)), [3])
+
+        # 不同的日期范围分别缓存，互不淘汰
+        stock_transceive = self.env['report.stock.transceive'].create({})
+        stock_transceive.__class__._cache_backend = SharedReportCache(FakeCacheClient())
+        try:
+            self.transceive_wizard.date_start = '2016-02-01'
+            context = self.transceive_wizard.open_report().get('context')
+            results = stock_transceive.with_context(context).search_read(domain=[])
+
+            other_context = dict(context, date_end='2016-02-02')
+            stock_transceive.with_context(other_context).search_read(domain=[])
+            self.assertEqual(stock_transceive.with_context(context).search_read(domain=[]), results)
+
+            key = stock_transceive.with_context(context)._get_cache_key()
+            other_key = stock_transceive.with_context(other_context)._get_cache_key()
+            self.assertNotEqual(key, other_key)
+            self.assertEqual(stock_transceive._cache_backend.get(key), results)
+            self.assertNotEqual(stock_transceive._cache_backend.get(other_key), None)
+
+            # 只影响界面的context不作为缓存的key
+            self.assertEqual(key, stock_transceive.with_context(
+                context, params={'action': 1}, search_default_goods=1)._get_cache_key())
+
+            stock_transceive.clear_report_cache()
+            self.assertEqual(stock_transceive._cache_backend.get(key), None)
+        finally:
+            stock_transceive.__class__._cache_backend = None
+
+    def test_stock_snapshot(self):
+        stock_transceive = self.env['report.stock.transceive'].create({})
+        snapshot_obj = self.env['wh.stock.snapshot']
+        self.transceive_wizard.date_start = '2016-03-01'
+        context = self.transceive_wizard.open_report().get('context')
+
+        def get_results():
+            stock_transceive.clear_report_cache()
+            return sorted((
+                result.get('goods'),
+                result.get('warehouse'),
+                result.get('goods_qty_begain'),
+                result.get('cost_begain'),
+                result.get('goods_qty_end'),
+                result.get('goods_qty_out'),
+                result.get('goods_qty_in'),
+            ) for result in stock_transceive.with_context(context).search_read(domain=[]))
+
+        real_results = get_results()
+
+        # 第二个快照在第一个快照的基础上累加
+        snapshot_obj.create_snapshot('2016-02-10')
+        snapshot_obj.create_snapshot('2016-03-01')
+        self.assertEqual(snapshot_obj.get_snapshot_date('2016-02-20'), '2016-02-10')
+        self.assertEqual(snapshot_obj.get_snapshot_date('2016-03-01'), '2016-03-01')
+        self.assertFalse(snapshot_obj.get_snapshot_date('2016-01-01'))
+
+        # 从快照取期初之后，收发明细表的结果不变
+        self.assertEqual(get_results(), real_results)
+        stock_transceive.with_context(context).find_source_move_line()
+
+        # 快照之前的单行发生变化，之后的快照被删除
+        snapshot_obj.create_snapshot('2100-01-01')
+        self.env['wh.internal'].search([]).cancel_approved_order()
+        self.assertEqual(snapshot_obj.get_snapshot_date('2100-01-01'), '2016-03-01')
+
+    def test_stock_balance(self):
+        cable = self.env.ref('goods.cable')
+        balance_obj = self.env['report.stock.balance']
+
+        # 库存余额随出入库单据审核增量更新
+        balances = balance_obj.search([('goods_id', '=', cable.id)])
+        self.assertEqual({balance.warehouse: balance.goods_qty for balance in balances},
+                         {u'总仓': 12048 - 120, u'上海仓': 120})
+
+        # 库存余额与重新汇总库存层的结果一致
+        for balance in balances:
+            layers = self.env['wh.stock.layer'].search([
+                ('goods_id', '=', cable.id), ('warehouse_id', '=', balance.warehouse_id.id)])
+            self.assertAlmostEqual(balance.cost, sum(layer.qty_remaining * layer.cost_unit for layer in layers))
+
+        # 反审核调拨单之后，上海仓的库存余额被删除，总仓的库存余额恢复
+        self.env['wh.internal'].search([]).cancel_approved_order()
+        balances = balance_obj.search([('goods_id', '=', cable.id)])
+        self.assertEqual({balance.warehouse: balance.goods_qty for balance in balances},
+                         {u'总仓': 12048})
@@ -72,6 +72,56 @@ class TestWarehouseOrder(TransactionCase):
         self.assertEqual(self.others_out_2.state, 'done')
         self.assertEqual(self.internal.state, 'done')
 
+    def test_batch_matching(self):
+        # 同一张出库单上的多行键盘套装只读取一次库存层，按行的顺序依次先进先出匹配
+        others_out = self.env['wh.out'].create({
+            'warehouse_id': self.browse_ref('warehouse.hd_stock').id,
+            'warehouse_dest_id': self.browse_ref('warehouse.warehouse_others').id,
+            'line_out_ids': [(0, 0, {
+                'goods_id': self.browse_ref('goods.keyboard_mouse').id,
+                'goods_qty': 30,
+                'goods_uos_qty': 1,
+                'type': 'out',
+            }), (0, 0, {
+                'goods_id': self.browse_ref('goods.keyboard_mouse').id,
+                'goods_qty': 30,
+                'goods_uos_qty': 1,
+                'type': 'out',
+            })],
+        })
+        others_out.approve_order()
+
+        first_line, second_line = others_out.line_out_ids
+        # 第一行先取掉others_in剩余的24个，再从others_in_2取6个
+        self.assertEqual(first_line.cost, 24 * self.others_in_keyboard_mouse.cost_unit +
+                         6 * self.others_in_2_keyboard_mouse.cost_unit)
+        self.assertEqual(second_line.cost, 30 * self.others_in_2_keyboard_mouse.cost_unit)
+        self.assertEqual(first_line.matching_out_ids.mapped('line_in_id'),
+                         self.others_in_keyboard_mouse | self.others_in_2_keyboard_mouse)
+
+        # 入库单行的剩余数量和库存层保持一致
+        self.assertEqual(self.others_in_keyboard_mouse.qty_remaining, 0)
+        self.assertEqual(self.others_in_2_keyboard_mouse.qty_remaining, 48 - 36)
+        layer = self.env['wh.stock.layer'].search([('line_id', '=', self.others_in_2_keyboard_mouse.id)])
+        self.assertEqual(layer.qty_remaining, 48 - 36)
+        self.assertFalse(self.env['wh.stock.layer'].search([('line_id', '=', self.others_in_keyboard_mouse.id)]))
+
+    def test_check_qty_remaining(self):
+        line_obj = self.env['wh.move.line']
+        line_ids = [self.overage_in_cable.id, self.others_in_keyboard_mouse.id]
+
+        # 增量维护的剩余数量应该与根据匹配记录重新推导的结果一致
+        self.assertEqual(line_obj.check_qty_remaining(line_ids), [])
+
+        self.env.cr.execute('UPDATE wh_move_line SET qty_remaining = 0 WHERE id = %s',
+                            (self.overage_in_cable.id,))
+        self.assertEqual(line_obj.check_qty_remaining(line_ids), [self.overage_in_cable.id])
+
+        # 修正之后剩余数量恢复正确
+        line_obj.check_qty_remaining(line_ids, fix=True)
+        self.assertEqual(self.overage_in_cable.qty_remaining, 12000 - 120 + 48)
+        self.assertEqual(line_obj.check_qty_remaining(line_ids), [])
+
     def test_unlink(self):
 
         # 审核后的单据无法被取消
@@ -6,6 +6,17 @@ def safe_division(divisor, dividend):
     return dividend != 0 and divisor / dividend or 0
 
 
+def iter_buffered(buffered, iterator):
+    # 先返回buffered中已经读取过的元素，再继续从iterator中读取并追加到buffered中，
+    # 这样多次遍历可以共用同一个只读取一次的iterator
+    for item in buffered:
+        yield item
+
+    for item in iterator:
+        buffered.append(item)
+        yield item
+
+
 def create_name(method):
     @functools.wraps(method)
     def func(self, vals):